@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os.path
+import shutil
+import tempfile
+import json
+import math
+import struct
+import zlib
+import platform
+import datetime
+from timeit import default_timer
+from optparse import OptionParser
+
+#local imports
+import ffault
+from tag import Tag
+
+#event code used for the synthetic finite fault directories
+EVENTCODE = 'b0000000'
+NETWORK = 'us'
+
+#size of the synthetic wave plot pages
+PAGE_WIDTH = 800
+PAGE_HEIGHT = 600
+
+#spacing of the synthetic subfaults (km) and deformation points (degrees)
+SUBFAULT_SIZE = 10.0
+DISP_SPACING = 0.01
+
+def makePNG(pngfile,width,height):
+    """
+    Write an RGB PNG file with a simple pattern.
+    """
+    rows = []
+    for y in range(0,height):
+        row = ''.join([chr((x*7+y*3) % 256)+chr((x*y) % 256)+chr(y % 256) for x in range(0,width)])
+        rows.append('\x00'+row)
+    def chunk(ctype,data):
+        return struct.pack('>I',len(data))+ctype+data+struct.pack('>I',zlib.crc32(ctype+data) & 0xffffffff)
+    f = open(pngfile,'wb')
+    f.write('\x89PNG\r\n\x1a\n')
+    f.write(chunk('IHDR',struct.pack('>IIBBBBB',width,height,8,2,0,0,0)))
+    f.write(chunk('IDAT',zlib.compress(''.join(rows),6)))
+    f.write(chunk('IEND',''))
+    f.close()
+
+def makeEventFile(eventfile,nsegments):
+    #Event_mult.in, laid out as described in ffault.readMulti()
+    lines = ['2015 3 29 23',
+             '255.16 20.26 83.16 2.47e+20',
+             '-4.8812 152.5964 2015 3 29 23',
+             '0.2 10 0',
+             '1 1 5',
+             '2.5',
+             '%i 9 6' % nsegments,
+             '1',
+             '30 255 83 1',
+             '17 5 0',
+             '9 1 1 41']
+    for i in range(1,nsegments):
+        lines += ['%i' % (i+1),
+                  '%.1f %.1f 83 1' % (30.0-(i % 10),255.0-(i % 20)),
+                  '17 5 0',
+                  '9 6',
+                  '1 1 1 1 1',
+                  '1 6 1 1']
+    f = open(eventfile,'wt')
+    f.write('\n'.join(lines)+'\n')
+    f.close()
+
+def makeStationFile(wavefile,nstations):
+    #Readlp.das, laid out as described in ffmfiles.readStations()
+    lines = ['header']*4 + ['%i' % nstations]
+    for i in range(0,nstations):
+        wavetype = 1
+        if i % 3 == 0:
+            wavetype = 3
+        lines.append('%3i STA%i %8.3f %8.3f IU BHZ %7.2f %7.2f %i 1.0' % (i+1,i,10.0,20.0,30.0+(i % 60),
+                                                                        (i*37) % 360,wavetype))
+    f = open(wavefile,'wt')
+    f.write('\n'.join(lines)+'\n')
+    f.close()
+
+def makeFSPFile(fspfile,nsegments,nsubfaults):
+    #FSP (SRCMOD format) file with nsubfaults subfaults in each segment
+    f = open(fspfile,'wt')
+    f.write('% ---------------------- FINITE-SOURCE RUPTURE MODEL ----------------------\n')
+    f.write('%% EventTAG: %s\n' % EVENTCODE)
+    f.write('%% Invs : Dx = %.2f km  Dz = %.2f km\n' % (SUBFAULT_SIZE,SUBFAULT_SIZE))
+    f.write('%% Invs : Ntw = 5  Nsg = %i\n' % nsegments)
+    for segment in range(0,nsegments):
+        f.write('%% SEGMENT # %i: STRIKE = 255.2 deg DIP = 20.3 deg\n' % (segment+1))
+        f.write('%   LAT     LON     X==EW   Y==NS   Z     SLIP   RAKE   TRUP   RISE   SF_MOMENT\n')
+        f.write('% ---------------------------------------------------------------------------\n')
+        for i in range(0,nsubfaults):
+            f.write('%8.4f %9.4f %7.2f %7.2f %6.2f %6.2f %6.1f %6.2f %6.2f %10.3e\n' % (-4.9+0.001*i,152.5+0.001*i,
+                                                                                     i*1.0,i*0.5,10.0+(i % 30),
+                                                                                     (i % 7)*1.5,83.0,i*0.1,4.0,
+                                                                                     1e19*((i % 5)+1)))
+    f.close()
+
+def makeDispFile(dispfile,npoints):
+    #surface deformation on a square grid of about npoints points: lon lat east north up
+    nside = max(2,int(math.sqrt(npoints)))
+    f = open(dispfile,'wt')
+    f.write('# Lon Lat Ux Uy Uz\n')
+    for j in range(0,nside):
+        lat = -6.0+j*DISP_SPACING
+        for i in range(0,nside):
+            lon = 151.5+i*DISP_SPACING
+            r = math.exp(-((i-nside/2.0)**2+(j-nside/2.0)**2)/(nside*nside/8.0))
+            f.write('%9.4f %9.4f %10.5f %10.5f %10.5f\n' % (lon,lat,0.3*r,-0.2*r,1.2*r-0.4*r*r))
+    f.close()
+
+def makeMomentRateFile(mrfile,moment=2.47e27,duration=36.0,dt=0.5):
+    #source time function (time, moment rate) integrating to about moment
+    times = [i*dt for i in range(0,int(duration/dt)+1)]
+    rates = [math.sin(math.pi*t/duration)**2 for t in times]
+    total = sum(rates)*dt
+    f = open(mrfile,'wt')
+    for t,rate in zip(times,rates):
+        f.write('%14.6E %14.6E\n' % (t,rate*moment/total))
+    f.close()
+
+def makeCMTFile(cmtfile,nsources):
+    f = open(cmtfile,'wt')
+    for i in range(0,nsources):
+        m = 1e25*((i % 5)+1)
+        f.write('PDE 2015  3 29 23 48 31.00  -4.7290  152.5620  41.0 7.5 7.5 NEAR COAST OF PAPUA NEW GUINEA\n')
+        f.write('event name:     %s\n' % EVENTCODE)
+        f.write('time shift:  %10.4f\n' % (i*0.1))
+        f.write('half duration:  %10.4f\n' % 2.0)
+        f.write('latitude:  %10.4f\n' % (-4.9+0.001*i))
+        f.write('longitude: %10.4f\n' % (152.5+0.001*i))
+        f.write('depth:  %10.4f\n' % (10.0+(i % 30)))
+        for label,scale in [('Mrr',0.4),('Mtt',-0.1),('Mpp',-0.3),('Mrt',0.8),('Mrp',-0.2),('Mtp',0.05)]:
+            f.write('%s:  %13.6e\n' % (label,scale*m))
+    f.close()
+
+def makeFFMDir(ffmdir,nsegments,nstations,npages,nsubfaults,npoints):
+    """
+    Make a synthetic finite fault directory.
+    @param ffmdir: Directory to create.
+    @param nsegments: Number of fault segments (Event_mult.in and .fsp).
+    @param nstations: Number of records in Readlp.das.
+    @param npages: Number of body wave and of surface wave plot pages.
+    @param nsubfaults: Number of subfaults per segment (.fsp and CMTSOLUTION).
+    @param npoints: Approximate number of points in the .disp grid.
+    """
+    if not os.path.isdir(ffmdir):
+        os.makedirs(ffmdir)
+    makeEventFile(os.path.join(ffmdir,'Event_mult.in'),nsegments)
+    f = open(os.path.join(ffmdir,'plot_info'),'wt')
+    f.write('255 20 83 2.47e+27\n\n7.5\n')
+    f.close()
+    makeStationFile(os.path.join(ffmdir,'Readlp.das'),nstations)
+    f = open(os.path.join(ffmdir,'synm.str_low'),'wt')
+    f.write('%i\n' % (nstations/4))
+    f.close()
+    pagefile = os.path.join(ffmdir,'%s_bwave_1.png' % EVENTCODE)
+    makePNG(pagefile,PAGE_WIDTH,PAGE_HEIGHT)
+    #the pages are all the same picture, so make it once and copy it
+    for i in range(0,npages):
+        for wave in ['bwave','swave']:
+            outfile = os.path.join(ffmdir,'%s_%s_%i.png' % (EVENTCODE,wave,i+1))
+            if outfile != pagefile:
+                shutil.copyfile(pagefile,outfile)
+    for fname in ['%s_basemap.png' % EVENTCODE,'%s_slip2.png' % EVENTCODE,'mr.png']:
+        shutil.copyfile(pagefile,os.path.join(ffmdir,fname))
+    makeFSPFile(os.path.join(ffmdir,'%s.fsp' % EVENTCODE),nsegments,nsubfaults)
+    makeDispFile(os.path.join(ffmdir,'%s.disp' % EVENTCODE),npoints)
+    makeMomentRateFile(os.path.join(ffmdir,'%s.mr' % EVENTCODE))
+    makeCMTFile(os.path.join(ffmdir,'CMTSOLUTION'),nsegments*nsubfaults)
+    for fname in ['%s.param' % EVENTCODE,'%s_coulomb.inp' % EVENTCODE]:
+        f = open(os.path.join(ffmdir,fname),'wt')
+        f.write('0\n')
+        f.close()
+
+def timeStage(function,setup=None,repeat=5):
+    """
+    Time a function, calling setup (untimed) before each call.
+    @return: Dictionary with the min, mean and max times (s) and the number of calls (repeat).
+    """
+    times = []
+    for i in range(0,repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        function()
+        times.append(default_timer()-start)
+    return {'min':min(times),'mean':sum(times)/len(times),'max':max(times),'repeat':repeat}
+
+def removeFolder(folder):
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+
+def runBenchmark(workdir,nsegments,nstations,npages,nsubfaults,npoints,repeat):
+    """
+    Make a synthetic finite fault directory in workdir and time each stage of building a product from it.
+    @return: List of (stage name,timing dictionary from timeStage()) tuples, in the order they were run.
+    """
+    ffmdir = os.path.join(workdir,'ffm')
+    makeFFMDir(ffmdir,nsegments,nstations,npages,nsubfaults,npoints)
+    ffault.BASE_PDL_FOLDER = os.path.join(workdir,'pdloutput')
+    eventid = NETWORK+EVENTCODE
+    pdlfolder = os.path.join(ffault.BASE_PDL_FOLDER,eventid)
+    webfolder = os.path.join(pdlfolder,'web')
+    manifestfile = ffault.getManifestFile(webfolder)
+    results = []
+
+    def clearEventCache():
+        removeFolder(ffault.getCacheFolder('eventinfo'))
+    results.append(('getEventInfo',timeStage(lambda: ffault.getEventInfo(ffmdir),clearEventCache,repeat)))
+    results.append(('getEventInfo (cached)',timeStage(lambda: ffault.getEventInfo(ffmdir),None,repeat)))
+
+    def clearStaged():
+        removeFolder(pdlfolder)
+        removeFolder(ffault.getCacheFolder('blobs'))
+        os.makedirs(webfolder)
+    copy = lambda: ffault.copyFiles(ffmdir,webfolder,manifestfile)
+    results.append(('copyFiles',timeStage(copy,clearStaged,repeat)))
+    results.append(('copyFiles (unchanged)',timeStage(copy,None,repeat)))
+
+    eventdict = ffault.makeTextBlocks([ffault.getEventInfo(ffmdir)])[0]
+    bodyfiles,surfacefiles = ffault.getWavePlots(ffmdir)
+    htmldata = open(os.path.join(os.path.dirname(os.path.abspath(ffault.__file__)),ffault.TEMPLATE1),'rt').read()
+    caption = ffault.getCaption([ffmdir])
+    fill = lambda: ffault.fillHTML(eventdict,htmldata,'Benchmark.',EVENTCODE,bodyfiles,surfacefiles,1,caption,
+                                   location='Synthetic event')
+    results.append(('fillHTML',timeStage(fill,None,repeat)))
+
+    contents = lambda: ffault.createContentsXML(eventid,pdlfolder,bodyfiles,[],surfacefiles,[])
+    results.append(('createContentsXML',timeStage(contents,None,repeat)))
+
+    xmlstr = open(os.path.join(pdlfolder,'contents.xml'),'rt').read()
+    def load():
+        tag = Tag('contents')
+        tag.loadFromString(xmlstr)
+        return tag
+    results.append(('Tag.loadFromString',timeStage(load,None,repeat)))
+    tag = load()
+    results.append(('Tag.renderToXML',timeStage(tag.renderToXML,None,repeat)))
+    return results
+
+def main(options):
+    workdir = tempfile.mkdtemp(prefix='ffbenchmark')
+    try:
+        parameters = {'segments':options.segments,'stations':options.stations,'pages':options.pages,
+                      'subfaults':options.subfaults,'points':options.points,'repeat':options.repeat}
+        stages = runBenchmark(workdir,options.segments,options.stations,options.pages,
+                              options.subfaults,options.points,options.repeat)
+    finally:
+        if options.keep:
+            print 'Synthetic data left in %s' % workdir
+        else:
+            shutil.rmtree(workdir)
+    for name,timing in stages:
+        print '%-24s min %9.4f s  mean %9.4f s' % (name,timing['min'],timing['mean'])
+    if options.output is not None:
+        result = {'time':datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+                  'host':platform.node(),
+                  'python':platform.python_version(),
+                  'numpy':ffault.readFSP is not None,
+                  'parameters':parameters,
+                  'stages':[dict(timing,name=name) for name,timing in stages]}
+        f = open(options.output,'wt')
+        json.dump(result,f,indent=1,sort_keys=True)
+        f.close()
+        print 'Results written to %s' % options.output
+
+if __name__ == '__main__':
+    usage = """usage: %prog [options]
+    Time the stages of building a finite fault product from a synthetic finite fault directory."""
+    parser = OptionParser(usage=usage)
+    parser.add_option("-n", "--segments", dest="segments", type="int", default=3,
+                      help="Number of fault segments", metavar="N")
+    parser.add_option("-m", "--stations", dest="stations", type="int", default=100,
+                      help="Number of wave records in Readlp.das", metavar="M")
+    parser.add_option("-k", "--pages", dest="pages", type="int", default=10,
+                      help="Number of body wave and of surface wave plot pages", metavar="K")
+    parser.add_option("-f", "--subfaults", dest="subfaults", type="int", default=1000,
+                      help="Number of subfaults per segment", metavar="NSUB")
+    parser.add_option("-d", "--points", dest="points", type="int", default=250000,
+                      help="Approximate number of points in the deformation grid", metavar="NPOINTS")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=5,
+                      help="Number of times to run each stage", metavar="R")
+    parser.add_option("-o", "--output", dest="output",
+                      help="Write the results as JSON to FILE", metavar="FILE")
+    parser.add_option("-e", "--keep", dest="keep", action="store_true", default=False,
+                      help="Keep the synthetic data")
+    (options,args) = parser.parse_args()
+    main(options)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os.path
+import json
+import hashlib
+import datetime
+
+TIMEFMT = '%Y-%m-%dT%H:%M:%S'
+
+#bump this when the fields change, so old cache files are ignored
+CACHE_VERSION = 1
+
+class EventInfo(object):
+    """
+    Everything read from one finite fault directory: origin, moment, fault segments and data counts.
+    Fields that are only sometimes present (slip and station statistics) are kept in extras.
+    """
+    __slots__ = ('time','lat','lon','depth','moment','magnitude','numsegments','segments',
+                 'nump','nums','npsh','numlow','nplow','extras')
+
+    FIELDS = ['time','lat','lon','depth','moment','magnitude','numsegments',
+              'nump','nums','npsh','numlow','nplow']
+
+    def __init__(self,**kwargs):
+        """
+        @param kwargs: Values for the fields in FIELDS, plus segments, a list of (strike,dip,rake)
+        tuples (one per segment), and extras, a dictionary of any other values.
+        """
+        for field in self.FIELDS:
+            setattr(self,field,kwargs[field])
+        self.segments = [tuple(segment) for segment in kwargs.get('segments',[])]
+        self.extras = dict(kwargs.get('extras',{}))
+
+    @classmethod
+    def fromDict(cls,eventdict):
+        """
+        Make an EventInfo from an event dictionary (see ffault.getEventInfo()), where the segments
+        are stored as strike1,dip1,rake1,strike2,...
+        """
+        kwargs = {}
+        used = set()
+        for field in cls.FIELDS:
+            kwargs[field] = eventdict[field]
+            used.add(field)
+        segments = []
+        for i in range(1,eventdict['numsegments']+1):
+            keys = ['strike%i' % i,'dip%i' % i,'rake%i' % i]
+            segments.append(tuple([eventdict[key] for key in keys]))
+            used.update(keys)
+        kwargs['segments'] = segments
+        kwargs['extras'] = dict([(key,value) for key,value in eventdict.iteritems() if key not in used])
+        return cls(**kwargs)
+
+    def asDict(self):
+        """
+        @return: Event dictionary, in the form returned by ffault.getEventInfo().
+        """
+        eventdict = dict(self.extras)
+        for field in self.FIELDS:
+            eventdict[field] = getattr(self,field)
+        for i in range(0,len(self.segments)):
+            strike,dip,rake = self.segments[i]
+            eventdict['strike%i' % (i+1)] = strike
+            eventdict['dip%i' % (i+1)] = dip
+            eventdict['rake%i' % (i+1)] = rake
+        return eventdict
+
+    def toJSON(self):
+        data = {}
+        for field in self.FIELDS:
+            data[field] = getattr(self,field)
+        data['time'] = self.time.strftime(TIMEFMT)
+        data['segments'] = self.segments
+        data['extras'] = self.extras
+        return data
+
+    @classmethod
+    def fromJSON(cls,data):
+        data = dict(data)
+        data['time'] = datetime.datetime.strptime(data['time'],TIMEFMT)
+        return cls(**data)
+
+    def __repr__(self):
+        return 'EventInfo(%s Mw %.1f at %.4f,%.4f, %i segment(s))' % (self.time.strftime(TIMEFMT),self.magnitude,
+                                                                   self.lat,self.lon,self.numsegments)
+
+def getInputKey(inputfiles,salt=''):
+    """
+    Fingerprint a set of input files by name, size and modification time, without reading them.
+    @param inputfiles: List of files.  Missing files are allowed (and are part of the fingerprint).
+    @param salt: Anything else the cached result depends on.
+    @return: Hex digest that changes whenever any of the files does.
+    """
+    sha = hashlib.sha1('%i %s' % (CACHE_VERSION,salt))
+    for inputfile in sorted(inputfiles):
+        try:
+            stat = os.stat(inputfile)
+            sha.update('%s %i %r\n' % (os.path.abspath(inputfile),stat.st_size,stat.st_mtime))
+        except OSError:
+            sha.update('%s missing\n' % os.path.abspath(inputfile))
+    return sha.hexdigest()
+
+class EventInfoCache(object):
+    """
+    EventInfo records saved as JSON, one file per finite fault directory, each tagged with the
+    fingerprint (see getInputKey()) of the files it was read from.
+    """
+    def __init__(self,cachefolder):
+        self.cachefolder = cachefolder
+
+    def _getFile(self,inputfolder):
+        name = hashlib.sha1(os.path.abspath(inputfolder)).hexdigest()
+        return os.path.join(self.cachefolder,'%s.json' % name)
+
+    def get(self,inputfolder,key):
+        """
+        @return: Cached EventInfo for inputfolder, or None if there isn't one for these inputs (key).
+        """
+        try:
+            data = json.load(open(self._getFile(inputfolder),'rt'))
+            if data['key'] != key:
+                return None
+            return EventInfo.fromJSON(data['eventinfo'])
+        except (IOError,ValueError,KeyError,TypeError):
+            return None
+
+    def put(self,inputfolder,key,eventinfo):
+        if not os.path.isdir(self.cachefolder):
+            try:
+                os.makedirs(self.cachefolder)
+            except OSError:
+                pass #another process made it first
+        cachefile = self._getFile(inputfolder)
+        tmpfile = cachefile + '.%i.tmp' % os.getpid()
+        f = open(tmpfile,'wt')
+        json.dump({'key':key,'inputfolder':os.path.abspath(inputfolder),'eventinfo':eventinfo.toJSON()},f,indent=1,sort_keys=True)
+        f.close()
+        os.rename(tmpfile,cachefile)
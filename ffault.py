@@ -7,14 +7,36 @@ import glob
 from optparse import OptionParser
 import json
 import datetime
-import shutil
-import urllib2
 import getpass
 import subprocess
 import math
+import csv
+import traceback
+import cProfile
+import pstats
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 #local imports
 from tag import Tag
+from pdlsender import PDLSender,CommandTransport,getTransport
+from location import LocationCache,LocationLookup
+from template import getTemplate,render
+from staging import stageFiles,copyFiles as stageAll,BlobStore,checkStaged
+from pngtools import ImageCache,optimizePNG
+from eventinfo import EventInfo,EventInfoCache,getInputKey
+from timing import Timer,getTimer,setTimer,span
+
+#the subfault and station statistics and the compact deformation files need numpy - without it they are left out
+try:
+    from ffmfiles import readFSP,getSlipStats,readStations,getStationStats,writeDispProducts
+    from ffmfiles import readMomentRate,getMomentRateStats,writeCMTBinary
+except ImportError:
+    readFSP = None
+    readMomentRate = None
+    writeCMTBinary = None
+    readStations = None
+    writeDispProducts = None
 
 #PDL command stuff
 JARFILE = 'ProductClient.jar'
@@ -29,9 +51,29 @@ DEFAULT_CAPTION = """Surface projection of the slip distribution superimposed on
 
 #required size of the base map for web page
 WEB_MAP_WIDTH = 304
-#output name for web base map
+#output name for web base map (made from the first plane's map, in two plane mode)
 OUTPUT_BASEMAP = 'basemap.png'
 
+#warn when the moment from the .mr file and plot_info differ by more than this fraction
+MR_MOMENT_TOLERANCE = 0.25
+
+#suffixes of the compact deformation files made from EVENT.disp
+DISP_GRID_SUFFIX = '_disp.bin'
+DISP_SUMMARY_SUFFIX = '_disp.geojson'
+
+#columnar binary copy of CMTSOLUTION (see ffmfiles.writeCMTBinary())
+CMT_BINARY_FILE = 'CMTSOLUTION.bin'
+
+#suffixes of the timing and profile reports written next to each PDL output folder
+TIMING_SUFFIX = '_timing.json'
+PROFILE_SUFFIX = '_profile.prof'
+#how many functions to print from a profile
+PROFILE_FUNCTIONS = 25
+
+#width of the optional wave plot thumbnails, and the folder (inside each web folder) they go in
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_FOLDER = 'thumbnails'
+
 #depending on whether user is "gavin" or "mhearne", choose one of these
 PRODCMD = "java -jar [JARFILE] --configFile=[CONFIGFILE] --send --source=us --type=finite-fault --code=[NET][EVENTCODE] --directory=[FFMDIR] --privateKey=/Users/%s/Desktop/ProductClient/id_dsa_ffm  --eventsource=[NET] --eventsourcecode=[EVENTCODE] [PROPERTIES]" % getpass.getuser()
 
@@ -44,6 +86,12 @@ TEMPLATE2 = 'template2.html'
 #folder where all pdl output should go
 BASE_PDL_FOLDER = '/Users/%s/pdloutput/' % getpass.getuser()
 
+#folder (inside BASE_PDL_FOLDER) where cached information is kept between runs
+CACHE_FOLDER = '.cache'
+
+#how long (seconds) to wait for the USGS event feed before describing the location offline
+LOCATION_TIMEOUT = 10.0
+
 #list of file patterns to copy from input folder(s) to output folder
 FILE_PATTERNS = {'bodywave':'*bwave*.png',
                  'surfacewave':'*swave*.png',
@@ -106,6 +154,17 @@ al., 2000).
 <i>Table 1. Multi-Segment Parameters.</i>
 """
 
+#sentences added to the result paragraph when the subfault (.fsp) file could be read
+SLIP_TEMPLATE = """ The peak slip is [PS] m, and the slip-weighted centroid of the
+rupture is at [CLAT], [CLON] at a depth of [CDEP] km."""
+AREA_TEMPLATE = """ The rupture covers [AREA] km^2."""
+DURATION_TEMPLATE = """ The rupture lasted about [DUR] s."""
+
+#same, for each plane's summary in the two plane template
+PLANE_SLIP_TEMPLATE = """Peak slip= [PS] m Centroid= [CLAT], [CLON], [CDEP] km deep<br />\n"""
+PLANE_AREA_TEMPLATE = """Rupture area= [AREA] km^2<br />\n"""
+PLANE_DURATION_TEMPLATE = """Duration= [DUR] s<br />\n"""
+
 
 
 CONTENTSBODYBLOCK = """\n<file title="Body Waves Plot" id="bodywave[V]">
@@ -193,59 +252,57 @@ HTMLFRAGMENT = """<div>
 <p>[COMMENT]</p>
 </div>"""
 
-possiblelocs = ['/usr/bin','/bin','/usr/local/bin','/sw/bin',
-                os.path.join(os.path.expanduser("~"),'bin'),
-                '/home/shake/bin','/opt/local/bin','/opt/ImageMagick/bin/']
-
-def findbinary(bin):
-    """
-    Search for binary in any of a list of likely locations on a Unix/Linux system.
-    @param bin:  Name of binary to find ('ps2pdf','eps2pdf', etc.)
-    """
-    found = False
-    binfile = None
-    for p in possiblelocs:
-        binfile = os.path.join(p,bin)
-        if os.path.isfile(binfile):
-            found = True
-            break
-        
-    return binfile
+def getImageCache():
+    #resized images are kept between runs, keyed by source image and size
+    return ImageCache(getCacheFolder('images'))
 
-def makeWebMap(webfolder):
-    convertbin = findbinary('convert')
-    if convertbin is None:
-        return
+def makeWebMap(webfolder,outputname=OUTPUT_BASEMAP):
     pdlfolder,web = os.path.split(os.path.abspath(webfolder))
     basemap = glob.glob(os.path.join(webfolder,'*_basemap.png'))
     if len(basemap):
         basemap = basemap[0]
     else:
         return
-    output = os.path.join(pdlfolder,OUTPUT_BASEMAP)
-    cmd = '%s %s -resize %ix %s' % (convertbin,basemap,WEB_MAP_WIDTH,output)
-    output,retcode = getCommandOutput(cmd)
+    output = os.path.join(pdlfolder,outputname)
+    try:
+        getImageCache().resize(basemap,WEB_MAP_WIDTH,output)
+    except Exception,msg:
+        print 'Could not make web map from %s: %s' % (basemap,str(msg))
+
+def makeThumbnails(webfolder,plotfiles):
+    """
+    Make small copies of wave plots in the thumbnails folder inside webfolder.
+    @param plotfiles: List of plot files, named as they were copied into webfolder.
+    """
+    thumbfolder = os.path.join(webfolder,THUMBNAIL_FOLDER)
+    if not os.path.isdir(thumbfolder):
+        os.makedirs(thumbfolder)
+    cache = getImageCache()
+    for plotfile in plotfiles:
+        plotfile = os.path.join(webfolder,os.path.basename(plotfile))
+        try:
+            cache.resize(plotfile,THUMBNAIL_WIDTH,os.path.join(thumbfolder,os.path.basename(plotfile)))
+        except Exception,msg:
+            print 'Could not make thumbnail of %s: %s' % (plotfile,str(msg))
 
 def createHTMLFragments(eventdicts,comment,pdlfolder):
+    fragment = getTemplate(HTMLFRAGMENT)
     if len(comment.strip()):
-        fragment = HTMLFRAGMENT.replace('[COMMENT]',comment)
         fragfile = os.path.join(pdlfolder,'comment.inc.html')
         f = open(fragfile,'wt')
-        f.write(fragment)
+        f.write(fragment.render({'COMMENT':comment}))
         f.close()
     seq = 1
     for eventdict in eventdicts:
         if len(eventdicts) == 1:
-            fragment = HTMLFRAGMENT.replace('[COMMENT]',eventdict['result'])
             fragfile = os.path.join(pdlfolder,'result%i.inc.html' % seq)
             f = open(fragfile,'wt')
-            f.write(fragment)
+            f.write(fragment.render({'COMMENT':eventdict['result']}))
             f.close()
 
-        fragment = HTMLFRAGMENT.replace('[COMMENT]',eventdict['process'])
         fragfile = os.path.join(pdlfolder,'process%i.inc.html' % seq)
         f = open(fragfile,'wt')
-        f.write(fragment)
+        f.write(fragment.render({'COMMENT':eventdict['process']}))
         f.close()
         seq += 1
         
@@ -269,17 +326,25 @@ def getCommandOutput(cmd):
     
     return (retcode,output)
 
-def generateCmdLine(eventdicts,eventid,output):
-    net = eventid[0:2]
-    eventcode = eventid[2:]
+def getProductProperties(eventdicts):
+    """
+    Get the PDL product properties for a list of event dictionaries (one per plane).
+    @return: List of (name,value) tuples, where name is the property name without the --property- prefix.
+    """
     props = []
     ec = 1
     for eventdict in eventdicts:
         for key,value in eventdict.iteritems():
             if key in ['process','result']:
                 continue
-            props.append('--property-%s%i=%s' % (key,ec,str(value)))
+            props.append(('%s%i' % (key,ec),str(value)))
         ec += 1
+    return props
+
+def generateCmdLine(eventdicts,eventid,output):
+    net = eventid[0:2]
+    eventcode = eventid[2:]
+    props = ['--property-%s=%s' % (key,value) for key,value in getProductProperties(eventdicts)]
     propstr = ' '.join(props)
     if getpass.getuser() == 'mhearne':
         PDLPATH = DEVPDLPATH
@@ -297,6 +362,24 @@ def generateCmdLine(eventdicts,eventid,output):
     cmd = cmd.replace('[PROPERTIES]',propstr)
     return cmd
 
+def makeProduct(eventdicts,eventid,output):
+    """
+    Describe a finite fault product for a PDLSender.
+    @return: Dictionary with the PDL product fields, the product properties, and the equivalent
+    ProductClient command line ('cmd').
+    """
+    net = eventid[0:2]
+    eventcode = eventid[2:]
+    product = {'source':'us',
+               'type':'finite-fault',
+               'code':net+eventcode,
+               'eventsource':net,
+               'eventsourcecode':eventcode,
+               'directory':output,
+               'properties':dict(getProductProperties(eventdicts)),
+               'cmd':generateCmdLine(eventdicts,eventid,output)}
+    return product
+
 def createContentsXML(eventid,outdir,bodywaves1,bodywaves2,surfacewaves1,surfacewaves2):
     eventcode = eventid[2:]
     contents = Tag('contents')
@@ -381,6 +464,22 @@ def createContentsXML(eventid,outdir,bodywaves1,bodywaves2,surfacewaves1,surface
                                                   'type':'text/plain'}))
         contents.addChild(cmt2tag)
 
+    #Binary CMT Solution (only made when numpy is installed)
+    cmtbincaption = "<![CDATA[ CMT solutions as little-endian binary columns, one value per point (see ffmfiles.py in ffloader for the layout) ]]>"
+    cmtplanes = [(plane1id,plane1mod)]
+    if isTwoPlane:
+        cmtplanes.append(('2','(Plane 2)'))
+    for planeid,planemod in cmtplanes:
+        cmtbinfile = 'web%s/%s' % (planeid,CMT_BINARY_FILE)
+        if not os.path.isfile(os.path.join(outdir,cmtbinfile)):
+            continue
+        cmtbintag = Tag('file',attributes={'title':'CMT Solution Binary %s' % planemod,
+                                           'id':'cmtbinary%s' % (planeid or '1')})
+        cmtbintag.addChild(Tag('caption',data=cmtbincaption))
+        cmtbintag.addChild(Tag('format',attributes={'href':cmtbinfile,
+                                                    'type':'application/octet-stream'}))
+        contents.addChild(cmtbintag)
+
     #Inversion Parameters File 1
     inv1caption = "<![CDATA[ Basic inversion parameters for each node in the finite fault ]]>"
     inv1tag1 = Tag('file',attributes={'title':'Inversion Parameters File 1 %s' % plane1mod,
@@ -461,6 +560,31 @@ def createContentsXML(eventid,outdir,bodywaves1,bodywaves2,surfacewaves1,surface
                                                   'type':'text/plain'}))
         contents.addChild(deftag2)
 
+    #Compact Surface Deformation Files (only made when numpy is installed)
+    gridcaption = "<![CDATA[ Decimated surface displacement grid, as little-endian binary (see ffmfiles.py in ffloader for the layout) ]]>"
+    summarycaption = "<![CDATA[ GeoJSON summary of surface displacement: extent and locations of largest uplift, subsidence and horizontal motion ]]>"
+    planes = [(plane1id,plane1mod)]
+    if isTwoPlane:
+        planes.append(('2','(Plane 2)'))
+    for planeid,planemod in planes:
+        seq = planeid or '1'
+        gridfile = 'web%s/%s%s' % (planeid,eventcode,DISP_GRID_SUFFIX)
+        if os.path.isfile(os.path.join(outdir,gridfile)):
+            gridtag = Tag('file',attributes={'title':'Surface Deformation Grid %s' % planemod,
+                                             'id':'surfacegrid%s' % seq})
+            gridtag.addChild(Tag('caption',data=gridcaption))
+            gridtag.addChild(Tag('format',attributes={'href':gridfile,
+                                                      'type':'application/octet-stream'}))
+            contents.addChild(gridtag)
+        summaryfile = 'web%s/%s%s' % (planeid,eventcode,DISP_SUMMARY_SUFFIX)
+        if os.path.isfile(os.path.join(outdir,summaryfile)):
+            summarytag = Tag('file',attributes={'title':'Surface Deformation Summary %s' % planemod,
+                                                'id':'surfacesummary%s' % seq})
+            summarytag.addChild(Tag('caption',data=summarycaption))
+            summarytag.addChild(Tag('format',attributes={'href':summaryfile,
+                                                         'type':'application/json'}))
+            contents.addChild(summarytag)
+
     cfile = os.path.join(outdir,'contents.xml')
     contents.renderToXML(cfile)
     
@@ -523,108 +647,106 @@ def getWavePlots(ffmdir):
     surfacefiles = glob.glob(os.path.join(ffmdir,FILE_PATTERNS['surfacewave']))
     return (bodyfiles,surfacefiles)
 
-def fillHTML(eventdict,htmldata,comment,eventcode,bodyfiles,surfacefiles,version,caption,onePlane=True,planeNumber=1):
-    location = getLocation(eventcode,eventdict['lat'],eventdict['lon'])
-    htmldata = htmldata.replace('[DATE]',eventdict['time'].strftime('%b %d, %Y'))
-    htmldata = htmldata.replace('[MAG]','%.1f' % eventdict['magnitude'])
-    htmldata = htmldata.replace('[LOCATION]','%s' % location)
-    htmldata = htmldata.replace('[PROCESS]','%s' % eventdict['process'])
-    htmldata = htmldata.replace('[RESULT]','%s' % eventdict['result'])
-    htmldata = htmldata.replace('[EVENT]','%s' % eventcode)
-    htmldata = htmldata.replace('[COMMENT]','%s' % comment)
-    htmldata = htmldata.replace('[BASEMAP_CAPTION]','%s' % caption)
+def getSequence(wavefile):
+    #wave plot files are named like EVENT_bwave_3.png - return the '3'
+    fpath,fname = os.path.split(wavefile)
+    fbase,fext = os.path.splitext(fname)
+    parts = fbase.split('_')
+    return parts[-1]
+
+def getHTMLContext(eventdict,comment,eventcode,bodyfiles,surfacefiles,version,caption,onePlane=True,planeNumber=1,location=None):
+    """
+    Get the macro values used to fill in an HTML template for one plane.
+    @return: Dictionary of macro name (without brackets) to value.
+    """
+    if location is None:
+        location = getLocation(eventcode,eventdict['lat'],eventdict['lon'])
+    context = {'DATE':eventdict['time'].strftime('%b %d, %Y'),
+               'MAG':'%.1f' % eventdict['magnitude'],
+               'LOCATION':location,
+               'PROCESS':eventdict['process'],
+               'RESULT':eventdict['result'],
+               'EVENT':eventcode,
+               'COMMENT':comment,
+               'BASEMAP_CAPTION':caption,
+               'VERSION':str(version)}
     if version == 1:
-        htmldata = htmldata.replace('[STATUS]','Preliminary')
+        context['STATUS'] = 'Preliminary'
     else:
-        htmldata = htmldata.replace('[STATUS]','Updated')
-    htmldata = htmldata.replace('[VERSION]',str(version))
+        context['STATUS'] = 'Updated'
+    bodycontexts = [{'V':getSequence(bodyfile),'EVENT':eventcode} for bodyfile in bodyfiles]
+    surfacecontexts = [{'V':getSequence(surfacefile),'EVENT':eventcode} for surfacefile in surfacefiles]
     if not onePlane:
-      magnitude = (math.log10(eventdict['moment'])-16.1)/1.5
-      htmldata = htmldata.replace('[MOMENT%i]' % planeNumber,'%.3g' % eventdict['moment'])
-      htmldata = htmldata.replace('[MWMAG%i]' % planeNumber,'%.1f' % magnitude)
-      htmldata = htmldata.replace('[STRIKE%i]' % planeNumber,'%.1f' % eventdict['strike1'])
-      htmldata = htmldata.replace('[DIP%i]' % planeNumber,'%.1f' % eventdict['dip1'])
-      htmldata = htmldata.replace('[RAKE%i]' % planeNumber,'%.1f' % eventdict['rake1'])
-      bodytext = ''
-      for bodyfile in bodyfiles:
-          fpath,fname = os.path.split(bodyfile)
-          fbase,fext = os.path.splitext(fname)
-          parts = fbase.split('_')
-          sequence = parts[-1]
-          if planeNumber == 1:
-              block = BODYBLOCK1
-          else:
-              block = BODYBLOCK2
-          bodyblock = block.replace('[V]',sequence)
-          bodyblock = bodyblock.replace('[EVENT]',eventcode)
-          bodytext += bodyblock
-      htmldata = htmldata.replace('[BODYBLOCK%i]' % planeNumber,bodytext)
-      surfacetext = ''
-      for surfacefile in surfacefiles:
-          fpath,fname = os.path.split(surfacefile)
-          fbase,fext = os.path.splitext(fname)
-          parts = fbase.split('_')
-          sequence = parts[-1]
-          if planeNumber == 1:
-              block = SURFACEBLOCK1
-          else:
-              block = SURFACEBLOCK2
-          surfaceblock = block.replace('[V]',sequence)
-          surfaceblock = surfaceblock.replace('[EVENT]',eventcode)
-          surfacetext += surfaceblock
-      htmldata = htmldata.replace('[SURFACEBLOCK%i]' % planeNumber,surfacetext)
+        magnitude = (math.log10(eventdict['moment'])-16.1)/1.5
+        context['MOMENT%i' % planeNumber] = '%.3g' % eventdict['moment']
+        context['MWMAG%i' % planeNumber] = '%.1f' % magnitude
+        context['STRIKE%i' % planeNumber] = '%.1f' % eventdict['strike1']
+        context['DIP%i' % planeNumber] = '%.1f' % eventdict['dip1']
+        context['RAKE%i' % planeNumber] = '%.1f' % eventdict['rake1']
+        context['SLIP%i' % planeNumber] = getSlipText(eventdict,PLANE_SLIP_TEMPLATE,PLANE_AREA_TEMPLATE,PLANE_DURATION_TEMPLATE)
+        if planeNumber == 1:
+            bodyblock = BODYBLOCK1
+            surfaceblock = SURFACEBLOCK1
+        else:
+            bodyblock = BODYBLOCK2
+            surfaceblock = SURFACEBLOCK2
+        context['BODYBLOCK%i' % planeNumber] = getTemplate(bodyblock).renderEach(bodycontexts)
+        context['SURFACEBLOCK%i' % planeNumber] = getTemplate(surfaceblock).renderEach(surfacecontexts)
     else:
-        bodytext = ''
-        for bodyfile in bodyfiles:
-            fpath,fname = os.path.split(bodyfile)
-            fbase,fext = os.path.splitext(fname)
-            parts = fbase.split('_')
-            sequence = parts[-1]
-            bodyblock = BODYBLOCK.replace('[V]',sequence)
-            bodyblock = bodyblock.replace('[EVENT]',eventcode)
-            bodytext += bodyblock
-        htmldata = htmldata.replace('[BODYBLOCK]',bodytext)
-        surfacetext = ''
-        for surfacefile in surfacefiles:
-            fpath,fname = os.path.split(surfacefile)
-            fbase,fext = os.path.splitext(fname)
-            parts = fbase.split('_')
-            sequence = parts[-1]
-            surfaceblock = SURFACEBLOCK.replace('[V]',sequence)
-            surfaceblock = surfaceblock.replace('[EVENT]',eventcode)
-            surfacetext += surfaceblock
-        htmldata = htmldata.replace('[SURFACEBLOCK]',surfacetext)
-        
-        
-    return htmldata
+        context['BODYBLOCK'] = getTemplate(BODYBLOCK).renderEach(bodycontexts)
+        context['SURFACEBLOCK'] = getTemplate(SURFACEBLOCK).renderEach(surfacecontexts)
+    return context
 
-def getLocation(eventcode,lat,lon):
-    URL_TEMPLATE = 'https://earthquake.usgs.gov/earthquakes/feed/v1.0/detail/[EVENTID].geojson'
-    url = URL_TEMPLATE.replace('[EVENTID]','us'+eventcode)
-    try:
-        fh = urllib2.urlopen(url)
-        data = fh.read()
-        fh.close()
-        jdict = json.loads(data)
-        locstr = jdict['properties']['place']
-    except:
-        locstr = '%.4f,%.4f' % (lat,lon)
+def fillHTML(eventdict,htmldata,comment,eventcode,bodyfiles,surfacefiles,version,caption,onePlane=True,planeNumber=1,location=None):
+    context = getHTMLContext(eventdict,comment,eventcode,bodyfiles,surfacefiles,version,caption,
+                             onePlane=onePlane,planeNumber=planeNumber,location=location)
+    return render(htmldata,context)
+
+def getCacheFolder(name):
+    return os.path.join(BASE_PDL_FOLDER,CACHE_FOLDER,name)
+
+def startLocationLookup(eventcode,offline=False):
+    """
+    Start looking up the place description for an event in the background, trying the
+    location cache and then the USGS detail feed (unless offline is True).
+    @return: LocationLookup object - call get(lat,lon) on it when the location is needed.
+    """
+    cache = LocationCache(getCacheFolder('locations'))
+    return LocationLookup('us'+eventcode,cache=cache,timeout=LOCATION_TIMEOUT,offline=offline)
 
-    return locstr
+def getLocation(eventcode,lat,lon,offline=False):
+    """
+    Get a place description for an event, trying (in order) the location cache, the USGS
+    detail feed (unless offline is True), and the bundled offline place index.
+    """
+    return startLocationLookup(eventcode,offline).get(lat,lon)
 
 def countWaves(wavefile):
-    lines = open(wavefile,'rt').readlines()
-    nt = int(lines[4].strip())
+    """
+    Count the P and SH wave records in Readlp.das (see ffmfiles.readStations() for the layout).
+    @return: Dictionary with nump and nums, and if numpy could read the table, azgap (largest azimuthal gap, degrees).
+    """
+    if readStations is not None:
+        try:
+            return getStationStats(readStations(wavefile))
+        except Exception,msg:
+            print 'Could not read station table from %s, counting it line by line: %s' % (wavefile,str(msg))
+    f = open(wavefile,'rt')
+    for i in range(0,4):
+        f.readline()
+    nt = int(f.readline().strip())
     ns = 0
     np = 0
-    #read the int value of the 8th column of each line.  if greater than 2, increment ns, otherwise increment np
-    for i in range(5,nt):
-        parts = lines[i].split()
+    #read the int value of the 9th column of each station line.  if greater than 2, increment ns, otherwise increment np
+    #(lines 6 to nt only, as always - see ffmfiles.DAS_UNCOUNTED_ROWS)
+    for i in range(0,nt-5):
+        parts = f.readline().split()
         if float(parts[8]) > 2:
             ns += 1
         else:
             np += 1
-    return (np,ns)
+    f.close()
+    return {'nump':np,'nums':ns}
 
 def readMulti(eventfile):
     """
@@ -684,7 +806,27 @@ def readMulti(eventfile):
             eventdict[keyrake] = rake
     return eventdict
     
+def getEventInputFiles(inputfolder):
+    #the files in a finite fault directory that readEventInfo() reads
+    inputfiles = [os.path.join(inputfolder,fname) for fname in ['Event_mult.in','plot_info','Readlp.das','synm.str_low']]
+    inputfiles += glob.glob(os.path.join(inputfolder,FILE_PATTERNS['fsp']))
+    return inputfiles + glob.glob(os.path.join(inputfolder,FILE_PATTERNS['moment_text']))
+
 def getEventInfo(inputfolder):
+    """
+    Get the event information for a finite fault directory, from the cache in .cache/eventinfo
+    if none of the input files have changed (by size and mtime) since they were last read.
+    @return: Event dictionary (see readEventInfo()).
+    """
+    cache = EventInfoCache(getCacheFolder('eventinfo'))
+    key = getInputKey(getEventInputFiles(inputfolder),salt='numpy=%s' % (readFSP is not None))
+    eventinfo = cache.get(inputfolder,key)
+    if eventinfo is None:
+        eventinfo = EventInfo.fromDict(readEventInfo(inputfolder))
+        cache.put(inputfolder,key,eventinfo)
+    return eventinfo.asDict()
+
+def readEventInfo(inputfolder):
     eventdict = {}
     eventfile = os.path.join(inputfolder,'Event_mult.in')
     plotfile = os.path.join(inputfolder,'plot_info')
@@ -699,70 +841,587 @@ def getEventInfo(inputfolder):
     eventdict['moment'] = float(mparts[3])
     #moment magnitude is in the last line of this file
     eventdict['magnitude'] = float(lines[-1].strip())
-    np,ns = countWaves(wavefile)
+    eventdict.update(countWaves(wavefile))
+    np = eventdict['nump']
+    ns = eventdict['nums']
     if os.path.isfile(lowfile):
         nlow = int(open(lowfile,'rt').readline().strip())
     else:
         nlow = 0
-    eventdict['nump'] = np
-    eventdict['nums'] = ns
     eventdict['npsh'] = int((np+ns)/30.0+0.9999)
     eventdict['numlow'] = nlow
     eventdict['nplow'] = int(nlow/20+0.9999)
+    eventdict.update(getSlipInfo(inputfolder))
+    eventdict.update(getMomentRateInfo(inputfolder,eventdict['moment']))
     return eventdict
 
-def copyFiles(inputfolder,outputfolder):
+def getSlipInfo(inputfolder):
+    """
+    Get summary statistics of the subfault table in the .fsp file in inputfolder.
+    @return: Dictionary from ffmfiles.getSlipStats() (peakslip, centroidlat, etc.), or an
+    empty dictionary if there is no .fsp file, it can't be read, or numpy isn't installed.
+    """
+    fspfiles = glob.glob(os.path.join(inputfolder,FILE_PATTERNS['fsp']))
+    if readFSP is None or not len(fspfiles):
+        return {}
+    try:
+        return getSlipStats(readFSP(fspfiles[0]))
+    except Exception,msg:
+        print 'Could not read subfaults from %s: %s' % (fspfiles[0],str(msg))
+        return {}
+
+def getMomentRateInfo(inputfolder,moment):
+    """
+    Get summary statistics of the source time function in the .mr file in inputfolder, and
+    warn if its total moment doesn't agree with the one in plot_info.
+    @param moment: Moment from plot_info (dyne.cm).
+    @return: Dictionary from ffmfiles.getMomentRateStats() (stfmoment, stfduration, etc.), or an
+    empty dictionary if there is no .mr file, it can't be read, or numpy isn't installed.
+    """
+    mrfiles = glob.glob(os.path.join(inputfolder,FILE_PATTERNS['moment_text']))
+    if readMomentRate is None or not len(mrfiles):
+        return {}
+    try:
+        stats = getMomentRateStats(readMomentRate(mrfiles[0]))
+    except Exception,msg:
+        print 'Could not read moment rate from %s: %s' % (mrfiles[0],str(msg))
+        return {}
+    if 'stfmoment' in stats and moment > 0:
+        if abs(stats['stfmoment']/moment - 1.0) > MR_MOMENT_TOLERANCE:
+            print 'Warning: moment from %s (%.3g) does not match plot_info (%.3g)' % (mrfiles[0],stats['stfmoment'],moment)
+    return stats
+
+def getStagedFiles(inputfolder):
+    #all of the files in inputfolder matching FILE_PATTERNS, without duplicates
+    stagefiles = []
     for key,pattern in FILE_PATTERNS.iteritems():
         pat = os.path.join(inputfolder,pattern)
-        copyfiles = glob.glob(pat)
-        for cfile in copyfiles:
-            shutil.copy(cfile,outputfolder)
+        for cfile in glob.glob(pat):
+            if cfile not in stagefiles:
+                stagefiles.append(cfile)
+    return stagefiles
+
+def getBlobStore():
+    #staged files are links into one content-addressed store shared by every event
+    return BlobStore(getCacheFolder('blobs'))
+
+def getManifestFile(outputfolder):
+    #staging manifests live in the cache folder, named after the event and web folder ('usb0006bqc_web1.json')
+    outputfolder = os.path.abspath(outputfolder)
+    pdlfolder,web = os.path.split(outputfolder)
+    eventid = os.path.basename(pdlfolder)
+    return os.path.join(getCacheFolder('manifests'),'%s_%s.json' % (eventid,web))
+
+def copyFiles(inputfolder,outputfolder,manifestfile=None):
+    """
+    Copy the files matching FILE_PATTERNS from inputfolder to outputfolder.  If manifestfile is
+    given, only new or changed files are copied (by way of the blob store), and files staged by
+    an earlier run that are no longer in inputfolder are removed.  Files are hard linked or cloned rather than copied
+    where the filesystem allows (see staging.copyFile()).
+    @return: Dictionary with lists of file names that were 'copied', 'unchanged' and 'removed',
+    and 'methods', a dictionary of file name -> method used to copy it.
+    """
+    stagefiles = getStagedFiles(inputfolder)
+    if manifestfile is not None:
+        return stageFiles(stagefiles,outputfolder,manifestfile,blobstore=getBlobStore())
+    methods = stageAll(stagefiles,outputfolder)
+    return {'copied':[os.path.basename(cfile) for cfile in stagefiles],'unchanged':[],'removed':[],'methods':methods}
 
 def makeTextBlocks(eventdicts):
-    textdicts = {}
-    eventcounter = 0
     for eventdict in eventdicts:
         if eventdict['numlow']:
             process = PROCESS_TEMPLATE_LONG
         else:
             process = PROCESS_TEMPLATE_NOLONG
-        process = process.replace('[XX]','%i' % eventdict['nump'])
-        process = process.replace('[YY]','%i' % eventdict['nums'])
+        context = {'XX':'%i' % eventdict['nump'],
+                   'YY':'%i' % eventdict['nums'],
+                   'AA':'%.1f' % eventdict['lon'],
+                   'BB':'%.1f' % eventdict['lat'],
+                   'CC':'%.1f' % eventdict['depth']}
         if eventdict['numlow']:
-            process = process.replace('[ZZ]','%i' % eventdict['numlow'])
-        process = process.replace('[AA]','%.1f' % eventdict['lon'])
-        process = process.replace('[BB]','%.1f' % eventdict['lat'])
-        process = process.replace('[CC]','%.1f' % eventdict['depth'])
-        eventdict['process'] = process
+            context['ZZ'] = '%i' % eventdict['numlow']
+        eventdict['process'] = render(process,context)
 
         #fill in the paragraph describing the result for a single plane solution
+        context = {'DD':'%.1f' % eventdict['strike1'],
+                   'EE':'%.1f' % eventdict['dip1'],
+                   'FF':'%.1e' % eventdict['moment'],
+                   'GG':'%.1f' % eventdict['magnitude'],
+                   'HH':'%i' % eventdict['numsegments']}
         if eventdict['numsegments'] == 1:
             result = RESULT_TEMPLATE
         else:
             result = RESULT_TEMPLATE_SEGMENTS
             segment_template = '<tr><td>[NUM]</td><td>[DD]</td><td>[EE]</td></tr>\n'
-            segmentstr = ''
+            segments = []
             for i in range(0,eventdict['numsegments']):
-                segtemp = segment_template
                 segnum = i+1
-                ddkey = 'strike%i' % (segnum)
-                eekey = 'dip%i' % (segnum)
-                segtemp = segtemp.replace('[NUM]','%i' % segnum)
-                segtemp = segtemp.replace('[DD]','%.1f' % eventdict[ddkey])
-                segtemp = segtemp.replace('[EE]','%.1f' % eventdict[eekey])
-                segmentstr += segtemp
-            result = result.replace('[SEGMENTS]',segmentstr)
-        result = result.replace('[DD]','%.1f' % eventdict['strike1'])
-        result = result.replace('[EE]','%.1f' % eventdict['dip1'])
-        result = result.replace('[FF]','%.1e' % eventdict['moment'])
-        result = result.replace('[GG]','%.1f' % eventdict['magnitude'])
-        result = result.replace('[HH]','%i' % eventdict['numsegments'])
-        eventdict['result'] = result
+                segments.append({'NUM':'%i' % segnum,
+                                 'DD':'%.1f' % eventdict['strike%i' % segnum],
+                                 'EE':'%.1f' % eventdict['dip%i' % segnum]})
+            context['SEGMENTS'] = getTemplate(segment_template).renderEach(segments)
+        eventdict['result'] = render(result,context) + getSlipText(eventdict,SLIP_TEMPLATE,AREA_TEMPLATE,DURATION_TEMPLATE)
 
     return eventdicts
 
+def getSlipText(eventdict,sliptemplate,areatemplate,durationtemplate):
+    #describe the subfault statistics from getSlipInfo(), if there are any
+    if 'peakslip' not in eventdict:
+        return ''
+    context = {'PS':'%.1f' % eventdict['peakslip'],
+               'CLAT':'%.2f' % eventdict['centroidlat'],
+               'CLON':'%.2f' % eventdict['centroidlon'],
+               'CDEP':'%.1f' % eventdict['centroiddepth']}
+    text = sliptemplate
+    if 'rupturearea' in eventdict:
+        context['AREA'] = '%i' % round(eventdict['rupturearea'])
+        text = text + areatemplate
+    if 'ruptureduration' in eventdict:
+        context['DUR'] = '%i' % round(eventdict['ruptureduration'])
+        text = text + durationtemplate
+    return render(text,context)
+
+def getCaption(ffmdirs):
+    #if there is a basemap_caption.txt file present in any of the folders, read in that text
+    #so it can be inserted into the HTML in [BASEMAP_CAPTION] macro
+    for ffmdir in ffmdirs:
+        captionfile = os.path.join(ffmdir,'basemap_caption.txt')
+        if os.path.isfile(captionfile):
+            return open(captionfile,'rt').read()
+    return DEFAULT_CAPTION
+
+def processPlane(ffmdir,webfolder,mapname=OUTPUT_BASEMAP,thumbnails=False):
+    """
+    Do the work for one fault plane that doesn't depend on any other plane: copy the files,
+    read the event information, fill in the text blocks, find the wave plots and make the web map.
+    @param ffmdir: Finite fault directory for the plane.
+    @param webfolder: Web folder in the PDL output folder to copy the files into.
+    @param mapname: Name of the web basemap to make from this plane's basemap, or None to make none.
+    @param thumbnails: If True, also make thumbnails of the wave plots.
+    @return: Three-element tuple containing the event dictionary, list of body wave plots and
+    list of surface wave plots.
+    """
+    if not os.path.isdir(webfolder):
+        os.makedirs(webfolder)
+    with span('copy'):
+        copyFiles(ffmdir,webfolder,getManifestFile(webfolder))
+    with span('convert'):
+        makeDeformationFiles(ffmdir,webfolder)
+        makeCMTFile(ffmdir,webfolder)
+    with span('parse'):
+        eventdict = getEventInfo(ffmdir)
+        eventdict = makeTextBlocks([eventdict])[0]
+    bodyfiles,surfacefiles = getWavePlots(ffmdir)
+    with span('resize'):
+        if mapname is not None:
+            makeWebMap(webfolder,mapname)
+        if thumbnails:
+            makeThumbnails(webfolder,bodyfiles+surfacefiles)
+    return (eventdict,bodyfiles,surfacefiles)
+
+def makeDeformationFiles(ffmdir,webfolder):
+    """
+    Make a decimated binary grid and a GeoJSON summary of each .disp file in ffmdir, in webfolder,
+    unless they are already newer than the .disp file.  Needs numpy.
+    """
+    if writeDispProducts is None:
+        return
+    for dispfile in glob.glob(os.path.join(ffmdir,FILE_PATTERNS['deformation'])):
+        base = os.path.splitext(os.path.basename(dispfile))[0]
+        binfile = os.path.join(webfolder,base+DISP_GRID_SUFFIX)
+        geojsonfile = os.path.join(webfolder,base+DISP_SUMMARY_SUFFIX)
+        mtime = os.path.getmtime(dispfile)
+        if os.path.isfile(binfile) and os.path.isfile(geojsonfile):
+            if os.path.getmtime(binfile) >= mtime and os.path.getmtime(geojsonfile) >= mtime:
+                continue
+        try:
+            writeDispProducts(dispfile,binfile,geojsonfile)
+        except Exception,msg:
+            print 'Could not make deformation grid from %s: %s' % (dispfile,str(msg))
+
+def makeCMTFile(ffmdir,webfolder):
+    """
+    Make a columnar binary copy of the CMTSOLUTION file in ffmdir, in webfolder, unless it is
+    already newer than the CMTSOLUTION file.  Needs numpy.
+    """
+    cmtfile = os.path.join(ffmdir,FILE_PATTERNS['cmt'])
+    if writeCMTBinary is None or not os.path.isfile(cmtfile):
+        return
+    binfile = os.path.join(webfolder,CMT_BINARY_FILE)
+    if os.path.isfile(binfile) and os.path.getmtime(binfile) >= os.path.getmtime(cmtfile):
+        return
+    tmpfile = binfile + '.%i.tmp' % os.getpid()
+    try:
+        writeCMTBinary(cmtfile,tmpfile)
+        os.rename(tmpfile,binfile)
+    except Exception,msg:
+        print 'Could not make binary CMT file from %s: %s' % (cmtfile,str(msg))
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+
+def _processPlaneJob(args):
+    #Pool.map() hands over one argument.  The spans are timed separately, as a worker process
+    #can't record them in the caller's Timer
+    timer = setTimer(Timer())
+    try:
+        result = processPlane(*args)
+    finally:
+        setTimer(None)
+    return (result,timer.start,timer.spans)
+
+def mapWorkers(function,jobs,nworkers=None):
+    """
+    Run a module level function over a list of jobs in a pool of worker processes.
+    @param nworkers: Number of workers (defaults to one per job, up to the number of CPUs).
+    @return: List of results, in the same order as jobs.
+    """
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    nworkers = min(nworkers,len(jobs))
+    if nworkers < 2:
+        return [function(job) for job in jobs]
+    if multiprocessing.current_process().daemon:
+        #batch workers aren't allowed to have child processes
+        pool = ThreadPool(nworkers)
+    else:
+        pool = multiprocessing.Pool(nworkers)
+    try:
+        results = pool.map(function,jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def processPlanes(jobs):
+    """
+    Run processPlane() for several planes at once, each in its own worker.
+    @param jobs: List of (ffmdir,webfolder,mapname,thumbnails) tuples.
+    @return: List of processPlane() results, in the same order as jobs.
+    """
+    results = []
+    for plane,(result,start,spans) in enumerate(mapWorkers(_processPlaneJob,jobs,len(jobs))):
+        getTimer().addSpans(spans,start,plane=plane+1)
+        results.append(result)
+    return results
+
+def _optimizeJob(job):
+    pngfile,cachefolder = job
+    return optimizePNG(pngfile,cachefolder)
+
+def optimizeImages(pdlfolder):
+    """
+    Losslessly recompress every PNG file in a PDL output folder, spread across worker processes.
+    @return: Three-element tuple containing the number of PNG files, and their total size
+    before and after.
+    """
+    cachefolder = getCacheFolder('png')
+    jobs = []
+    for root,dirs,files in os.walk(pdlfolder):
+        for fname in sorted(files):
+            if fname.lower().endswith('.png'):
+                jobs.append((os.path.join(root,fname),cachefolder))
+    results = mapWorkers(_optimizeJob,jobs)
+    oldsize = sum([result[0] for result in results])
+    newsize = sum([result[1] for result in results])
+    return (len(jobs),oldsize,newsize)
+
+def processEvent(eventid,ffmdirs,version=1,comment='Not available yet.',offline=False,thumbnails=False,optimize=False):
+    """
+    Build the PDL output folder (web files, HTML, fragments, contents.xml) for one event.
+    @param eventid: Network and event code ('usb0006bqc', etc.)
+    @param ffmdirs: List of one (single plane) or two (double plane) finite fault directories.
+    @param version: Integer version number of the finite fault product.
+    @param comment: 'Scientific analysis' comment to insert into the HTML.
+    @param offline: If True, don't look up the event location on the network.
+    @param thumbnails: If True, make thumbnails of the wave plots.
+    @param optimize: If True, losslessly recompress the PNG files in the output folder.
+    @return: Two-element tuple containing the PDL output folder and the list of event dictionaries (one per plane).
+    """
+    homedir = os.path.dirname(os.path.abspath(__file__)) #where is this script?
+    html1 = os.path.join(homedir,TEMPLATE1)
+    html2 = os.path.join(homedir,TEMPLATE2)
+    eventcode = eventid[2:]
+    pdlfolder = os.path.join(BASE_PDL_FOLDER,eventid)
+    for ffmdir in ffmdirs:
+        if not os.path.isdir(ffmdir):
+            raise Exception,'Finite fault directory %s does not exist.' % ffmdir
+    #the location lookup runs while the files are copied and parsed
+    lookup = startLocationLookup(eventcode,offline)
+    caption = getCaption(ffmdirs)
+    htmloutfile = os.path.join(pdlfolder,'%s.html' % eventcode)
+    if len(ffmdirs) == 1:
+        bodyfiles2 = []
+        surfacefiles2 = []
+        ffmdir = ffmdirs[0]
+        webfolder = os.path.join(pdlfolder,'web')
+        eventdict,bodyfiles1,surfacefiles1 = processPlane(ffmdir,webfolder,OUTPUT_BASEMAP,thumbnails)
+        with span('geocode'):
+            location = lookup.get(eventdict['lat'],eventdict['lon'])
+        with span('html'):
+            htmldata = open(html1,'rt').read()
+            htmldata = fillHTML(eventdict,htmldata,comment,eventcode,bodyfiles1,surfacefiles1,version,caption,location=location)
+        eventdicts = [eventdict]
+    else:
+        ffmdir1,ffmdir2 = ffmdirs
+        webfolder1 = os.path.join(pdlfolder,'web1')
+        webfolder2 = os.path.join(pdlfolder,'web2')
+        #the two planes don't depend on each other until the HTML is filled in
+        results = processPlanes([(ffmdir1,webfolder1,OUTPUT_BASEMAP,thumbnails),
+                                 (ffmdir2,webfolder2,None,thumbnails)])
+        eventdict1,bodyfiles1,surfacefiles1 = results[0]
+        eventdict2,bodyfiles2,surfacefiles2 = results[1]
+        with span('geocode'):
+            location = lookup.get(eventdict1['lat'],eventdict1['lon'])
+        with span('html'):
+            context1 = getHTMLContext(eventdict1,comment,eventcode,bodyfiles1,surfacefiles1,version,caption,onePlane=False,planeNumber=1,location=location)
+            context2 = getHTMLContext(eventdict2,comment,eventcode,bodyfiles2,surfacefiles2,version,caption,onePlane=False,planeNumber=2,location=location)
+            #where both planes fill the same macro, plane 1 wins
+            context = context2.copy()
+            context.update(context1)
+            htmldata = render(open(html2,'rt').read(),context)
+        eventdicts = [eventdict1,eventdict2]
+    with span('html'):
+        #write out the html data
+        f = open(htmloutfile,'wt')
+        f.write(htmldata)
+        f.close()
+        createHTMLFragments(eventdicts,comment,pdlfolder)
+    with span('xml'):
+        createContentsXML(eventid,pdlfolder,bodyfiles1,bodyfiles2,surfacefiles1,surfacefiles2)
+    if optimize:
+        with span('optimize'):
+            nfiles,oldsize,newsize = optimizeImages(pdlfolder)
+        if oldsize:
+            print '%s: recompressed %i PNG files from %i to %i bytes (saved %.1f%%)' % (eventid,nfiles,oldsize,newsize,
+                                                                                     100.0*(oldsize-newsize)/oldsize)
+    saveBuildRecord(eventid,ffmdirs,eventdicts)
+    return (pdlfolder,eventdicts)
+
+def getBuildRecordFile(eventid):
+    return os.path.join(getCacheFolder('builds'),'%s.json' % eventid)
+
+def saveBuildRecord(eventid,ffmdirs,eventdicts):
+    #remember what the PDL output folder was built from, so it can be sent later without rebuilding it
+    record = {'eventid':eventid,
+              'ffmdirs':[os.path.abspath(ffmdir) for ffmdir in ffmdirs],
+              'eventinfo':[EventInfo.fromDict(eventdict).toJSON() for eventdict in eventdicts]}
+    recordfile = getBuildRecordFile(eventid)
+    folder = os.path.dirname(recordfile)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass #another process made it first
+    tmpfile = recordfile + '.%i.tmp' % os.getpid()
+    f = open(tmpfile,'wt')
+    json.dump(record,f,indent=1,sort_keys=True)
+    f.close()
+    os.rename(tmpfile,recordfile)
+
+def loadStagedEvent(eventid,ffmdirs):
+    """
+    Get a PDL output folder built by an earlier run (usually with -r) ready to send, without
+    rebuilding it.  The folder must have been built from the same finite fault directories, all
+    of its staged files must still be there, and none of the source files may have changed.
+    @param eventid: Network and event code ('usb0006bqc', etc.)
+    @param ffmdirs: List of one (single plane) or two (double plane) finite fault directories.
+    @return: Two-element tuple containing the PDL output folder and the list of event dictionaries (one per plane).
+    @raise Exception: When the folder can't be sent as it is, listing the reasons.
+    """
+    eventcode = eventid[2:]
+    pdlfolder = os.path.join(BASE_PDL_FOLDER,eventid)
+    recordfile = getBuildRecordFile(eventid)
+    try:
+        record = json.load(open(recordfile,'rt'))
+    except (IOError,ValueError):
+        raise Exception,'No record of %s having been built (%s).' % (pdlfolder,recordfile)
+    ffmdirs = [os.path.abspath(ffmdir) for ffmdir in ffmdirs]
+    if record['ffmdirs'] != ffmdirs:
+        raise Exception,'%s was built from %s, not %s.' % (pdlfolder,', '.join(record['ffmdirs']),', '.join(ffmdirs))
+    if len(ffmdirs) == 1:
+        webfolders = [os.path.join(pdlfolder,'web')]
+    else:
+        webfolders = [os.path.join(pdlfolder,'web1'),os.path.join(pdlfolder,'web2')]
+    problems = []
+    for outfile in [os.path.join(pdlfolder,'%s.html' % eventcode),os.path.join(pdlfolder,'contents.xml')]:
+        if not os.path.isfile(outfile):
+            problems.append('%s is missing' % outfile)
+    for ffmdir,webfolder in zip(ffmdirs,webfolders):
+        problems += checkStaged(getStagedFiles(ffmdir),webfolder,getManifestFile(webfolder))
+        if not os.path.isdir(ffmdir):
+            continue
+        key = getInputKey(getEventInputFiles(ffmdir),salt='numpy=%s' % (readFSP is not None))
+        if EventInfoCache(getCacheFolder('eventinfo')).get(ffmdir,key) is None:
+            problems.append('Event information in %s has changed since %s was built' % (ffmdir,pdlfolder))
+    if len(problems):
+        raise Exception,'%s must be rebuilt:\n%s' % (pdlfolder,'\n'.join(problems))
+    eventdicts = [EventInfo.fromJSON(data).asDict() for data in record['eventinfo']]
+    return (pdlfolder,eventdicts)
+
+def sendProduct(eventdicts,eventid,pdlfolder,sender=None):
+    """
+    Send a finished PDL output folder to PDL.
+    @param sender: Started PDLSender to send through, or None to run ProductClient directly.
+    @return: Three-element tuple containing the command line, a boolean indicating success or failure,
+    and the output from the sender.
+    """
+    product = makeProduct(eventdicts,eventid,pdlfolder)
+    if sender is None:
+        retcode,output = getCommandOutput(product['cmd'])
+    else:
+        retcode,output = sender.send(product)
+    return (product['cmd'],retcode,output)
+
+def getReportFile(eventid,suffix):
+    #timing and profile reports go next to the PDL output folder, not in it, so they aren't sent
+    return os.path.join(BASE_PDL_FOLDER,'%s%s' % (eventid,suffix))
+
+def writeTimingReport(timer,eventid,**info):
+    """
+    Write a Timer's spans to BASE_PDL_FOLDER/EVENTID_timing.json (see timing.Timer.getReport()),
+    and print the total time spent in each kind of span.
+    """
+    reportfile = getReportFile(eventid,TIMING_SUFFIX)
+    timer.writeReport(reportfile,eventid=eventid,**info)
+    totals = timer.getTotals()
+    print '%s: %s (timing written to %s)' % (eventid,', '.join(['%s %.2fs' % (name,totals[name]) for name in sorted(totals)]),
+                                             reportfile)
+
+def writeProfile(profile,eventid,nfunctions=PROFILE_FUNCTIONS):
+    """
+    Save cProfile results to BASE_PDL_FOLDER/EVENTID_profile.prof (readable with pstats), and print
+    the nfunctions functions with the most cumulative time.
+    """
+    profilefile = getReportFile(eventid,PROFILE_SUFFIX)
+    profile.dump_stats(profilefile)
+    stats = pstats.Stats(profilefile)
+    stats.sort_stats('cumulative').print_stats(nfunctions)
+    print 'Profile written to %s' % profilefile
+
+def readManifest(manifestfile):
+    """
+    Read a batch manifest file.  Each row is a comma separated list of:
+    eventid,ffmdir1[,ffmdir2],version,comment
+    Blank rows and rows starting with # are ignored.  Empty version or comment fields
+    get the same defaults as the command line.  Each event may only be listed once, as
+    its rows would all be built into the same output folder.
+    @param manifestfile: Path to manifest file.
+    @return: List of dictionaries with keys eventid, ffmdirs, version, comment.
+    """
+    rows = []
+    eventlines = {} #event id -> line it was first listed on
+    f = open(manifestfile,'rb')
+    for lineno,parts in enumerate(csv.reader(f)):
+        parts = [p.strip() for p in parts]
+        if not len(parts) or not len(parts[0]) or parts[0].startswith('#'):
+            continue
+        if len(parts) not in (4,5):
+            f.close()
+            raise Exception,'Line %i of %s should have 4 or 5 fields, not %i.' % (lineno+1,manifestfile,len(parts))
+        eventid = parts[0]
+        if eventid in eventlines:
+            f.close()
+            raise Exception,'Event %s is listed on both line %i and line %i of %s.' % (eventid,eventlines[eventid],lineno+1,manifestfile)
+        eventlines[eventid] = lineno+1
+        ffmdirs = parts[1:-2]
+        if len(parts[-2]):
+            version = int(parts[-2])
+            if version < 1:
+                f.close()
+                raise Exception,'Weird version number "%s" on line %i of %s.' % (parts[-2],lineno+1,manifestfile)
+        else:
+            version = 1
+        comment = parts[-1]
+        if not len(comment):
+            comment = 'Not available yet.'
+        rows.append({'eventid':eventid,'ffmdirs':ffmdirs,'version':version,'comment':comment})
+    f.close()
+    return rows
+
+def processBatchRow(row,offline=False,thumbnails=False,optimize=False):
+    """
+    Build one manifest row, trapping any error so that one bad event does not abort the
+    rest of the batch.
+    @return: Dictionary with keys eventid, success, pdlfolder, eventdicts and message.
+    """
+    result = {'eventid':row['eventid'],'success':False,'pdlfolder':None,'eventdicts':None,'message':''}
+    timer = setTimer(Timer())
+    try:
+        with span('build'):
+            pdlfolder,eventdicts = processEvent(row['eventid'],row['ffmdirs'],row['version'],row['comment'],offline,thumbnails,optimize)
+        result['pdlfolder'] = pdlfolder
+        result['eventdicts'] = eventdicts
+        timer.writeReport(getReportFile(row['eventid'],TIMING_SUFFIX),eventid=row['eventid'],ffmdirs=row['ffmdirs'])
+        #only once everything for the row has been done
+        result['success'] = True
+        result['message'] = 'Output was written to %s' % pdlfolder
+    except Exception,msg:
+        result['message'] = traceback.format_exc()
+    finally:
+        setTimer(None)
+    return result
+
+def _processBatchJob(job):
+    #multiprocessing needs a module level function taking a single argument
+    index,row,offline,thumbnails,optimize = job
+    return (index,processBatchRow(row,offline,thumbnails,optimize))
+
+def runBatch(rows,nprocs=None,doReview=False,sender=None,offline=False,thumbnails=False,optimize=False):
+    """
+    Build many events in parallel across a pool of worker processes.  Unless doReview is True,
+    each event is queued for sending as soon as it has been built, so that sending overlaps with
+    building the rest of the batch.
+    @param rows: List of manifest rows, as returned by readManifest().
+    @param nprocs: Number of worker processes (defaults to the number of CPUs).
+    @param doReview: If True, don't send products to PDL.
+    @param sender: PDLSender to send products through.  If None, one that runs
+    ProductClient for each product is used.
+    @param offline: If True, don't look up event locations on the network.
+    @param thumbnails: If True, make thumbnails of the wave plots.
+    @param optimize: If True, losslessly recompress the PNG files in each product.
+    @return: List of result dictionaries (see processBatchRow()), in manifest order.
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = max(1,min(nprocs,len(rows)))
+    jobs = [(i,rows[i],offline,thumbnails,optimize) for i in range(0,len(rows))]
+    if not doReview:
+        if sender is None:
+            sender = PDLSender(CommandTransport())
+        sender.start()
+    def makeCallback(result):
+        def sent(product,sendresult):
+            result['success'] = sendresult['success']
+            result['message'] = 'Command "%s" returned %s with output: "%s"' % (product['cmd'],sendresult['success'],sendresult['output'])
+            print '%s: sent (%s)' % (result['eventid'],sendresult['success'])
+        return sent
+    pool = multiprocessing.Pool(nprocs)
+    results = []
+    try:
+        for index,result in pool.imap_unordered(_processBatchJob,jobs):
+            if result['success']:
+                status = 'OK'
+            else:
+                status = 'FAILED'
+            print '%s: %s' % (result['eventid'],status)
+            results.append((index,result))
+            if result['success'] and not doReview:
+                product = makeProduct(result['eventdicts'],result['eventid'],result['pdlfolder'])
+                sender.submit(product,makeCallback(result))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if not doReview:
+            sender.stop()
+    results.sort()
+    return [result for index,result in results]
+
 if __name__ == '__main__':
     usage = """usage: %prog [options] NET EVENTID FFMDIR1 [FFMDIR2]
+       %prog [options] -b MANIFEST
     Use this script to send finite fault data to PDL.
     Example: (for a single plane solution)
     %prog us b0006bqc /home/ghayes/ffmdata/b0006bqc
@@ -770,6 +1429,15 @@ if __name__ == '__main__':
     %prog us b0006bqc /home/ghayes/ffmdata/b0006bqc /home/ghayes/ffmdata/b0006bqc2
     OR (single plane solution with comment)
     %prog us b0006bqc /home/ghayes/ffmdata/b0006bqc /home/ghayes/ffmdata/b0006bqc2 -c"This earthquake is very deadly."
+    OR (many events at once, spread over 4 processes)
+    %prog -b manifest.csv -n 4
+
+    A batch manifest has one event per line, with comma separated fields:
+    eventid,ffmdir1[,ffmdir2],version,comment
+    For example:
+    usb0006bqc,/home/ghayes/ffmdata/b0006bqc,2,"This earthquake is very deadly."
+    usb0007abc,/home/ghayes/ffmdata/b0007abc,/home/ghayes/ffmdata/b0007abc2,1,
+    Lines starting with # are ignored.  Each event may only be listed once.
 
     Note: It is possible to modify the caption for the basemap by creating a file called basemap_caption.txt
     in the finite fault directory (or in the case where there are two, in either one).  This file should contain
@@ -785,6 +1453,22 @@ if __name__ == '__main__':
                       help="Add a version number to the finite fault output", metavar="COMMENT")
     parser.add_option("-r", "--review",action="store_true",
                       dest="doReview",default=False,help="don't send products to PDL")
+    parser.add_option("-b", "--batch", dest="manifest",
+                      help="process all of the events listed in MANIFEST", metavar="MANIFEST")
+    parser.add_option("-n", "--nprocs", dest="nprocs",type="int",
+                      help="number of processes to use in batch mode (default is number of CPUs)", metavar="NPROCS")
+    parser.add_option("-s", "--sender", dest="sender",
+                      help="send products through one long-lived sender process started with COMMAND (see pdlsender.py)", metavar="COMMAND")
+    parser.add_option("-o", "--offline",action="store_true",
+                      dest="offline",default=False,help="don't look up event locations on the network")
+    parser.add_option("-t", "--thumbnails",action="store_true",
+                      dest="thumbnails",default=False,help="make thumbnails of the wave plots")
+    parser.add_option("--send-only",action="store_true",
+                      dest="sendOnly",default=False,help="send the output folder built by an earlier run (with -r) without rebuilding it")
+    parser.add_option("-z", "--optimize",action="store_true",
+                      dest="optimize",default=False,help="losslessly recompress PNG files before sending")
+    parser.add_option("--profile",action="store_true",
+                      dest="profile",default=False,help="profile the run with cProfile (single events only)")
     (options, args) = parser.parse_args()
     homedir = os.path.dirname(os.path.abspath(__file__)) #where is this script?
     html1 = os.path.join(homedir,TEMPLATE1)
@@ -795,6 +1479,23 @@ if __name__ == '__main__':
         parser.print_help()
         sys.exit(1)
 
+    if options.manifest is not None:
+        try:
+            rows = readManifest(options.manifest)
+        except Exception,msg:
+            print 'Could not read batch manifest: %s' % str(msg)
+            sys.exit(1)
+        sender = PDLSender(getTransport(options.sender))
+        results = runBatch(rows,nprocs=options.nprocs,doReview=options.doReview,sender=sender,offline=options.offline,thumbnails=options.thumbnails,optimize=options.optimize)
+        nfailed = 0
+        for result in results:
+            print '%s: %s' % (result['eventid'],result['message'])
+            if not result['success']:
+                nfailed += 1
+        print '%i of %i events succeeded.' % (len(results)-nfailed,len(results))
+        getBlobStore().prune()
+        sys.exit(int(nfailed > 0))
+
     if not len(args):
         print 'Missing input arguments.'
         parser.print_help()
@@ -812,101 +1513,40 @@ if __name__ == '__main__':
                 raise Exception
         except:
             print 'Weird version number "%s". Exiting.' % options.version
+            sys.exit(1)
 
     net = args[0]
     eventcode = args[1]
     eventid = net+eventcode
-    pdlfolder = os.path.join(BASE_PDL_FOLDER,eventid)
-    
-    if len(args) == 3:
-        bodyfiles2 = []
-        surfacefiles2 = []
-        ffmdir = args[2]
-        #copy the files first
-        webfolder = os.path.join(pdlfolder,'web')
-        if not os.path.isdir(webfolder):
-            os.makedirs(webfolder)
-        copyFiles(ffmdir,webfolder)
-        eventdict = getEventInfo(ffmdir)
-        eventdict = makeTextBlocks([eventdict])[0]
-        htmloutfile = os.path.join(pdlfolder,'%s.html' % eventcode)
-        htmldata = open(html1,'rt').read()
-        bodyfiles1,surfacefiles1 = getWavePlots(ffmdir)
-
-        #if there is a basemap_caption.txt file present, read in that text and insert it
-        #into the HTML in [BASEMAP_CAPTION] macro
-        captionfile = os.path.join(ffmdir,'basemap_caption.txt')
-        if os.path.isfile(captionfile):
-            caption = open(captionfile,'rt').read()
-        else:
-            caption = DEFAULT_CAPTION
-        
-        htmldata = fillHTML(eventdict,htmldata,comment,eventcode,bodyfiles1,surfacefiles1,version,caption)
-        makeWebMap(webfolder)
-        f = open(htmloutfile,'wt')
-        f.write(htmldata)
-        f.close()
-        createHTMLFragments([eventdict],comment,pdlfolder)
+    timer = setTimer(Timer())
+    profile = None
+    if options.profile:
+        profile = cProfile.Profile()
+        profile.enable()
+    if options.sendOnly:
+        try:
+            with span('load'):
+                pdlfolder,eventdicts = loadStagedEvent(eventid,args[2:4])
+        except Exception,msg:
+            print str(msg)
+            sys.exit(1)
     else:
-        ffmdir1 = args[2]
-        ffmdir2 = args[3]
-
-        #if there is a basemap_caption.txt file present in either folder, read in that text and insert it
-        #into the HTML in [BASEMAP_CAPTION] macro
-        captionfile1 = os.path.join(ffmdir1,'basemap_caption.txt')
-        captionfile2 = os.path.join(ffmdir2,'basemap_caption.txt')
-        if os.path.isfile(captionfile1):
-            caption = open(captionfile1,'rt').read()
-        elif os.path.isfile(captionfile2):
-            caption = open(captionfile2,'rt').read()
-        else:
-            caption = DEFAULT_CAPTION
-        
-        #first plane
-        #copy the files first
-        webfolder1 = os.path.join(pdlfolder,'web1')
-        if not os.path.isdir(webfolder1):
-            os.makedirs(webfolder1)
-        copyFiles(ffmdir1,webfolder1)
-        eventdict1 = getEventInfo(ffmdir1)
-        eventdict1 = makeTextBlocks([eventdict1])[0]
-        htmloutfile = os.path.join(pdlfolder,'%s.html' % eventcode)
-        htmldata = open(html2,'rt').read()
-        bodyfiles1,surfacefiles1 = getWavePlots(ffmdir1)
-        htmldata = fillHTML(eventdict1,htmldata,comment,eventcode,bodyfiles1,surfacefiles1,version,caption,onePlane=False,planeNumber=1)
-        makeWebMap(webfolder1)
-        #second plane
-        #copy the files first
-        webfolder2 = os.path.join(pdlfolder,'web2')
-        if not os.path.isdir(webfolder2):
-            os.makedirs(webfolder2)
-        copyFiles(ffmdir2,webfolder2)
-        eventdict2 = getEventInfo(ffmdir2)
-        eventdict2 = makeTextBlocks([eventdict2])[0]
-        bodyfiles2,surfacefiles2 = getWavePlots(ffmdir2)
-        htmldata = fillHTML(eventdict2,htmldata,comment,eventcode,bodyfiles2,surfacefiles2,version,caption,onePlane=False,planeNumber=2)
-        #write out the html data
-        f = open(htmloutfile,'wt')
-        f.write(htmldata)
-        f.close()
-        createHTMLFragments([eventdict1,eventdict2],comment,pdlfolder)
-    createContentsXML(eventid,pdlfolder,bodyfiles1,bodyfiles2,surfacefiles1,surfacefiles2)
+        with span('build'):
+            pdlfolder,eventdicts = processEvent(eventid,args[2:4],version,comment,options.offline,options.thumbnails,options.optimize)
+        getBlobStore().prune()
     if not options.doReview:
-        if len(args) > 3:
-            cmd = generateCmdLine([eventdict1,eventdict2],eventid,pdlfolder)
-        else:
-            cmd = generateCmdLine([eventdict],eventid,pdlfolder)
-        retcode,output = getCommandOutput(cmd)
+        with span('send'):
+            sender = None
+            if options.sender is not None:
+                sender = PDLSender(getTransport(options.sender))
+                sender.start()
+            cmd,retcode,output = sendProduct(eventdicts,eventid,pdlfolder,sender)
+            if sender is not None:
+                sender.stop()
         print 'Command "%s" returned %s with output: "%s"' % (cmd,retcode,output)
     else:
         print 'Output was written to %s' % pdlfolder
-        
-
-            
-        
-        
-        
-    
-    
-    
-    
+    if profile is not None:
+        profile.disable()
+        writeProfile(profile,eventid)
+    writeTimingReport(timer,eventid,ffmdirs=args[2:4],sendOnly=options.sendOnly,review=options.doReview)
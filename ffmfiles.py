@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import re
+import sys
+import os.path
+import mmap
+import math
+import json
+import struct
+from itertools import islice
+
+#third party imports
+import numpy as np
+
+#how many subfault rows to convert to numbers at a time
+CHUNK_ROWS = 10000
+
+#names of the FSP subfault table columns, as used in the arrays returned by readFSP()
+FSP_COLUMNS = {'LAT':'lat',
+               'LON':'lon',
+               'X==EW':'x',
+               'Y==NS':'y',
+               'Z':'depth',
+               'SLIP':'slip',
+               'RAKE':'rake',
+               'TRUP':'trup',
+               'RISE':'rise',
+               'SF_MOMENT':'moment'}
+
+#columns of the station table in Readlp.das (0 based), which starts on the sixth line,
+#after four header lines and a line holding the number of stations
+DAS_COLUMNS = {'station':1,
+               'component':5,
+               'distance':6,
+               'azimuth':7,
+               'type':8,
+               'weight':9}
+DAS_HEADER_LINES = 4
+
+#records with a type greater than this are SH waves, the rest are P waves
+DAS_MAX_P_TYPE = 2
+
+#the published nump and nums have always counted the station table as lines 6 to nt of the
+#file, that is, all but the last five rows - kept as is until a real Readlp.das shows otherwise
+DAS_UNCOUNTED_ROWS = 5
+
+#names of the columns of a .disp file (longitude, latitude and the east, north and up displacements)
+DISP_COLUMNS = ['lon','lat','east','north','up']
+
+#how many bytes of a .disp file to convert to numbers at a time
+DISP_BLOCK_SIZE = 4*1024*1024
+
+#the decimated deformation grid is at most this many points on a side
+DISP_GRID_SIZE = 100
+
+#header of the binary deformation grid: magic, version, kind (DISP_POINTS or DISP_GRID), number
+#of fields, number of rows, number of columns, then (grids only) lon0, lat0, dlon and dlat
+DISP_MAGIC = 'FFMDISP\x00'
+DISP_VERSION = 1
+DISP_HEADER = '<8sIIIII4d'
+DISP_POINTS = 0
+DISP_GRID = 1
+
+#CMTSOLUTION field labels and the names of the columns they go in, in file order
+CMT_FIELDS = [('time shift','timeshift'),
+              ('half duration','halfduration'),
+              ('latitude','lat'),
+              ('longitude','lon'),
+              ('depth','depth'),
+              ('Mrr','mrr'),
+              ('Mtt','mtt'),
+              ('Mpp','mpp'),
+              ('Mrt','mrt'),
+              ('Mrp','mrp'),
+              ('Mtp','mtp')]
+
+#header of the binary CMT file: magic, version, number of fields, number of sources, then
+#the field names (16 bytes each) and one float64 column per field
+CMT_MAGIC = 'FFMCMT\x00\x00'
+CMT_VERSION = 1
+CMT_HEADER = '<8sIII'
+
+#the effective duration of the source time function is the time between these fractions of the total moment
+MR_MOMENT_FRACTIONS = (0.05,0.95)
+
+#a line that isn't numbers (a comment or column names)
+TEXT_LINE_PATTERN = re.compile(r'^[ \t]*[^-+.0-9\s]',re.MULTILINE)
+
+DX_PATTERN = re.compile(r'\bDx\s*=\s*([-+.0-9eE]+)')
+DZ_PATTERN = re.compile(r'\bDz\s*=\s*([-+.0-9eE]+)')
+
+def _getColumnNames(line):
+    #'%   LAT  LON  X==EW ...' -> ['lat','lon','x',...], or None if line isn't a column header
+    names = line.lstrip('%').split()
+    if 'LAT' not in names or 'LON' not in names or 'SLIP' not in names:
+        return None
+    return [FSP_COLUMNS.get(name,name.lower()) for name in names]
+
+def readFSP(fspfile):
+    """
+    Read the subfault table from an FSP (SRCMOD format) file.  The file is read a line at
+    a time, and the rows are converted to numbers CHUNK_ROWS at a time, so no Python objects
+    are made per subfault.  Multi-segment files, where each segment has its own table
+    header, are read into one table.
+    @param fspfile: FSP file.
+    @return: Dictionary of column name ('lat','lon','depth','slip','rake','trup','rise', etc.) to
+    numpy array, with one element per subfault.  If the file gives the subfault size (Dx and Dz),
+    there is also an 'area' column, in the square of the file's length unit (km).
+    """
+    columns = None
+    chunks = []
+    areas = []
+    area = np.nan
+    rows = []
+
+    def flush():
+        if not len(rows):
+            return
+        data = np.fromstring(' '.join(rows),sep=' ')
+        if data.size % len(columns):
+            raise Exception,'Subfault table in %s has rows with the wrong number of columns.' % fspfile
+        data = data.reshape(-1,len(columns))
+        chunks.append(data)
+        areas.append(np.repeat(area,len(data)))
+        del rows[:]
+
+    f = open(fspfile,'rt')
+    for line in f:
+        if line.startswith('%'):
+            dx = DX_PATTERN.search(line)
+            dz = DZ_PATTERN.search(line)
+            if dx is not None and dz is not None:
+                flush()
+                area = float(dx.group(1))*float(dz.group(1))
+                continue
+            names = _getColumnNames(line)
+            if names is not None:
+                flush()
+                if columns is not None and names != columns:
+                    raise Exception,'Segments in %s have different columns.' % fspfile
+                columns = names
+            continue
+        if columns is None or not len(line.strip()):
+            continue
+        rows.append(line)
+        if len(rows) >= CHUNK_ROWS:
+            flush()
+    f.close()
+    if columns is None:
+        raise Exception,'No subfault table found in %s.' % fspfile
+    flush()
+    if len(chunks):
+        table = np.vstack(chunks)
+        area = np.concatenate(areas)
+    else:
+        table = np.zeros((0,len(columns)))
+        area = np.zeros(0)
+    fsp = {}
+    for i in range(0,len(columns)):
+        fsp[columns[i]] = table[:,i]
+    if not np.isnan(area).any():
+        fsp['area'] = area
+    return fsp
+
+def getSlipStats(fsp):
+    """
+    Summarize a subfault table.
+    @param fsp: Dictionary of arrays, as returned by readFSP().
+    @return: Dictionary containing:
+             - peakslip Largest subfault slip (file units, usually m).
+             - centroidlat,centroidlon,centroiddepth Slip-weighted average subfault position.
+             - rupturearea Total area of the subfaults (km^2), if the file gives their size.
+             - ruptureduration Latest time any subfault finished slipping (rupture time plus
+               rise time, s), if the file has rupture times.
+             or an empty dictionary if the table has no subfaults.
+    """
+    stats = {}
+    slip = fsp['slip']
+    if not len(slip):
+        return stats
+    stats['peakslip'] = round(float(slip.max()),2)
+    weights = slip
+    if slip.sum() <= 0:
+        weights = np.ones_like(slip)
+    #take longitudes relative to the first subfault, so a fault across the dateline averages properly
+    lon0 = fsp['lon'][0]
+    lons = (fsp['lon']-lon0+180.0) % 360.0 - 180.0 + lon0
+    centroidlon = (np.average(lons,weights=weights)+180.0) % 360.0 - 180.0
+    stats['centroidlat'] = round(float(np.average(fsp['lat'],weights=weights)),4)
+    stats['centroidlon'] = round(float(centroidlon),4)
+    stats['centroiddepth'] = round(float(np.average(fsp['depth'],weights=weights)),1)
+    if 'area' in fsp:
+        stats['rupturearea'] = round(float(fsp['area'].sum()),1)
+    if 'trup' in fsp:
+        finish = fsp['trup']
+        if 'rise' in fsp:
+            finish = finish+fsp['rise']
+        stats['ruptureduration'] = round(float(finish.max()),1)
+    return stats
+
+def readStations(wavefile):
+    """
+    Read the station table from a Readlp.das file.  Only the header and the station rows are
+    read, and the columns are converted all at once.
+    @param wavefile: Readlp.das file.
+    @return: Dictionary of column name to numpy array, with one element per record: station and
+    component (strings), and type, azimuth, distance and (if the rows have that column) weight (floats).
+    """
+    f = open(wavefile,'rt')
+    try:
+        for i in range(0,DAS_HEADER_LINES):
+            f.readline()
+        nt = int(f.readline().strip())
+        rows = [line.split() for line in islice(f,nt)]
+    finally:
+        f.close()
+    lengths = set([len(row) for row in rows])
+    if len(rows) != nt or len(lengths) > 1:
+        raise Exception,'Station table in %s is incomplete or has rows of different lengths.' % wavefile
+    if nt:
+        ncols = lengths.pop()
+    else:
+        ncols = max(DAS_COLUMNS.values())+1
+    if ncols <= DAS_COLUMNS['type']:
+        raise Exception,'Station table in %s has only %i columns.' % (wavefile,ncols)
+    table = np.array(rows,dtype=str).reshape(nt,ncols)
+    stations = {}
+    for name in ['station','component']:
+        stations[name] = table[:,DAS_COLUMNS[name]]
+    for name in ['type','weight','azimuth','distance']:
+        if DAS_COLUMNS[name] < ncols:
+            stations[name] = table[:,DAS_COLUMNS[name]].astype(float)
+    return stations
+
+def getStationStats(stations):
+    """
+    Summarize a station table.
+    @param stations: Dictionary of arrays, as returned by readStations().
+    @return: Dictionary containing:
+             - nump Number of P wave records (not counting the last DAS_UNCOUNTED_ROWS).
+             - nums Number of SH wave records (likewise).
+             - azgap Largest gap (degrees) in azimuthal coverage of all records, if there are any.
+    """
+    ncounted = max(0,len(stations['type'])-DAS_UNCOUNTED_ROWS)
+    ptype = stations['type'][0:ncounted] <= DAS_MAX_P_TYPE
+    stats = {'nump':int(ptype.sum()),
+             'nums':int((~ptype).sum())}
+    if len(stations['type']):
+        azimuths = np.unique(stations['azimuth'] % 360.0)
+        gaps = np.diff(np.concatenate([azimuths,[azimuths[0]+360.0]]))
+        stats['azgap'] = round(float(gaps.max()),1)
+    return stats
+
+def _getBlocks(data,blocksize):
+    #split a string or mmap into blocks of whole lines
+    pos = 0
+    size = len(data)
+    while pos < size:
+        end = min(size,pos+blocksize)
+        if end < size:
+            newline = data.find('\n',end-1)
+            if newline < 0:
+                end = size
+            else:
+                end = newline+1
+        yield data[pos:end]
+        pos = end
+
+def readDisp(dispfile,blocksize=DISP_BLOCK_SIZE):
+    """
+    Read a surface deformation (.disp) file, one point per line: lon lat east north up.
+    The file is memory mapped and converted blocksize bytes at a time, so the text is never
+    all in memory at once.  Comment and column name lines are skipped.
+    @param dispfile: .disp file.
+    @return: Dictionary of column name (see DISP_COLUMNS) to numpy array, with one element per point.
+    """
+    f = open(dispfile,'rb')
+    chunks = []
+    ncols = None
+    try:
+        if os.fstat(f.fileno()).st_size:
+            data = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        else:
+            data = ''
+        for block in _getBlocks(data,blocksize):
+            if TEXT_LINE_PATTERN.search(block) is not None:
+                block = ''.join([line for line in block.splitlines(True) if TEXT_LINE_PATTERN.match(line) is None])
+            if ncols is None:
+                for line in block.splitlines():
+                    if len(line.strip()):
+                        ncols = len(line.split())
+                        break
+                if ncols is None:
+                    continue
+                if ncols < len(DISP_COLUMNS):
+                    raise Exception,'%s has %i columns, expected %i.' % (dispfile,ncols,len(DISP_COLUMNS))
+            values = np.fromstring(block,sep=' ')
+            if values.size % ncols:
+                raise Exception,'%s has rows with the wrong number of columns.' % dispfile
+            chunks.append(values.reshape(-1,ncols))
+        if len(data):
+            data.close()
+    finally:
+        f.close()
+    if len(chunks):
+        table = np.vstack(chunks)
+    else:
+        table = np.zeros((0,len(DISP_COLUMNS)))
+    disp = {}
+    for i in range(0,len(DISP_COLUMNS)):
+        disp[DISP_COLUMNS[i]] = table[:,i]
+    return disp
+
+def _getSpacing(values):
+    #unique values and their spacing, if they are evenly spaced
+    unique = np.unique(values)
+    if len(unique) < 2:
+        return (unique,None)
+    steps = np.diff(unique)
+    if not np.allclose(steps,steps[0],rtol=1e-3):
+        return (unique,None)
+    return (unique,float(steps[0]))
+
+def decimateDisp(disp,maxsize=DISP_GRID_SIZE):
+    """
+    Thin out deformation points.  Points on a regular lon/lat grid are returned as a grid with
+    at most maxsize points on a side; anything else as at most maxsize*maxsize points.
+    @param disp: Dictionary of arrays, as returned by readDisp().
+    @return: Dictionary with kind (DISP_GRID or DISP_POINTS), fields (names) and data (2D float32 array
+    per field), and for grids lon0,lat0 (south west corner), dlon and dlat.
+    """
+    npoints = len(disp['lon'])
+    lons,dlon = _getSpacing(disp['lon'])
+    lats,dlat = _getSpacing(disp['lat'])
+    fields = DISP_COLUMNS[2:]
+    if npoints and dlon is not None and dlat is not None and len(lons)*len(lats) == npoints:
+        order = np.lexsort((disp['lon'],disp['lat'])) #rows from south to north, west to east within a row
+        step = int(math.ceil(max(len(lons),len(lats))/float(maxsize)))
+        data = [disp[field][order].reshape(len(lats),len(lons))[::step,::step].astype('<f4') for field in fields]
+        return {'kind':DISP_GRID,'fields':fields,'data':data,
+                'lon0':float(lons[0]),'lat0':float(lats[0]),'dlon':dlon*step,'dlat':dlat*step}
+    fields = DISP_COLUMNS
+    step = max(1,int(math.ceil(npoints/float(maxsize*maxsize))))
+    data = [disp[field][::step].astype('<f4').reshape(1,-1) for field in fields]
+    return {'kind':DISP_POINTS,'fields':fields,'data':data,'lon0':0.0,'lat0':0.0,'dlon':0.0,'dlat':0.0}
+
+def writeDispBinary(grid,binfile):
+    """
+    Write a decimated deformation grid (see decimateDisp()) as little-endian binary: the
+    DISP_HEADER structure, the field names (16 bytes each, null padded), then each field as
+    float32 rows (south to north for grids).
+    """
+    nrows,ncols = grid['data'][0].shape
+    f = open(binfile,'wb')
+    f.write(struct.pack(DISP_HEADER,DISP_MAGIC,DISP_VERSION,grid['kind'],len(grid['fields']),nrows,ncols,
+                        grid['lon0'],grid['lat0'],grid['dlon'],grid['dlat']))
+    for field in grid['fields']:
+        f.write(struct.pack('16s',field))
+    for data in grid['data']:
+        f.write(np.ascontiguousarray(data,dtype='<f4').tostring())
+    f.close()
+
+def readDispBinary(binfile):
+    """
+    Read a file written by writeDispBinary().
+    @return: Dictionary like the one returned by decimateDisp().
+    """
+    data = open(binfile,'rb').read()
+    hsize = struct.calcsize(DISP_HEADER)
+    magic,version,kind,nfields,nrows,ncols,lon0,lat0,dlon,dlat = struct.unpack(DISP_HEADER,data[0:hsize])
+    if magic != DISP_MAGIC:
+        raise Exception,'%s is not a deformation grid file.' % binfile
+    fields = [data[hsize+i*16:hsize+(i+1)*16].rstrip('\x00') for i in range(0,nfields)]
+    values = np.frombuffer(data,dtype='<f4',offset=hsize+nfields*16).reshape(nfields,nrows,ncols)
+    return {'kind':kind,'fields':fields,'data':list(values),
+            'lon0':lon0,'lat0':lat0,'dlon':dlon,'dlat':dlat}
+
+def getDispSummary(disp):
+    """
+    Summarize surface deformation as GeoJSON: the extent of the grid, and the points of largest
+    uplift, subsidence and horizontal motion.
+    @param disp: Dictionary of arrays, as returned by readDisp().
+    @return: GeoJSON FeatureCollection (as a dictionary).
+    """
+    features = []
+    lon = disp['lon']
+    lat = disp['lat']
+    if not len(lon):
+        return {'type':'FeatureCollection','features':features}
+    horizontal = np.hypot(disp['east'],disp['north'])
+    west,east,south,north = [float(x) for x in (lon.min(),lon.max(),lat.min(),lat.max())]
+    features.append({'type':'Feature',
+                     'geometry':{'type':'Polygon',
+                                 'coordinates':[[[west,south],[east,south],[east,north],[west,north],[west,south]]]},
+                     'properties':{'name':'extent',
+                                   'npoints':len(lon),
+                                   'maxup':round(float(disp['up'].max()),5),
+                                   'minup':round(float(disp['up'].min()),5),
+                                   'maxhorizontal':round(float(horizontal.max()),5)}})
+    for name,index in [('maximum uplift',disp['up'].argmax()),
+                       ('maximum subsidence',disp['up'].argmin()),
+                       ('maximum horizontal displacement',horizontal.argmax())]:
+        properties = {'name':name}
+        for field in DISP_COLUMNS[2:]:
+            properties[field] = round(float(disp[field][index]),5)
+        features.append({'type':'Feature',
+                         'geometry':{'type':'Point','coordinates':[float(lon[index]),float(lat[index])]},
+                         'properties':properties})
+    return {'type':'FeatureCollection','features':features}
+
+def writeDispProducts(dispfile,binfile,geojsonfile):
+    """
+    Make the compact versions of a .disp file: a decimated binary grid (see writeDispBinary())
+    and a GeoJSON summary (see getDispSummary()).
+    """
+    disp = readDisp(dispfile)
+    writeDispBinary(decimateDisp(disp),binfile)
+    f = open(geojsonfile,'wt')
+    json.dump(getDispSummary(disp),f)
+    f.close()
+
+def _getCMTBlocks(f):
+    #the fields of each source in a CMTSOLUTION file, as a list of (label,value) tuples, one source at a time
+    block = None
+    for line in f:
+        if not len(line.strip()):
+            continue
+        if ':' not in line:
+            #the PDE line that starts each source
+            if block is not None:
+                yield block
+            block = []
+            continue
+        if block is None:
+            block = []
+        label,value = line.split(':',1)
+        block.append((label.strip(),value.strip()))
+    if block is not None:
+        yield block
+
+def writeCMTBinary(cmtfile,binfile):
+    """
+    Convert a CMTSOLUTION file to a columnar little-endian binary file: the CMT_HEADER structure,
+    the field names (16 bytes each, null padded), then one float64 column per field (see
+    CMT_FIELDS), each holding every source in file order.  The text is read twice, once to count
+    the sources and once to fill in the (memory mapped) output, so memory use doesn't grow with
+    the number of sources.
+    @param cmtfile: CMTSOLUTION file.
+    @param binfile: Output file.
+    @return: Number of sources.
+    """
+    names = [name for label,name in CMT_FIELDS]
+    columns = dict([(CMT_FIELDS[i][0],i) for i in range(0,len(CMT_FIELDS))])
+    f = open(cmtfile,'rt')
+    try:
+        nsources = sum(1 for block in _getCMTBlocks(f))
+        offset = struct.calcsize(CMT_HEADER)+len(names)*16
+        out = open(binfile,'wb')
+        out.write(struct.pack(CMT_HEADER,CMT_MAGIC,CMT_VERSION,len(names),nsources))
+        for name in names:
+            out.write(struct.pack('16s',name))
+        out.truncate(offset+len(names)*nsources*8)
+        out.close()
+        if not nsources:
+            return 0
+        table = np.memmap(binfile,dtype='<f8',mode='r+',offset=offset,shape=(len(names),nsources))
+        f.seek(0)
+        isource = 0
+        for block in _getCMTBlocks(f):
+            found = 0
+            for label,value in block:
+                if label in columns:
+                    table[columns[label],isource] = float(value)
+                    found += 1
+            if found != len(names):
+                raise Exception,'Source %i in %s is missing some of its fields.' % (isource+1,cmtfile)
+            isource += 1
+        table.flush()
+        del table
+    finally:
+        f.close()
+    return nsources
+
+def readCMTBinary(binfile):
+    """
+    Read a file written by writeCMTBinary().
+    @return: Dictionary of field name to numpy array, with one element per source.
+    """
+    data = open(binfile,'rb').read()
+    hsize = struct.calcsize(CMT_HEADER)
+    magic,version,nfields,nsources = struct.unpack(CMT_HEADER,data[0:hsize])
+    if magic != CMT_MAGIC:
+        raise Exception,'%s is not a binary CMT file.' % binfile
+    names = [data[hsize+i*16:hsize+(i+1)*16].rstrip('\x00') for i in range(0,nfields)]
+    values = np.frombuffer(data,dtype='<f8',offset=hsize+nfields*16).reshape(nfields,nsources)
+    return dict(zip(names,values))
+
+def readMomentRate(mrfile):
+    """
+    Read a moment rate (.mr) file, one sample per line: time (s) and moment rate (dyne.cm/s).
+    Comment and column name lines are skipped, as are any columns after the second.
+    @param mrfile: .mr file.
+    @return: Dictionary with time and rate arrays, sorted by time.
+    """
+    data = open(mrfile,'rt').read()
+    lines = [line for line in data.splitlines() if len(line.strip()) and TEXT_LINE_PATTERN.match(line) is None]
+    if not len(lines):
+        return {'time':np.zeros(0),'rate':np.zeros(0)}
+    ncols = len(lines[0].split())
+    if ncols < 2:
+        raise Exception,'%s has %i column(s), expected at least 2.' % (mrfile,ncols)
+    values = np.fromstring('\n'.join(lines),sep=' ')
+    if values.size != len(lines)*ncols:
+        raise Exception,'%s has rows with the wrong number of columns.' % mrfile
+    table = values.reshape(-1,ncols)
+    table = table[np.argsort(table[:,0],kind='mergesort')]
+    return {'time':table[:,0],'rate':table[:,1]}
+
+def getMomentRateStats(mr):
+    """
+    Summarize a source time function.
+    @param mr: Dictionary of arrays, as returned by readMomentRate().
+    @return: Dictionary containing:
+             - stfmoment Total moment (integral of the moment rate, dyne.cm).
+             - stfpeakrate Largest moment rate (dyne.cm/s).
+             - stfpeaktime Time of the largest moment rate (s).
+             - stfcentroidtime Moment-weighted average time (s).
+             - stfduration Time taken to release the middle 90% of the moment (s, see MR_MOMENT_FRACTIONS).
+             or an empty dictionary if there are fewer than two samples or no moment.
+    """
+    stats = {}
+    time = mr['time']
+    rate = np.clip(mr['rate'],0.0,None)
+    if len(time) < 2:
+        return stats
+    #cumulative moment by the trapezoid rule, so the total matches np.trapz()
+    steps = np.diff(time)*(rate[1:]+rate[:-1])/2.0
+    cumulative = np.concatenate([[0.0],np.cumsum(steps)])
+    moment = cumulative[-1]
+    if moment <= 0:
+        return stats
+    ipeak = rate.argmax()
+    start,end = np.interp(np.array(MR_MOMENT_FRACTIONS)*moment,cumulative,time)
+    stats['stfmoment'] = float('%.4g' % moment)
+    stats['stfpeakrate'] = float('%.4g' % rate[ipeak])
+    stats['stfpeaktime'] = round(float(time[ipeak]),2)
+    stats['stfcentroidtime'] = round(float(np.trapz(time*rate,time)/moment),2)
+    stats['stfduration'] = round(float(end-start),2)
+    return stats
+
+if __name__ == '__main__':
+    if os.path.basename(sys.argv[1]).startswith('CMTSOLUTION'):
+        binfile = sys.argv[1]+'.bin'
+        print '%i sources written to %s' % (writeCMTBinary(sys.argv[1],binfile),binfile)
+        sys.exit(0)
+    if sys.argv[1].endswith('.mr'):
+        mr = readMomentRate(sys.argv[1])
+        print '%i samples' % len(mr['time'])
+        for key,value in sorted(getMomentRateStats(mr).items()):
+            print '%s: %s' % (key,value)
+        sys.exit(0)
+    if sys.argv[1].endswith('.disp'):
+        disp = readDisp(sys.argv[1])
+        grid = decimateDisp(disp)
+        print '%i points, decimated to %s' % (len(disp['lon']),'x'.join([str(n) for n in grid['data'][0].shape]))
+        print json.dumps(getDispSummary(disp),indent=1)
+        sys.exit(0)
+    if sys.argv[1].endswith('.das'):
+        stations = readStations(sys.argv[1])
+        print '%i records' % len(stations['type'])
+        for key,value in sorted(getStationStats(stations).items()):
+            print '%s: %s' % (key,value)
+        sys.exit(0)
+    fsp = readFSP(sys.argv[1])
+    print '%i subfaults' % len(fsp['slip'])
+    for key,value in sorted(getSlipStats(fsp).items()):
+        print '%s: %s' % (key,value)
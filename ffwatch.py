@@ -0,0 +1,483 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import sys
+import os
+import os.path
+import glob
+import time
+import json
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+from optparse import OptionParser
+
+#local imports
+import ffault
+from eventinfo import getInputKey
+from pdlsender import PDLSender,getTransport
+
+#files that must be in a finite fault directory before it is built, and the FILE_PATTERNS
+#(see ffault.py) that must each match at least one file
+REQUIRED_FILES = ['Event_mult.in','plot_info','Readlp.das']
+REQUIRED_PATTERNS = ['bodywave','surfacewave','basemap']
+
+#an event is built once its directories are complete and none of their files have changed for this long (seconds)
+DEFAULT_SETTLE = 30.0
+
+#how long (seconds) to wait before trying a failed event again - doubled after each failure, up to MAX_RETRY_DELAY
+RETRY_DELAY = 60.0
+MAX_RETRY_DELAY = 3600.0
+
+#how often (seconds) the polling watcher looks for changes
+DEFAULT_INTERVAL = 10.0
+
+#inotify event flags (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+#what to watch for in the data root (new and removed directories) and in each directory
+ROOT_MASK = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_ONLYDIR
+DIR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+            IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+#struct inotify_event, before its name
+EVENT_HEADER = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_HEADER)
+
+def getDirectories(root):
+    #every directory directly inside root
+    folders = []
+    for name in sorted(os.listdir(root)):
+        folder = os.path.join(root,name)
+        if os.path.isdir(folder) and not name.startswith('.'):
+            folders.append(folder)
+    return folders
+
+def getDirectoryKey(ffmdir):
+    """
+    Fingerprint every file in a finite fault directory by name, size and modification time.
+    @return: Hex digest (see eventinfo.getInputKey()), or None if the directory is gone.
+    """
+    try:
+        names = os.listdir(ffmdir)
+    except OSError:
+        return None
+    return getInputKey([os.path.join(ffmdir,name) for name in names])
+
+def isComplete(ffmdir):
+    """
+    @return: True if ffmdir has all of the REQUIRED_FILES and at least one file matching each
+    of the REQUIRED_PATTERNS.
+    """
+    for fname in REQUIRED_FILES:
+        if not os.path.isfile(os.path.join(ffmdir,fname)):
+            return False
+    for key in REQUIRED_PATTERNS:
+        if not len(glob.glob(os.path.join(ffmdir,ffault.FILE_PATTERNS[key]))):
+            return False
+    return True
+
+def getEventKey(ffmdirs):
+    """
+    Fingerprint all of an event's directories (see getDirectoryKey()).
+    @return: String, or None if any of the directories is gone.
+    """
+    keys = [getDirectoryKey(ffmdir) for ffmdir in ffmdirs]
+    if None in keys:
+        return None
+    return ','.join(keys)
+
+class WatchManifest(object):
+    """
+    The events to build, read from a batch manifest (see ffault.readManifest()), which is read
+    again whenever it changes.  This is where an event's planes are paired up: a row with two
+    directories is a double plane event, and is not built until both are finished.  Directories
+    are relative to the finite fault root folder.
+    """
+    def __init__(self,manifestfile,root):
+        self.manifestfile = manifestfile
+        self.root = root
+        self.mtime = None
+        self.rows = []
+
+    def getRows(self):
+        """
+        @return: List of manifest rows, as of the last time the manifest could be read.
+        """
+        try:
+            mtime = os.path.getmtime(self.manifestfile)
+        except OSError:
+            return self.rows
+        if mtime == self.mtime:
+            return self.rows
+        self.mtime = mtime
+        try:
+            rows = ffault.readManifest(self.manifestfile)
+        except Exception,msg:
+            print 'Could not read %s, still using the events it listed before: %s' % (self.manifestfile,str(msg))
+            return self.rows
+        for row in rows:
+            row['ffmdirs'] = [os.path.join(self.root,ffmdir) for ffmdir in row['ffmdirs']]
+        self.rows = rows
+        return self.rows
+
+def getEventRows(root,net,options,manifest=None):
+    """
+    @return: List of events to build, as manifest rows (see ffault.readManifest()): the rows of
+    manifest (a WatchManifest) if there is one, and otherwise one single plane event per directory
+    in root.  Those are only guesses (any directory could be the second plane of another event),
+    so they are marked review only, and are never sent.
+    """
+    if manifest is not None:
+        return manifest.getRows()
+    rows = []
+    for folder in getDirectories(root):
+        rows.append({'eventid':net+os.path.basename(folder),'ffmdirs':[folder],
+                     'version':options.version,'comment':options.comment,'review':True})
+    return rows
+
+def getVersionFile(eventid):
+    return os.path.join(ffault.getCacheFolder('versions'),'%s.json' % eventid)
+
+def getNextVersion(eventid,version):
+    """
+    @return: version, or one more than the last version of eventid that the watcher sent, whichever is larger.
+    """
+    try:
+        record = json.load(open(getVersionFile(eventid),'rt'))
+    except (IOError,ValueError):
+        return version
+    return max(version,record['version']+1)
+
+def saveSentVersion(eventid,version):
+    versionfile = getVersionFile(eventid)
+    folder = os.path.dirname(versionfile)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass #another process made it first
+    tmpfile = versionfile + '.%i.tmp' % os.getpid()
+    f = open(tmpfile,'wt')
+    json.dump({'eventid':eventid,'version':version},f)
+    f.close()
+    os.rename(tmpfile,versionfile)
+
+class PollingWatcher(object):
+    """
+    Find changed finite fault directories by fingerprinting every directory in the data root
+    every interval seconds.
+    """
+    def __init__(self,root,interval=DEFAULT_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.keys = dict([(folder,getDirectoryKey(folder)) for folder in getDirectories(root)])
+
+    def wait(self,timeout):
+        """
+        Wait up to timeout seconds (or the polling interval, if that is shorter) for changes.
+        @return: Set of directories that have changed.
+        """
+        time.sleep(max(0.0,min(timeout,self.interval)))
+        changed = set()
+        keys = {}
+        for folder in getDirectories(self.root):
+            keys[folder] = getDirectoryKey(folder)
+            if keys[folder] != self.keys.get(folder):
+                changed.add(folder)
+        self.keys = keys
+        return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """
+    Find changed finite fault directories with Linux inotify (through ctypes), watching the
+    data root for new directories and every directory in it for changed files.
+    """
+    def __init__(self,root):
+        libname = ctypes.util.find_library('c')
+        if libname is None:
+            raise OSError,'Could not find the C library.'
+        self.libc = ctypes.CDLL(libname,use_errno=True)
+        if not hasattr(self.libc,'inotify_init'):
+            raise OSError,'inotify is not available on this system.'
+        self.root = root
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError,'inotify_init() failed: %s' % os.strerror(ctypes.get_errno())
+        self.folders = {} #watch descriptor -> directory
+        self.rootwd = self._addWatch(root,ROOT_MASK)
+        for folder in getDirectories(root):
+            self._addWatch(folder,DIR_MASK)
+
+    def _addWatch(self,folder,mask):
+        wd = self.libc.inotify_add_watch(self.fd,folder,mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if folder == self.root or err not in (errno.ENOENT,errno.ENOTDIR):
+                raise OSError,'Could not watch %s: %s' % (folder,os.strerror(err))
+            return None
+        self.folders[wd] = folder
+        return wd
+
+    def wait(self,timeout):
+        """
+        Wait up to timeout seconds for changes.
+        @return: Set of directories that have changed.
+        """
+        changed = set()
+        readable,writable,exceptional = select.select([self.fd],[],[],max(0.0,timeout))
+        if not len(readable):
+            return changed
+        data = os.read(self.fd,64*1024)
+        pos = 0
+        while pos+EVENT_SIZE <= len(data):
+            wd,mask,cookie,length = struct.unpack(EVENT_HEADER,data[pos:pos+EVENT_SIZE])
+            name = data[pos+EVENT_SIZE:pos+EVENT_SIZE+length].rstrip('\x00')
+            pos += EVENT_SIZE+length
+            if mask & IN_Q_OVERFLOW:
+                #events were lost - treat every directory as changed
+                changed.update(getDirectories(self.root))
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd,None)
+                continue
+            if wd == self.rootwd:
+                folder = os.path.join(self.root,name)
+                if mask & (IN_CREATE | IN_MOVED_TO) and os.path.isdir(folder):
+                    self._addWatch(folder,DIR_MASK)
+                    changed.add(folder)
+                continue
+            if wd in self.folders:
+                changed.add(self.folders[wd])
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def getWatcher(root,poll=False,interval=DEFAULT_INTERVAL):
+    """
+    @return: InotifyWatcher for root, or a PollingWatcher if poll is True or inotify isn't available.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except (OSError,AttributeError),msg:
+            print 'Polling for changes every %.0f seconds (%s)' % (interval,str(msg))
+    return PollingWatcher(root,interval)
+
+class BuildQueue(object):
+    """
+    Events waiting to be built.  An event is ready once all of its directories are complete (see
+    isComplete()) and none of them has changed for settle seconds.  Events whose directories
+    have the same fingerprint (see getEventKey()) as when the event was last built are skipped,
+    and an event that failed is only tried again after a delay that doubles with each failure,
+    unless its directories change in the meantime.
+    """
+    def __init__(self,settle=DEFAULT_SETTLE,retrydelay=RETRY_DELAY):
+        self.settle = settle
+        self.retrydelay = retrydelay
+        self.changed = {} #directory -> time of last change, until it has settled
+        self.keys = {} #directory -> fingerprint when last looked at
+        self.built = {} #event id -> fingerprint when last built
+        self.failures = {} #event id -> (failures in a row,time to try again,fingerprint)
+
+    def touch(self,ffmdir):
+        self.changed[ffmdir] = time.time()
+
+    def markBuilt(self,row,key):
+        self.built[row['eventid']] = key
+        self.failures.pop(row['eventid'],None)
+
+    def markFailed(self,row,key):
+        """
+        @return: Seconds until the event will be tried again.
+        """
+        nfailures = 1
+        failure = self.failures.get(row['eventid'])
+        if failure is not None and failure[2] == key:
+            nfailures = failure[0]+1
+        delay = min(MAX_RETRY_DELAY,self.retrydelay*2**(nfailures-1))
+        self.failures[row['eventid']] = (nfailures,time.time()+delay,key)
+        return delay
+
+    def getTimeout(self):
+        #how long until the next directory has settled or the next failed event is due
+        now = time.time()
+        times = [changed+self.settle for changed in self.changed.values() if changed+self.settle > now]
+        times += [retry for nfailures,retry,key in self.failures.values() if retry > now]
+        if not len(times):
+            return self.settle
+        return max(0.0,min(times)-now)
+
+    def isSettled(self,ffmdir,now):
+        #directories are also fingerprinted here, so changes the watcher missed still have to settle
+        key = getDirectoryKey(ffmdir)
+        if key != self.keys.get(ffmdir):
+            self.keys[ffmdir] = key
+            self.changed[ffmdir] = now
+        if ffmdir in self.changed:
+            if now-self.changed[ffmdir] < self.settle:
+                return False
+            del self.changed[ffmdir]
+        return True
+
+    def getReady(self,rows):
+        """
+        @param rows: List of events to consider, as manifest rows (see getEventRows()).
+        @return: List of (manifest row,fingerprint) tuples for the events that are ready to build.
+        """
+        now = time.time()
+        ready = []
+        for row in rows:
+            settled = [self.isSettled(ffmdir,now) for ffmdir in row['ffmdirs']]
+            if False in settled:
+                continue
+            complete = [isComplete(ffmdir) for ffmdir in row['ffmdirs']]
+            if False in complete:
+                continue
+            key = getEventKey(row['ffmdirs'])
+            if key is None or key == self.built.get(row['eventid']):
+                continue
+            failure = self.failures.get(row['eventid'])
+            if failure is not None and failure[2] == key and now < failure[1]:
+                continue
+            ready.append((row,key))
+        return ready
+
+def buildEvent(row,options,sender=None):
+    """
+    Build (and if options.doSend is True and the row isn't marked review only, send) an event,
+    as the next version after the last one the watcher sent.
+    @param row: Manifest row (see getEventRows()).
+    @return: True if the event was built (and sent), False if not.
+    """
+    eventid = row['eventid']
+    row = dict(row,version=getNextVersion(eventid,row['version']))
+    result = ffault.processBatchRow(row,options.offline,options.thumbnails,options.optimize)
+    print '%s: version %i: %s' % (eventid,row['version'],result['message'])
+    if not result['success']:
+        return False
+    ffault.getBlobStore().prune()
+    if not options.doSend or row.get('review'):
+        return True
+    cmd,retcode,output = ffault.sendProduct(result['eventdicts'],eventid,result['pdlfolder'],sender)
+    print 'Command "%s" returned %s with output: "%s"' % (cmd,retcode,output)
+    if retcode:
+        saveSentVersion(eventid,row['version'])
+    return retcode
+
+def watch(root,net,options,sender=None,manifest=None):
+    """
+    Build events as their finite fault directories in root are finished, until interrupted.
+    @param manifest: WatchManifest listing the events to build, or None to build each directory in
+    root as a single plane event.
+    """
+    watcher = getWatcher(root,options.poll,options.interval)
+    queue = BuildQueue(options.settle)
+    if not options.existing:
+        for row in getEventRows(root,net,options,manifest):
+            queue.markBuilt(row,getEventKey(row['ffmdirs']))
+    print 'Watching %s' % root
+    try:
+        while True:
+            for folder in watcher.wait(queue.getTimeout()):
+                queue.touch(folder)
+            for row,key in queue.getReady(getEventRows(root,net,options,manifest)):
+                try:
+                    success = buildEvent(row,options,sender)
+                except Exception,msg:
+                    print 'Could not build %s: %s' % (row['eventid'],str(msg))
+                    success = False
+                if success:
+                    queue.markBuilt(row,key)
+                else:
+                    print '%s: trying again in %.0f seconds' % (row['eventid'],queue.markFailed(row,key))
+    finally:
+        watcher.close()
+
+if __name__ == '__main__':
+    usage = """usage: %prog [options] FFMROOT
+    Watch FFMROOT, the folder where finite fault directories are written, and build the product
+    for each event as soon as its directories are finished.  A directory is finished when it
+    has Event_mult.in, plot_info, Readlp.das and the wave and base map plots, and nothing in it
+    has changed for SETTLE seconds.  Products are only built for review unless -S is given.
+    With -m, the events (and which directories hold their planes) are read from MANIFEST, a
+    batch manifest as for ffault.py -b, with directories relative to FFMROOT.  Without it, each
+    directory is built as a single plane event, for review only (-S needs -m).
+    Example:
+    %prog -m events.csv /home/ghayes/ffmdata"""
+    parser = OptionParser(usage=usage)
+    parser.add_option("-e", "--net", dest="net", default='us',
+                      help="network code of the events, without -m (default is us)", metavar="NET")
+    parser.add_option("-c", "--comment", dest="comment", default='Not available yet.',
+                      help="add a 'scientific analysis' comment to the HTML output, without -m", metavar="COMMENT")
+    parser.add_option("-v", "--version", dest="version", type="int", default=1,
+                      help="lowest version number to give the finite fault output, without -m", metavar="VERSION")
+    parser.add_option("-m", "--manifest", dest="manifest",
+                      help="build the events listed in MANIFEST (see ffault.py -b)", metavar="MANIFEST")
+    parser.add_option("-S", "--send",action="store_true",
+                      dest="doSend",default=False,help="send products to PDL (the default is to only build them for review)")
+    parser.add_option("-s", "--sender", dest="sender",
+                      help="send products through one long-lived sender process started with COMMAND (see pdlsender.py)", metavar="COMMAND")
+    parser.add_option("-o", "--offline",action="store_true",
+                      dest="offline",default=False,help="don't look up event locations on the network")
+    parser.add_option("-t", "--thumbnails",action="store_true",
+                      dest="thumbnails",default=False,help="make thumbnails of the wave plots")
+    parser.add_option("-z", "--optimize",action="store_true",
+                      dest="optimize",default=False,help="losslessly recompress PNG files before sending")
+    parser.add_option("-w", "--settle", dest="settle", type="float", default=DEFAULT_SETTLE,
+                      help="seconds an event's directories must stay unchanged before it is built (default %.0f)" % DEFAULT_SETTLE, metavar="SETTLE")
+    parser.add_option("-p", "--poll",action="store_true",
+                      dest="poll",default=False,help="poll for changes instead of using inotify")
+    parser.add_option("-i", "--interval", dest="interval", type="float", default=DEFAULT_INTERVAL,
+                      help="seconds between polls (default %.0f)" % DEFAULT_INTERVAL, metavar="INTERVAL")
+    parser.add_option("-x", "--existing",action="store_true",
+                      dest="existing",default=False,help="also build the events whose directories are already finished when the watcher starts")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        print 'Missing or non-existent finite fault root folder.'
+        parser.print_help()
+        sys.exit(1)
+    if options.doSend and options.manifest is None:
+        print 'Products can only be sent (-S) for events listed in a manifest (-m).'
+        sys.exit(1)
+    root = os.path.abspath(args[0])
+    manifest = None
+    if options.manifest is not None:
+        if not os.path.isfile(options.manifest):
+            print 'Manifest file %s does not exist.' % options.manifest
+            sys.exit(1)
+        try:
+            ffault.readManifest(options.manifest)
+        except Exception,msg:
+            print 'Could not read %s: %s' % (options.manifest,str(msg))
+            sys.exit(1)
+        manifest = WatchManifest(os.path.abspath(options.manifest),root)
+    sender = None
+    if options.doSend and options.sender is not None:
+        sender = PDLSender(getTransport(options.sender))
+        sender.start()
+    try:
+        watch(root,options.net,options,sender,manifest)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if sender is not None:
+            sender.stop()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os.path
+import glob
+import json
+import time
+import math
+import csv
+import threading
+import socket
+import httplib
+
+#USGS detail feed, where the official place names come from
+DETAIL_HOST = 'earthquake.usgs.gov'
+DETAIL_PATH = '/earthquakes/feed/v1.0/detail/%s.geojson'
+
+#how long (seconds) to wait for the detail feed before using the offline place index
+DEFAULT_TIMEOUT = 10.0
+
+#how long (seconds) a looked-up location stays good, and how many events to remember
+DEFAULT_TTL = 30*86400
+DEFAULT_MAXENTRIES = 2000
+
+#table of named places bundled with this script (name,region,lat,lon)
+PLACES_FILE = 'places.csv'
+
+#size (degrees) of the cells in the place index
+GRID_SIZE = 5.0
+
+EARTH_RADIUS = 6371.0
+KM_PER_DEGREE = EARTH_RADIUS*math.pi/180.0
+
+COMPASS = ['N','NNE','NE','ENE','E','ESE','SE','SSE','S','SSW','SW','WSW','W','WNW','NW','NNW']
+
+class LocationCache(object):
+    """
+    Persistent cache of event location strings, one small JSON file per event in cachefolder.
+    Entries older than ttl seconds are ignored, and when there are more than maxentries
+    events the least recently used ones are removed.  One file per event means that
+    several processes (batch mode) can share the cache safely.
+    """
+    def __init__(self,cachefolder,ttl=DEFAULT_TTL,maxentries=DEFAULT_MAXENTRIES):
+        self.cachefolder = cachefolder
+        self.ttl = ttl
+        self.maxentries = maxentries
+
+    def _getFile(self,eventid):
+        safeid = ''.join([c for c in eventid if c.isalnum()])
+        return os.path.join(self.cachefolder,'%s.json' % safeid)
+
+    def get(self,eventid):
+        """
+        @return: Cached location string for eventid, or None if there isn't a current one.
+        """
+        cachefile = self._getFile(eventid)
+        try:
+            entry = json.load(open(cachefile,'rt'))
+        except (IOError,ValueError):
+            return None
+        if time.time() - entry['saved'] > self.ttl:
+            self._remove(cachefile)
+            return None
+        try:
+            os.utime(cachefile,None) #mark as recently used
+        except OSError:
+            pass
+        return entry['place']
+
+    def put(self,eventid,place):
+        if not os.path.isdir(self.cachefolder):
+            try:
+                os.makedirs(self.cachefolder)
+            except OSError:
+                pass #another process made it first
+        cachefile = self._getFile(eventid)
+        tmpfile = cachefile + '.%i.tmp' % os.getpid()
+        f = open(tmpfile,'wt')
+        json.dump({'eventid':eventid,'place':place,'saved':time.time()},f)
+        f.close()
+        os.rename(tmpfile,cachefile)
+        self.evict()
+
+    def evict(self):
+        cachefiles = glob.glob(os.path.join(self.cachefolder,'*.json'))
+        if len(cachefiles) <= self.maxentries:
+            return
+        mtimes = []
+        for cachefile in cachefiles:
+            try:
+                mtimes.append((os.path.getmtime(cachefile),cachefile))
+            except OSError:
+                pass
+        mtimes.sort()
+        for mtime,cachefile in mtimes[0:len(mtimes)-self.maxentries]:
+            self._remove(cachefile)
+
+    def _remove(self,cachefile):
+        try:
+            os.remove(cachefile)
+        except OSError:
+            pass
+
+def getDistance(lat1,lon1,lat2,lon2):
+    """
+    Great circle distance (km) between two points.
+    """
+    lat1,lon1,lat2,lon2 = [math.radians(x) for x in (lat1,lon1,lat2,lon2)]
+    a = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS*math.asin(min(1.0,math.sqrt(a)))
+
+def getAzimuth(lat1,lon1,lat2,lon2):
+    """
+    Azimuth (degrees clockwise from north) of point 2 as seen from point 1.
+    """
+    lat1,lon1,lat2,lon2 = [math.radians(x) for x in (lat1,lon1,lat2,lon2)]
+    y = math.sin(lon2-lon1)*math.cos(lat2)
+    x = math.cos(lat1)*math.sin(lat2) - math.sin(lat1)*math.cos(lat2)*math.cos(lon2-lon1)
+    return math.degrees(math.atan2(y,x)) % 360.0
+
+class PlaceIndex(object):
+    """
+    Offline reverse geocoder: a grid index over a table of named places that finds
+    the nearest place to a point without touching the network.
+    """
+    def __init__(self,placefile=None,gridsize=GRID_SIZE):
+        if placefile is None:
+            placefile = os.path.join(os.path.dirname(os.path.abspath(__file__)),PLACES_FILE)
+        self.gridsize = gridsize
+        self.nrows = int(math.ceil(180.0/gridsize))
+        self.ncols = int(math.ceil(360.0/gridsize))
+        self.cells = {}
+        self.nplaces = 0
+        f = open(placefile,'rb')
+        for parts in csv.reader(f):
+            if not len(parts) or parts[0].startswith('#'):
+                continue
+            name,region,lat,lon = parts
+            lat = float(lat)
+            lon = float(lon)
+            self.cells.setdefault(self._getCell(lat,lon),[]).append((lat,lon,'%s, %s' % (name,region)))
+            self.nplaces += 1
+        f.close()
+
+    def _getCell(self,lat,lon):
+        row = min(int((lat+90.0)/self.gridsize),self.nrows-1)
+        col = int(((lon+180.0) % 360.0)/self.gridsize) % self.ncols
+        return (row,col)
+
+    def _getRing(self,row,col,radius):
+        #all of the cells whose row or column is exactly radius cells away from (row,col)
+        cells = set()
+        for drow in range(-radius,radius+1):
+            r = row+drow
+            if r < 0 or r >= self.nrows:
+                continue
+            if abs(drow) == radius:
+                dcols = range(-radius,radius+1)
+            else:
+                dcols = [-radius,radius]
+            for dcol in dcols:
+                cells.add((r,(col+dcol) % self.ncols))
+        return cells
+
+    def nearest(self,lat,lon):
+        """
+        Find the nearest named place to a point.
+        @return: Three-element tuple of place name, distance (km) and azimuth (degrees) from
+        the place to the point, or None if the index is empty.
+        """
+        if not self.nplaces:
+            return None
+        row,col = self._getCell(lat,lon)
+        best = None
+        maxradius = max(self.nrows,self.ncols/2+1)
+        for radius in range(0,maxradius+1):
+            for cell in self._getRing(row,col,radius):
+                for plat,plon,name in self.cells.get(cell,[]):
+                    dist = getDistance(lat,lon,plat,plon)
+                    if best is None or dist < best[0]:
+                        best = (dist,plat,plon,name)
+            if best is not None:
+                #anything in the next ring is at least radius cells away - a degree of
+                #longitude is shortest at the highest latitude those cells can reach
+                maxlat = min(90.0,abs(lat)+(radius+1)*self.gridsize)
+                mindist = radius*self.gridsize*KM_PER_DEGREE*math.cos(math.radians(maxlat))
+                if best[0] <= mindist:
+                    break
+        dist,plat,plon,name = best
+        return (name,dist,getAzimuth(plat,plon,lat,lon))
+
+    def describe(self,lat,lon):
+        """
+        Describe a point relative to the nearest named place, ('47km SSW of Kokopo, Papua New Guinea').
+        """
+        place = self.nearest(lat,lon)
+        if place is None:
+            return '%.4f,%.4f' % (lat,lon)
+        name,dist,azimuth = place
+        if dist < 1.0:
+            return name
+        direction = COMPASS[int((azimuth+11.25)/22.5) % 16]
+        return '%ikm %s of %s' % (int(round(dist)),direction,name)
+
+class FeedClient(object):
+    """
+    Fetch event places from the USGS detail feed, keeping idle HTTPS connections open
+    so that later lookups (the rest of a batch) skip the TCP and TLS handshakes.
+    Safe to share between threads.
+    """
+    def __init__(self,host=DETAIL_HOST,maxidle=4):
+        self.host = host
+        self.maxidle = maxidle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _getConnection(self,timeout):
+        self.lock.acquire()
+        try:
+            if len(self.idle):
+                conn = self.idle.pop()
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return (conn,True)
+        finally:
+            self.lock.release()
+        return (httplib.HTTPSConnection(self.host,timeout=timeout),False)
+
+    def _releaseConnection(self,conn):
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.maxidle:
+                self.idle.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def getPlace(self,eventid,timeout=DEFAULT_TIMEOUT):
+        """
+        @return: The feed's place string for eventid.
+        @raise Exception: When the feed can't be reached or doesn't know the event.
+        """
+        path = DETAIL_PATH % eventid
+        while True:
+            conn,reused = self._getConnection(timeout)
+            try:
+                conn.request('GET',path)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException,socket.error),msg:
+                conn.close()
+                if not reused:
+                    raise Exception,'Could not reach %s: %s' % (self.host,str(msg))
+                #the server closed an idle connection - try again on a fresh one
+        if response.status != 200:
+            conn.close()
+            raise Exception,'%s returned status %i for %s' % (self.host,response.status,eventid)
+        if response.getheader('connection','').lower() == 'close':
+            conn.close()
+        else:
+            self._releaseConnection(conn)
+        return json.loads(data)['properties']['place']
+
+class LocationLookup(object):
+    """
+    Look up an event's place in the background, so the request overlaps other work.
+    get() waits no longer than timeout seconds after the lookup was started, then falls
+    back to the offline place index.
+    """
+    def __init__(self,eventid,cache=None,client=None,timeout=DEFAULT_TIMEOUT,offline=False):
+        self.eventid = eventid
+        self.cache = cache
+        self.client = client
+        self.timeout = timeout
+        self.deadline = time.time()+timeout
+        self.place = None
+        self.done = threading.Event()
+        if cache is not None:
+            self.place = cache.get(eventid)
+        if self.place is not None or offline:
+            self.done.set()
+            return
+        if self.client is None:
+            self.client = getFeedClient()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True #don't let a hung request keep the program alive
+        thread.start()
+
+    def _run(self):
+        try:
+            place = self.client.getPlace(self.eventid,self.timeout)
+            if self.cache is not None:
+                self.cache.put(self.eventid,place)
+            self.place = place
+        except Exception:
+            pass
+        finally:
+            self.done.set()
+
+    def get(self,lat,lon):
+        """
+        @return: The feed's place string for the event or, if it isn't available by the
+        deadline, a description from the offline place index.
+        """
+        remaining = self.deadline - time.time()
+        if remaining > 0:
+            self.done.wait(remaining)
+        if self.place is not None:
+            return self.place
+        #an offline description isn't cached, so the feed gets another chance next time
+        return getPlaceIndex().describe(lat,lon)
+
+_feedclient = None
+_placeindex = None
+
+def getFeedClient():
+    """
+    Get the feed client shared by every lookup in this process.
+    """
+    global _feedclient
+    if _feedclient is None:
+        _feedclient = FeedClient()
+    return _feedclient
+
+def getPlaceIndex():
+    """
+    Get the index over the bundled place table, loading it the first time it is needed.
+    """
+    global _placeindex
+    if _placeindex is None:
+        _placeindex = PlaceIndex()
+    return _placeindex
+
+if __name__ == '__main__':
+    index = getPlaceIndex()
+    for lat,lon in [(-4.8812,152.5964),(38.297,142.373),(-36.122,-72.898),(28.2305,84.7314)]:
+        t1 = time.time()
+        place = index.describe(lat,lon)
+        t2 = time.time()
+        print '%.4f,%.4f: %s (%i microseconds)' % (lat,lon,place,int((t2-t1)*1e6))
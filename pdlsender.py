@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import sys
+import os
+import os.path
+import json
+import time
+import select
+import signal
+import threading
+import traceback
+import Queue
+import subprocess
+
+#how long (seconds) a long-lived sender process gets to answer for one product
+DEFAULT_TIMEOUT = 600.0
+
+class CommandTransport(object):
+    """
+    Send each product by running its PDL command line (java -jar ProductClient.jar ...)
+    in a new process.  This is the default, and behaves exactly like sending by hand.
+    """
+    def start(self):
+        pass
+
+    def send(self,product):
+        """
+        Send one product.
+        @param product: Product dictionary (see ffault.makeProduct()), containing at least 'cmd'.
+        @return: Two-element tuple containing a boolean indicating success or failure,
+        and the output from the sender.
+        """
+        proc = subprocess.Popen(product['cmd'],
+                                shell=True,
+                                stdout=subprocess.PIPE,
+                                )
+        output = proc.communicate()[0]
+        return (proc.returncode == 0,output)
+
+    def stop(self):
+        pass
+
+class ProcessTransport(object):
+    """
+    Send products through one long-lived process, so that JVM startup and key loading
+    happen once per session instead of once per product.
+
+    The process is started with cmd and is handed one product per line on its stdin, as a
+    JSON object (the product dictionary).  For each product it must write back one line of
+    JSON on stdout: {"code": "<product code>", "success": true|false, "output": "..."}.
+    Any other lines (log messages, replies for other products) are skipped.  A process that
+    doesn't answer within timeout seconds is killed, and started again for the next product.
+    Running this module as a script starts a local stand-in that speaks the same protocol
+    without contacting PDL.
+    """
+    def __init__(self,cmd,timeout=DEFAULT_TIMEOUT):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.proc = None
+        self.buffer = ''
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd,
+                                     shell=True,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     preexec_fn=os.setsid, #own process group, so _kill() gets the shell's children too
+                                     )
+        self.buffer = ''
+
+    def _readLine(self,deadline):
+        #next line from the process, '' at end of file, or None if the deadline passes first
+        fd = self.proc.stdout.fileno()
+        while '\n' not in self.buffer:
+            remaining = deadline-time.time()
+            if remaining <= 0:
+                return None
+            readable,writable,exceptional = select.select([fd],[],[],remaining)
+            if not len(readable):
+                continue
+            data = os.read(fd,4096)
+            if not len(data):
+                line = self.buffer
+                self.buffer = ''
+                return line
+            self.buffer += data
+        line,self.buffer = self.buffer.split('\n',1)
+        return line+'\n'
+
+    def _kill(self):
+        try:
+            os.killpg(self.proc.pid,signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+    def send(self,product):
+        if self.proc is None or self.proc.poll() is not None:
+            #the sender went away (or was never started) - give it one fresh start
+            self.start()
+        try:
+            self.proc.stdin.write(json.dumps(product)+'\n')
+            self.proc.stdin.flush()
+        except IOError,msg:
+            return (False,'Sender process "%s" failed: %s' % (self.cmd,str(msg)))
+        code = product.get('code')
+        deadline = time.time()+self.timeout
+        skipped = []
+        while True:
+            line = self._readLine(deadline)
+            if line is None:
+                self._kill()
+                return (False,'Sender process "%s" did not answer for %s within %.0f seconds' % (self.cmd,code,self.timeout))
+            if not len(line):
+                return (False,'Sender process "%s" exited with code %s' % (self.cmd,self.proc.poll()))
+            try:
+                reply = json.loads(line)
+            except ValueError:
+                reply = None
+            if not isinstance(reply,dict) or reply.get('code') != code:
+                skipped.append(line.strip())
+                continue
+            output = reply.get('output','')
+            if len(skipped):
+                output = '\n'.join(skipped+[output])
+            return (bool(reply.get('success',False)),output)
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+class PDLSender(object):
+    """
+    Long-lived sender that feeds products to a transport from a queue, one at a time,
+    on a background thread.  Usage:
+
+    sender = PDLSender(ProcessTransport('java -cp ... MySender'))
+    sender.start()
+    sender.submit(product1,callback)
+    success,output = sender.send(product2) #blocks until product2 has been sent
+    results = sender.stop() #waits for the queue to drain
+    """
+    def __init__(self,transport=None):
+        if transport is None:
+            transport = CommandTransport()
+        self.transport = transport
+        self.queue = Queue.Queue()
+        self.results = []
+        self.thread = None
+
+    def start(self):
+        self.transport.start()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            product,callback = item
+            try:
+                success,output = self.transport.send(product)
+            except Exception,msg:
+                success,output = (False,'Sender failed: %s' % str(msg))
+            result = {'code':product.get('code'),'success':success,'output':output}
+            self.results.append(result)
+            if callback is not None:
+                #a failing callback mustn't stop the products behind it from being sent
+                try:
+                    callback(product,result)
+                except Exception:
+                    traceback.print_exc()
+
+    def submit(self,product,callback=None):
+        """
+        Queue a product for sending.
+        @param product: Product dictionary (see ffault.makeProduct()).
+        @param callback: Optional function called as callback(product,result) once the product
+        has been sent, where result is a dictionary with keys code, success and output.
+        """
+        if self.thread is None:
+            raise Exception,'PDLSender must be started before products are submitted.'
+        self.queue.put((product,callback))
+
+    def send(self,product):
+        """
+        Queue a product and wait until it has been sent.
+        @return: Two-element tuple containing a boolean indicating success or failure,
+        and the output from the transport.
+        """
+        done = threading.Event()
+        holder = []
+        def callback(product,result):
+            holder.append(result)
+            done.set()
+        self.submit(product,callback)
+        #wait() without a timeout can't be interrupted with Ctrl-C in Python 2
+        while not done.wait(1.0):
+            if self.thread is None or not self.thread.is_alive():
+                break
+        if not len(holder):
+            return (False,'Sender thread stopped before %s was sent' % product.get('code'))
+        return (holder[0]['success'],holder[0]['output'])
+
+    def stop(self):
+        """
+        Send everything still in the queue, then shut down the transport.
+        @return: List of result dictionaries (code, success, output), in the order sent.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            while self.thread.is_alive():
+                self.thread.join(1.0)
+            self.thread = None
+        self.transport.stop()
+        return self.results
+
+def getTransport(cmd=None):
+    """
+    Choose a transport.
+    @param cmd: Command line for a long-lived sender process, or None to run
+    the PDL command line for every product.
+    """
+    if cmd is None:
+        return CommandTransport()
+    return ProcessTransport(cmd)
+
+if __name__ == '__main__':
+    #stand-in for a real long-lived sender: acknowledge each product without contacting PDL
+    for line in iter(sys.stdin.readline,''):
+        product = json.loads(line)
+        directory = product.get('directory','')
+        if os.path.isdir(directory):
+            reply = {'code':product.get('code'),'success':True,'output':'Received %s from %s' % (product.get('code'),directory)}
+        else:
+            reply = {'code':product.get('code'),'success':False,'output':'No such product directory %s' % directory}
+        sys.stdout.write(json.dumps(reply)+'\n')
+        sys.stdout.flush()
@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os.path
+import sys
+import struct
+import zlib
+import math
+import time
+import thread
+
+#third party imports (optional - everything here also works without PIL or numpy, just more slowly)
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+#local imports
+from staging import hashFile,copyFile
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+#PNG color type -> (mode,number of channels)
+COLOR_TYPES = {0:('L',1),
+               2:('RGB',3),
+               3:('P',1),
+               4:('LA',2),
+               6:('RGBA',4)}
+
+MODE_TYPES = {'L':0,'RGB':2,'LA':4,'RGBA':6}
+
+#chunks that don't affect how an image looks, and are dropped when recompressing
+METADATA_CHUNKS = ['tEXt','zTXt','iTXt','tIME']
+
+#zlib strategies to try when recompressing
+ZLIB_STRATEGIES = [zlib.Z_DEFAULT_STRATEGY,zlib.Z_FILTERED]
+
+def readChunks(data):
+    """
+    Split the contents of a PNG file into chunks.
+    @return: List of (chunk type,chunk data) tuples, in file order.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise Exception,'Not a PNG file.'
+    chunks = []
+    pos = len(PNG_SIGNATURE)
+    while pos+8 <= len(data):
+        length,ctype = struct.unpack('>I4s',data[pos:pos+8])
+        chunks.append((ctype,data[pos+8:pos+8+length]))
+        pos += 12+length
+        if ctype == 'IEND':
+            break
+    return chunks
+
+def makeChunk(ctype,data):
+    crc = zlib.crc32(ctype+data) & 0xffffffff
+    return struct.pack('>I4s',len(data),ctype) + data + struct.pack('>I',crc)
+
+def unfilterRows(data,height,stride,bpp):
+    """
+    Undo the per-row PNG filters.
+    @param data: Decompressed image data (one filter type byte in front of each row).
+    @param height: Number of rows.
+    @param stride: Number of bytes in each row (not counting the filter type byte).
+    @param bpp: Number of bytes per complete pixel (at least 1).
+    @return: List of bytearrays, one per row.
+    """
+    rows = []
+    prev = bytearray(stride)
+    pos = 0
+    for y in range(0,height):
+        ftype = data[pos]
+        line = bytearray(data[pos+1:pos+1+stride])
+        pos += stride+1
+        if ftype == 1 and np is not None and stride % bpp == 0: #sub, as a running sum of each sample
+            samples = np.frombuffer(str(line),dtype=np.uint8).reshape((stride/bpp,bpp))
+            line = bytearray(np.cumsum(samples,axis=0,dtype=np.uint8).tostring())
+        elif ftype == 1: #sub
+            for i in range(bpp,stride):
+                line[i] = (line[i]+line[i-bpp]) & 255
+        elif ftype == 2 and np is not None: #up
+            line = bytearray((np.frombuffer(str(line),dtype=np.uint8)+np.frombuffer(str(prev),dtype=np.uint8)).tostring())
+        elif ftype == 2: #up
+            line = bytearray([(a+b) & 255 for a,b in zip(line,prev)])
+        elif ftype == 3: #average
+            for i in range(0,stride):
+                if i >= bpp:
+                    left = line[i-bpp]
+                else:
+                    left = 0
+                line[i] = (line[i]+((left+prev[i]) >> 1)) & 255
+        elif ftype == 4: #paeth
+            for i in range(0,stride):
+                if i >= bpp:
+                    a = line[i-bpp]
+                    c = prev[i-bpp]
+                else:
+                    a = 0
+                    c = 0
+                b = prev[i]
+                p = a+b-c
+                pa = abs(p-a)
+                pb = abs(p-b)
+                pc = abs(p-c)
+                if pa <= pb and pa <= pc:
+                    pred = a
+                elif pb <= pc:
+                    pred = b
+                else:
+                    pred = c
+                line[i] = (line[i]+pred) & 255
+        elif ftype != 0:
+            raise Exception,'Unknown PNG filter type %i.' % ftype
+        rows.append(line)
+        prev = line
+    return rows
+
+def _unpackBits(line,width,bitdepth):
+    #samples of less than 8 bits, most significant bits first
+    samples = bytearray(width)
+    perbyte = 8/bitdepth
+    mask = (1 << bitdepth)-1
+    for x in range(0,width):
+        byte = line[x/perbyte]
+        shift = 8-bitdepth*(x % perbyte+1)
+        samples[x] = (byte >> shift) & mask
+    return samples
+
+def readPNG(filename):
+    """
+    Decode a PNG file into 8 bit samples.
+    @param filename: PNG file (any bit depth or color type, but not interlaced).
+    @return: Four-element tuple containing width, height, mode ('L','LA','RGB','RGBA') and a list of
+    bytearrays, one per row, holding the interleaved samples.
+    """
+    data = open(filename,'rb').read()
+    header = None
+    palette = None
+    transparency = None
+    idat = []
+    for ctype,cdata in readChunks(data):
+        if ctype == 'IHDR':
+            header = struct.unpack('>IIBBBBB',cdata)
+        elif ctype == 'PLTE':
+            palette = bytearray(cdata)
+        elif ctype == 'tRNS':
+            transparency = bytearray(cdata)
+        elif ctype == 'IDAT':
+            idat.append(cdata)
+    if header is None:
+        raise Exception,'%s has no PNG header.' % filename
+    width,height,bitdepth,colortype,compression,pngfilter,interlace = header
+    if interlace:
+        raise Exception,'%s is interlaced, which is not supported.' % filename
+    if colortype not in COLOR_TYPES:
+        raise Exception,'%s has unknown PNG color type %i.' % (filename,colortype)
+    mode,nchannels = COLOR_TYPES[colortype]
+    bitsperpixel = nchannels*bitdepth
+    stride = (width*bitsperpixel+7)/8
+    bpp = max(1,bitsperpixel/8)
+    rows = unfilterRows(bytearray(zlib.decompress(''.join(idat))),height,stride,bpp)
+    if bitdepth == 16:
+        rows = [line[0::2] for line in rows] #keep the most significant byte
+    elif bitdepth < 8:
+        rows = [_unpackBits(line,width,bitdepth) for line in rows]
+        if colortype == 0:
+            scale = 255/((1 << bitdepth)-1)
+            rows = [bytearray([sample*scale for sample in line]) for line in rows]
+    if colortype == 3:
+        if palette is None:
+            raise Exception,'%s has no palette.' % filename
+        colors = [palette[i*3:i*3+3] for i in range(0,len(palette)/3)]
+        if transparency is not None:
+            mode = 'RGBA'
+            for i in range(0,len(colors)):
+                if i < len(transparency):
+                    colors[i] = colors[i]+transparency[i:i+1]
+                else:
+                    colors[i] = colors[i]+bytearray([255])
+        else:
+            mode = 'RGB'
+        rows = [bytearray().join([colors[index] for index in line]) for line in rows]
+    return (width,height,mode,rows)
+
+def writePNG(filename,width,height,mode,rows,level=9):
+    """
+    Encode 8 bit samples as a PNG file.
+    @param mode: One of 'L','LA','RGB' or 'RGBA'.
+    @param rows: List of bytearrays (or strings), one per row, of interleaved samples.
+    @param level: zlib compression level.
+    """
+    header = struct.pack('>IIBBBBB',width,height,8,MODE_TYPES[mode],0,0,0)
+    raw = ''.join(['\x00'+str(line) for line in rows])
+    f = open(filename,'wb')
+    f.write(PNG_SIGNATURE)
+    f.write(makeChunk('IHDR',header))
+    f.write(makeChunk('IDAT',zlib.compress(raw,level)))
+    f.write(makeChunk('IEND',''))
+    f.close()
+
+def _getWeights(srcsize,dstsize):
+    #for each output pixel, the (source pixel,weight) pairs it averages over (a box filter)
+    scale = srcsize/float(dstsize)
+    weights = []
+    for i in range(0,dstsize):
+        start = i*scale
+        end = start+scale
+        pairs = []
+        for j in range(int(start),min(srcsize,int(math.ceil(end)))):
+            overlap = min(end,j+1)-max(start,j)
+            if overlap > 0:
+                pairs.append((j,overlap/scale))
+        weights.append(pairs)
+    return weights
+
+def _resizeAxis(image,axis,newsize):
+    #area average a numpy array along one axis, summing over the few source pixels at a time
+    #that each output pixel covers (padded with zero weights) rather than over the whole axis
+    weights = _getWeights(image.shape[axis],newsize)
+    npairs = max([len(pairs) for pairs in weights])
+    indices = np.zeros((npairs,newsize),dtype=np.intp)
+    factors = np.zeros((npairs,newsize))
+    for i,pairs in enumerate(weights):
+        for k,(j,weight) in enumerate(pairs):
+            indices[k,i] = j
+            factors[k,i] = weight
+    shape = [1]*image.ndim
+    shape[axis] = newsize
+    result = 0.0
+    for k in range(0,npairs):
+        result = result+np.take(image,indices[k],axis=axis)*factors[k].reshape(shape)
+    return result
+
+def resizeRows(rows,width,height,nchannels,newwidth,newheight):
+    """
+    Resize an image by area averaging, which is what shrinking plots and maps needs.
+    Uses numpy when it is installed.
+    @return: List of bytearrays, one per row of the resized image.
+    """
+    if np is not None:
+        image = np.frombuffer(''.join([str(line) for line in rows]),dtype=np.uint8)
+        image = image.reshape((height,width,nchannels)).astype(np.float64)
+        image = _resizeAxis(_resizeAxis(image,0,newheight),1,newwidth)
+        image = np.minimum(np.floor(image+0.5),255).astype(np.uint8).reshape((newheight,newwidth*nchannels))
+        return [bytearray(line.tostring()) for line in image]
+    #rows first, so that the slower per-pixel pass works on the smaller image
+    tmprows = []
+    for pairs in _getWeights(height,newheight):
+        acc = [0.0]*(width*nchannels)
+        for j,weight in pairs:
+            acc = [a+weight*v for a,v in zip(acc,rows[j])]
+        tmprows.append(acc)
+    colweights = _getWeights(width,newwidth)
+    newrows = []
+    for acc in tmprows:
+        line = bytearray(newwidth*nchannels)
+        pos = 0
+        for pairs in colweights:
+            for c in range(0,nchannels):
+                value = 0.0
+                for j,weight in pairs:
+                    value += weight*acc[j*nchannels+c]
+                line[pos] = min(255,int(value+0.5))
+                pos += 1
+        newrows.append(line)
+    return newrows
+
+def getResizedHeight(width,height,newwidth):
+    #keep the aspect ratio, like convert -resize WIDTHx
+    return max(1,int(round(height*newwidth/float(width))))
+
+def resizePNG(infile,outfile,newwidth):
+    """
+    Write a copy of a PNG file resized to newwidth pixels wide, keeping the aspect ratio.
+    Uses PIL when it is installed, and the (slower) decoder, resizer and encoder in this module
+    otherwise, all in process.
+    """
+    if Image is not None:
+        image = Image.open(infile)
+        width,height = image.size
+        newheight = getResizedHeight(width,height,newwidth)
+        image.resize((newwidth,newheight),Image.ANTIALIAS).save(outfile,'PNG')
+        return
+    width,height,mode,rows = readPNG(infile)
+    newheight = getResizedHeight(width,height,newwidth)
+    rows = resizeRows(rows,width,height,len(mode),newwidth,newheight)
+    writePNG(outfile,newwidth,newheight,mode,rows)
+
+def filterRows(rows,bpp):
+    """
+    Filter image rows for compression, choosing none, sub or up for each row by the usual
+    minimum sum of absolute differences rule.
+    @param rows: List of bytearrays, one per row (as returned by unfilterRows()).
+    @param bpp: Number of bytes per complete pixel (at least 1).
+    @return: String of filtered data, ready to be compressed.
+    """
+    parts = []
+    prev = bytearray(len(rows[0]))
+    for line in rows:
+        left = bytearray(bpp)+line[:-bpp]
+        best = None
+        for ftype,filtered in [(0,line),
+                               (1,bytearray([(a-b) & 255 for a,b in zip(line,left)])),
+                               (2,bytearray([(a-b) & 255 for a,b in zip(line,prev)]))]:
+            score = sum([min(v,256-v) for v in filtered])
+            if best is None or score < best[0]:
+                best = (score,ftype,filtered)
+        parts.append(chr(best[1])+str(best[2]))
+        prev = line
+    return ''.join(parts)
+
+def _deflate(raw,level=9):
+    #smallest zlib stream for raw over the strategies worth trying
+    best = None
+    for strategy in ZLIB_STRATEGIES:
+        compressor = zlib.compressobj(level,zlib.DEFLATED,15,9,strategy)
+        compressed = compressor.compress(raw)+compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+    return best
+
+def recompressPNG(data,refilter=True):
+    """
+    Losslessly shrink a PNG file: re-deflate the image data at the highest compression level
+    (optionally after choosing new row filters), and drop metadata chunks (text and timestamps).
+    Chunks that affect how the image is displayed (palette, transparency, gamma, color profile) are kept.
+    @param data: Contents of a PNG file.
+    @param refilter: If True, also try re-filtering the rows.
+    @return: Contents of the smallest PNG file found, which may be data itself.
+    """
+    chunks = readChunks(data)
+    header = None
+    idat = []
+    for ctype,cdata in chunks:
+        if ctype == 'IHDR':
+            header = struct.unpack('>IIBBBBB',cdata)
+        elif ctype == 'IDAT':
+            idat.append(cdata)
+    if header is None or not len(idat):
+        return data
+    width,height,bitdepth,colortype,compression,pngfilter,interlace = header
+    raw = zlib.decompress(''.join(idat))
+    best = _deflate(raw)
+    if refilter and not interlace and colortype in COLOR_TYPES:
+        bitsperpixel = COLOR_TYPES[colortype][1]*bitdepth
+        stride = (width*bitsperpixel+7)/8
+        bpp = max(1,bitsperpixel/8)
+        rows = unfilterRows(bytearray(raw),height,stride,bpp)
+        compressed = _deflate(filterRows(rows,bpp))
+        if len(compressed) < len(best):
+            best = compressed
+    parts = [PNG_SIGNATURE]
+    wroteidat = False
+    for ctype,cdata in chunks:
+        if ctype in METADATA_CHUNKS:
+            continue
+        if ctype == 'IDAT':
+            if not wroteidat:
+                parts.append(makeChunk('IDAT',best))
+                wroteidat = True
+            continue
+        parts.append(makeChunk(ctype,cdata))
+    newdata = ''.join(parts)
+    if len(newdata) >= len(data):
+        return data
+    return newdata
+
+def getTempFile(filename):
+    #unique to this process and thread, as planes and images are worked on by threads of one process
+    return filename + '.%i.%i.tmp' % (os.getpid(),thread.get_ident())
+
+def optimizePNG(pngfile,cachefolder,refilter=True):
+    """
+    Replace pngfile with a losslessly recompressed copy (see recompressPNG()).  Results are kept in
+    cachefolder, keyed by the SHA1 of the original file, so each distinct image is only recompressed
+    once.  pngfile is replaced by renaming, never rewritten in place, so files it is hard linked to
+    are left alone.
+    @return: Two-element tuple containing the size of pngfile before and after.
+    """
+    oldsize = os.path.getsize(pngfile)
+    cachefile = os.path.join(cachefolder,'%s.png' % hashFile(pngfile))
+    if not os.path.isfile(cachefile):
+        if not os.path.isdir(cachefolder):
+            try:
+                os.makedirs(cachefolder)
+            except OSError:
+                pass #another process made it first
+        data = recompressPNG(open(pngfile,'rb').read(),refilter)
+        tmpfile = getTempFile(cachefile)
+        f = open(tmpfile,'wb')
+        f.write(data)
+        f.close()
+        os.rename(tmpfile,cachefile)
+    newsize = os.path.getsize(cachefile)
+    if newsize >= oldsize:
+        return (oldsize,oldsize)
+    copyFile(cachefile,pngfile)
+    return (oldsize,newsize)
+
+class ImageCache(object):
+    """
+    Resized copies of images, keyed by the SHA1 of the source image and the target width, so that an
+    image is only ever resized once.  Outputs are hard links to (or copies of) the cached images.
+    """
+    def __init__(self,folder):
+        self.folder = folder
+
+    def resize(self,sourcefile,newwidth,outfile):
+        """
+        Make outfile a copy of sourcefile resized to newwidth pixels wide.
+        @return: True if the image had to be resized, False if it was already in the cache.
+        """
+        cachefile = os.path.join(self.folder,'%s_%i.png' % (hashFile(sourcefile),newwidth))
+        resized = False
+        if not os.path.isfile(cachefile):
+            if not os.path.isdir(self.folder):
+                try:
+                    os.makedirs(self.folder)
+                except OSError:
+                    pass #another process made it first
+            tmpfile = getTempFile(cachefile)
+            try:
+                resizePNG(sourcefile,tmpfile,newwidth)
+            except:
+                if os.path.isfile(tmpfile):
+                    os.remove(tmpfile)
+                raise
+            os.rename(tmpfile,cachefile)
+            resized = True
+        copyFile(cachefile,outfile)
+        return resized
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2:
+        data = open(sys.argv[1],'rb').read()
+        t1 = time.time()
+        newdata = recompressPNG(data)
+        t2 = time.time()
+        print 'Recompressed %s from %i to %i bytes in %.2f seconds.' % (sys.argv[1],len(data),len(newdata),t2-t1)
+        sys.exit(0)
+    infile = sys.argv[1]
+    outfile = sys.argv[2]
+    newwidth = int(sys.argv[3])
+    t1 = time.time()
+    resizePNG(infile,outfile,newwidth)
+    t2 = time.time()
+    print 'Resized %s to %i pixels wide in %.2f seconds.' % (infile,newwidth,t2-t1)
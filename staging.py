@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os.path
+import json
+import hashlib
+import shutil
+import sys
+import time
+import errno
+import threading
+import ctypes
+import ctypes.util
+from multiprocessing.pool import ThreadPool
+
+#how many bytes to read at a time when hashing or copying files
+BLOCKSIZE = 1024*1024
+
+#how many files to stage at once
+MAX_THREADS = 8
+
+#hard link staged files to their sources when both are on the same filesystem.  The staged
+#file then shares its contents with the source, so this is only safe as long as the inversion
+#code replaces its output files rather than rewriting them in place.
+USE_HARDLINKS = True
+
+#blobs that no staged file links to are only pruned once they are this old (seconds), so that
+#a blob another process has just added but not yet linked isn't removed from under it
+PRUNE_AGE = 3600
+
+#Linux ioctl that makes dest share (copy-on-write) the blocks of src on btrfs, xfs, etc.
+FICLONE = 0x40049409
+
+#most bytes one sendfile() call will copy on Linux
+MAX_SENDFILE = 0x7ffff000
+
+def hashFile(filename):
+    """
+    @return: SHA1 hex digest of the contents of filename.
+    """
+    sha = hashlib.sha1()
+    f = open(filename,'rb')
+    try:
+        for block in iter(lambda: f.read(BLOCKSIZE),''):
+            sha.update(block)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+class StagingManifest(object):
+    """
+    Record of the files staged into one output folder by a previous run.  Each entry is
+    keyed by the file name in the output folder, and holds the source path, size, mtime
+    and SHA1 hash of the source file at the time it was staged.
+    """
+    def __init__(self,manifestfile):
+        self.manifestfile = manifestfile
+        self.entries = {}
+        if os.path.isfile(manifestfile):
+            try:
+                self.entries = json.load(open(manifestfile,'rt'))['files']
+            except (ValueError,KeyError):
+                self.entries = {} #a damaged manifest just means everything gets copied again
+
+    def save(self):
+        folder = os.path.dirname(self.manifestfile)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmpfile = self.manifestfile + '.%i.tmp' % os.getpid()
+        f = open(tmpfile,'wt')
+        json.dump({'files':self.entries},f,indent=1,sort_keys=True)
+        f.close()
+        os.rename(tmpfile,self.manifestfile)
+
+def _link(sourcefile,tmpfile):
+    os.link(sourcefile,tmpfile)
+
+def _reflink(sourcefile,tmpfile):
+    import fcntl
+    src = open(sourcefile,'rb')
+    try:
+        dst = open(tmpfile,'wb')
+        try:
+            fcntl.ioctl(dst.fileno(),FICLONE,src.fileno())
+        finally:
+            dst.close()
+    except:
+        src.close()
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+        raise
+    src.close()
+
+_libc = [] #the C library (or None if it can't be loaded), once getLibc() has looked for it
+
+def getLibc():
+    """
+    @return: The C library through ctypes, with copy_file_range() and sendfile() set up where it
+    has them, or None if it can't be loaded.  Python 2's os module has neither of those calls.
+    """
+    if not len(_libc):
+        libc = None
+        libname = ctypes.util.find_library('c')
+        if libname is not None and sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(libname,use_errno=True)
+            except OSError:
+                pass
+        if libc is not None:
+            if hasattr(libc,'copy_file_range'):
+                libc.copy_file_range.argtypes = [ctypes.c_int,ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,
+                                                 ctypes.c_size_t,ctypes.c_uint]
+                libc.copy_file_range.restype = ctypes.c_ssize_t
+            if hasattr(libc,'sendfile'):
+                libc.sendfile.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t]
+                libc.sendfile.restype = ctypes.c_ssize_t
+        _libc.append(libc)
+    return _libc[0]
+
+def _kernelCopy(sourcefile,tmpfile,copyblock):
+    #copy with copyblock(srcfd,dstfd,nbytes), which moves up to nbytes from the current
+    #position of srcfd to that of dstfd inside the kernel, returning the number moved or -1
+    src = open(sourcefile,'rb')
+    dst = open(tmpfile,'wb')
+    try:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            ncopied = copyblock(src.fileno(),dst.fileno(),remaining)
+            if ncopied < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                raise OSError,(err,os.strerror(err))
+            if ncopied == 0:
+                break
+            remaining -= ncopied
+    finally:
+        src.close()
+        dst.close()
+
+def _copyFileRange(sourcefile,tmpfile):
+    #copy_file_range() lets the filesystem copy (or share) the blocks itself (Linux 4.5+, glibc 2.27+)
+    libc = getLibc()
+    _kernelCopy(sourcefile,tmpfile,lambda srcfd,dstfd,nbytes: libc.copy_file_range(srcfd,None,dstfd,None,nbytes,0))
+
+def _sendfile(sourcefile,tmpfile):
+    #sendfile() copies inside the kernel, without passing the data through Python (Linux 2.6.33+)
+    libc = getLibc()
+    _kernelCopy(sourcefile,tmpfile,lambda srcfd,dstfd,nbytes: libc.sendfile(dstfd,srcfd,None,min(nbytes,MAX_SENDFILE)))
+
+def _copy(sourcefile,tmpfile):
+    src = open(sourcefile,'rb')
+    dst = open(tmpfile,'wb')
+    try:
+        shutil.copyfileobj(src,dst,BLOCKSIZE)
+    finally:
+        src.close()
+        dst.close()
+
+def getCopyMethods():
+    methods = []
+    if USE_HARDLINKS and hasattr(os,'link'):
+        methods.append(('hardlink',_link))
+    if sys.platform.startswith('linux'):
+        methods.append(('reflink',_reflink))
+    libc = getLibc()
+    if libc is not None and hasattr(libc,'copy_file_range'):
+        methods.append(('copy_file_range',_copyFileRange))
+    if libc is not None and hasattr(libc,'sendfile'):
+        methods.append(('sendfile',_sendfile))
+    methods.append(('copy',_copy))
+    return methods
+
+def copyFile(sourcefile,destfile):
+    """
+    Stage sourcefile as destfile using the cheapest method that works: a hard link, a
+    reflink (copy-on-write clone), an in-kernel copy_file_range or sendfile copy, or a plain copy.  The file
+    is written under a temporary name and renamed, so destfile is replaced atomically
+    and never seen half-written.
+    @return: Name of the method that was used ('hardlink','reflink','copy_file_range','sendfile','copy').
+    """
+    tmpfile = os.path.join(os.path.dirname(destfile),'.%s.%i.tmp' % (os.path.basename(destfile),os.getpid()))
+    if os.path.lexists(tmpfile):
+        #left over from an interrupted run - it may be a link to some other file, so never write into it
+        os.remove(tmpfile)
+    for name,method in getCopyMethods():
+        try:
+            method(sourcefile,tmpfile)
+        except (OSError,IOError):
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            if name == 'copy':
+                raise
+            continue
+        break
+    if name != 'hardlink':
+        shutil.copymode(sourcefile,tmpfile)
+    os.rename(tmpfile,destfile)
+    if os.path.lexists(tmpfile):
+        #rename() does nothing when both names are already links to the same file
+        os.remove(tmpfile)
+    return name
+
+def copyFiles(sourcefiles,outputfolder,nthreads=MAX_THREADS):
+    """
+    Stage many files into outputfolder at once with copyFile().
+    @return: Dictionary of output file name -> method used.
+    """
+    def stage(sourcefile):
+        name = os.path.basename(sourcefile)
+        return (name,copyFile(sourcefile,os.path.join(outputfolder,name)))
+    return dict(runThreads(stage,sourcefiles,nthreads))
+
+#one pool of MAX_THREADS threads per process, made the first time it is needed (see getPool())
+_pool = None
+_poolpid = None
+_poollock = threading.Lock()
+
+def getPool():
+    #starting and stopping a pool costs about as much as staging a plane, so keep one around
+    global _pool,_poolpid
+    _poollock.acquire()
+    try:
+        if _pool is None or _poolpid != os.getpid(): #a forked child can't use its parent's threads
+            _pool = ThreadPool(MAX_THREADS)
+            _poolpid = os.getpid()
+        return _pool
+    finally:
+        _poollock.release()
+
+def runThreads(function,items,nthreads=MAX_THREADS):
+    #run function over items on a bounded pool of threads, returning the results in order
+    if len(items) < 2 or nthreads < 2:
+        return [function(item) for item in items]
+    if nthreads >= MAX_THREADS:
+        return getPool().map(function,items)
+    pool = ThreadPool(min(nthreads,len(items)))
+    try:
+        return pool.map(function,items)
+    finally:
+        pool.close()
+        pool.join()
+
+class BlobStore(object):
+    """
+    Content-addressed store of staged files.  Each distinct file is kept once, as
+    folder/ab/abcdef... (its SHA1 hash), and staged files are hard links to it, so files
+    that are identical across planes and events take up space (and copy time) only once.
+    """
+    def __init__(self,folder):
+        self.folder = folder
+
+    def getPath(self,sha1):
+        return os.path.join(self.folder,sha1[0:2],sha1)
+
+    def add(self,sourcefile):
+        """
+        Copy sourcefile into the store, hashing it in the same pass, so it is only read once.
+        If the store already has it, the copy is dropped and the blob's mtime is refreshed
+        instead, so that prune() leaves it alone until it has been linked.
+        @return: SHA1 hex digest of sourcefile, which is also its key in the store.
+        """
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                pass #another thread or process made it first
+        tmpfile = os.path.join(self.folder,'.%i.%i.tmp' % (os.getpid(),id(sourcefile)))
+        sha = hashlib.sha1()
+        src = open(sourcefile,'rb')
+        dst = open(tmpfile,'wb')
+        try:
+            for block in iter(lambda: src.read(BLOCKSIZE),''):
+                sha.update(block)
+                dst.write(block)
+        except:
+            dst.close()
+            os.remove(tmpfile)
+            raise
+        finally:
+            src.close()
+            dst.close()
+        sha1 = sha.hexdigest()
+        blobfile = self.getPath(sha1)
+        if os.path.isfile(blobfile):
+            try:
+                os.utime(blobfile,None)
+                os.remove(tmpfile) #already have it
+                return sha1
+            except OSError:
+                pass #pruned since we looked - put this copy in its place
+        shutil.copymode(sourcefile,tmpfile)
+        blobfolder = os.path.dirname(blobfile)
+        if not os.path.isdir(blobfolder):
+            try:
+                os.makedirs(blobfolder)
+            except OSError:
+                pass
+        os.rename(tmpfile,blobfile)
+        return sha1
+
+    def link(self,sha1,destfile):
+        """
+        Stage the blob sha1 as destfile (see copyFile()).
+        @return: Name of the method that was used.
+        """
+        return copyFile(self.getPath(sha1),destfile)
+
+    def prune(self,minage=PRUNE_AGE):
+        """
+        Remove blobs that no staged file links to any more.
+        @return: Two-element tuple of the number of blobs removed and the bytes freed.
+        """
+        nremoved = 0
+        nbytes = 0
+        if not os.path.isdir(self.folder):
+            return (nremoved,nbytes)
+        now = time.time()
+        for blobfolder in os.listdir(self.folder):
+            blobfolder = os.path.join(self.folder,blobfolder)
+            if not os.path.isdir(blobfolder):
+                continue
+            for blobfile in os.listdir(blobfolder):
+                blobfile = os.path.join(blobfolder,blobfile)
+                try:
+                    stat = os.stat(blobfile)
+                    if stat.st_nlink > 1 or now - stat.st_mtime < minage:
+                        continue
+                    os.remove(blobfile)
+                except OSError:
+                    continue
+                nremoved += 1
+                nbytes += stat.st_size
+        return (nremoved,nbytes)
+
+def isUnchanged(entry,sourcefile,stat,destfile):
+    #quick check on path, size and mtime - no need to read the file
+    if entry is None or not os.path.isfile(destfile):
+        return False
+    return entry['source'] == sourcefile and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+def checkStaged(sourcefiles,outputfolder,manifestfile):
+    """
+    Check that an output folder still holds what stageFiles() put there, and that the source
+    files haven't changed since.  Sources whose size or mtime differ from the manifest are hashed.
+    @return: List of strings describing each problem found (empty if there are none).
+    """
+    if not os.path.isfile(manifestfile):
+        return ['%s has no staging manifest (%s)' % (outputfolder,manifestfile)]
+    entries = StagingManifest(manifestfile).entries
+    problems = []
+    names = set([os.path.basename(sourcefile) for sourcefile in sourcefiles])
+    for name in sorted(names - set(entries.keys())):
+        problems.append('%s has been added since %s was staged' % (name,outputfolder))
+    for name in sorted(entries.keys()):
+        entry = entries[name]
+        sourcefile = entry['source']
+        if name not in names or not os.path.isfile(sourcefile):
+            problems.append('%s has been removed since %s was staged' % (sourcefile,outputfolder))
+            continue
+        destfile = os.path.join(outputfolder,name)
+        if not os.path.isfile(destfile):
+            problems.append('%s is missing' % destfile)
+            continue
+        stat = os.stat(sourcefile)
+        if isUnchanged(entry,sourcefile,stat,destfile):
+            continue
+        if hashFile(sourcefile) != entry['sha1']:
+            problems.append('%s has changed since %s was staged' % (sourcefile,outputfolder))
+    return problems
+
+def stageFiles(sourcefiles,outputfolder,manifestfile,nthreads=MAX_THREADS,blobstore=None):
+    """
+    Copy files into an output folder, skipping files that haven't changed since the
+    last run, and removing files that the last run staged but that are no longer in sourcefiles.
+    A file counts as changed when its size or mtime differ from the manifest and its
+    contents hash differently.  Files that fail the quick size and mtime check are hashed and
+    copied (see copyFile()) on up to nthreads threads at once.
+    @param sourcefiles: List of files to stage.
+    @param outputfolder: Folder to stage them into.
+    @param manifestfile: JSON file recording what was staged (created or updated).
+    @param blobstore: Optional BlobStore.  If given, changed files are added to the store
+    (see BlobStore.add()), and staged as links to their blobs.
+    @return: Dictionary with lists of output file names that were 'copied', 'unchanged' and 'removed',
+    and 'methods', a dictionary of output file name -> method used to copy it.
+    """
+    manifest = StagingManifest(manifestfile)
+    oldentries = manifest.entries
+    newentries = {}
+    summary = {'copied':[],'unchanged':[],'removed':[],'methods':{}}
+    uniquefiles = []
+    names = set()
+    for sourcefile in sourcefiles:
+        name = os.path.basename(sourcefile)
+        if name not in names:
+            names.add(name)
+            uniquefiles.append(sourcefile)
+
+    def stage(job):
+        sourcefile,stat = job
+        name = os.path.basename(sourcefile)
+        destfile = os.path.join(outputfolder,name)
+        entry = oldentries.get(name)
+        if blobstore is not None:
+            sha1 = blobstore.add(sourcefile)
+        else:
+            sha1 = hashFile(sourcefile)
+        newentry = {'source':sourcefile,
+                    'size':stat.st_size,
+                    'mtime':stat.st_mtime,
+                    'sha1':sha1}
+        if entry is not None and entry['sha1'] == sha1 and os.path.isfile(destfile):
+            #touched, but not changed
+            newentry['method'] = entry.get('method')
+            return (name,newentry,None)
+        if blobstore is not None:
+            method = blobstore.link(sha1,destfile)
+        else:
+            method = copyFile(sourcefile,destfile)
+        newentry['method'] = method
+        return (name,newentry,method)
+
+    #the quick unchanged checks are done here, and only files that need reading go to the threads
+    changedfiles = []
+    for sourcefile in uniquefiles:
+        name = os.path.basename(sourcefile)
+        stat = os.stat(sourcefile)
+        entry = oldentries.get(name)
+        if isUnchanged(entry,sourcefile,stat,os.path.join(outputfolder,name)):
+            newentries[name] = entry
+            summary['unchanged'].append(name)
+        else:
+            changedfiles.append((sourcefile,stat))
+    for name,entry,method in runThreads(stage,changedfiles,nthreads):
+        newentries[name] = entry
+        if method is None:
+            summary['unchanged'].append(name)
+        else:
+            summary['copied'].append(name)
+            summary['methods'][name] = method
+    for name in oldentries:
+        if name in newentries:
+            continue
+        destfile = os.path.join(outputfolder,name)
+        if os.path.isfile(destfile):
+            os.remove(destfile)
+        summary['removed'].append(name)
+    manifest.entries = newentries
+    manifest.save()
+    return summary
@@ -1,53 +1,436 @@
 #!/usr/bin/env python
 
-from xml.dom import minidom
-import copy
+import re
+import xml.sax
+from xml.sax.handler import ContentHandler,property_lexical_handler,feature_external_ges
 import datetime
+import StringIO
 
 TIMEFMT = '%Y-%m-%d %H:%M:%S'
 
+#how many bytes to hand the XML parser at a time when reading files
+CHUNKSIZE = 65536
+
+def convertValue(key,value):
+    """
+    Convert an attribute value string to a float or int if possible, or to a datetime if the
+    attribute name mentions a time or date and the value is in TIMEFMT.
+    """
+    try:
+        value = float(value)
+    except ValueError,msg:
+        try:
+            value = int(value)
+        except ValueError,msg:
+            pass
+    #this may be a time field - let's assume it is and try to parse it
+    if (isinstance(value,str) or isinstance(value,unicode)) and (key.lower().count('time') or key.lower().count('date')): 
+        try:
+            value = datetime.datetime.strptime(value,TIMEFMT)
+        except ValueError:
+            pass #oh, well, I guess it isn't
+    return value
+
+class RawValue(unicode):
+    """
+    Attribute value exactly as it was read from XML, not yet converted with convertValue().
+    """
+    __slots__ = ()
+
+class Attributes(dict):
+    """
+    Attribute dictionary that can hold RawValue strings.  A RawValue is converted with
+    convertValue() the first time it is read, and the result is kept alongside it.  The
+    RawValue itself stays in the dictionary, so path queries, the id index (see
+    getAttributeText()) and rendering always see the text that was read, however the
+    attribute has been used.
+    """
+    __slots__ = ('_converted',) #key -> (RawValue,converted value), made on the first read
+
+    def __getitem__(self,key):
+        value = dict.__getitem__(self,key)
+        if not isinstance(value,RawValue):
+            return value
+        try:
+            converted = self._converted
+        except AttributeError:
+            converted = self._converted = {}
+        entry = converted.get(key)
+        #only good while the same RawValue is still stored under key
+        if entry is None or entry[0] is not value:
+            entry = converted[key] = (value,convertValue(key,unicode(value)))
+        return entry[1]
+
+    def get(self,key,default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def iteritems(self):
+        for key in self.keys():
+            yield (key,self[key])
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key,value in self.iteritems():
+            yield value
+
+    def values(self):
+        return list(self.itervalues())
+
+    def pop(self,key,*default):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self,key)
+            return value
+        return dict.pop(self,key,*default)
+
+    def copy(self):
+        #copies stay unconverted until read, like the original
+        return Attributes(dict.iteritems(self))
+
+class EmptyAttributes(Attributes):
+    """
+    Read-only empty attribute dictionary, shared by every Tag that has no attributes.  A Tag
+    swaps it for its own Attributes as soon as its attributes are asked for (see Tag.attributes).
+    """
+    __slots__ = ()
+
+    def _readOnly(self,*args,**kwargs):
+        raise TypeError,'The shared empty attribute dictionary can not be changed.'
+    __setitem__ = _readOnly
+    __delitem__ = _readOnly
+    update = _readOnly
+    setdefault = _readOnly
+    popitem = _readOnly
+    clear = _readOnly
+
+EMPTY_ATTRIBUTES = EmptyAttributes()
+
+#shared by every Tag with no children - addChild() gives a Tag its own list
+EMPTY_CHILDREN = ()
+
+class TagBuilder(ContentHandler):
+    """
+    SAX handler that builds a tree of Tag objects in one pass as the document is parsed.
+
+    A tag's data is the text that comes before its first child element, stripped.  CDATA
+    sections are kept with their <![CDATA[ ]]> markers, so a loaded Tag renders back out
+    the way it was written.  Attributes of the root element are kept as strings; all
+    other attributes are kept as RawValue strings and converted with convertValue() when
+    they are read.
+    """
+    def __init__(self,root,keepChildren=True):
+        """
+        @param root: Tag to fill in from the root element of the document.
+        @param keepChildren: If False, finished children of the root are not added to it,
+        only collected in the completed list (see Tag.iterLoadFromFile()).
+        """
+        ContentHandler.__init__(self)
+        self.root = root
+        self.keepChildren = keepChildren
+        self.stack = [] #[tag,text pieces (None once the first child node is seen)] for each open element
+        self.completed = []
+
+    def _finishText(self,entry):
+        if entry[1] is None:
+            return
+        text = ''.join(entry[1]).strip()
+        if len(text):
+            entry[0].data = text
+        entry[1] = None
+
+    def startElement(self,name,attrs):
+        if len(self.stack):
+            self._finishText(self.stack[-1])
+            attributes = EMPTY_ATTRIBUTES
+            if len(attrs):
+                attributes = Attributes()
+                for key,value in attrs.items():
+                    attributes[key] = RawValue(value)
+            tag = Tag(name,attributes)
+        else:
+            tag = self.root
+            tag.name = name
+            for key,value in attrs.items():
+                tag.addAttribute(key,value)
+        self.stack.append([tag,[]])
+
+    def endElement(self,name):
+        entry = self.stack.pop()
+        self._finishText(entry)
+        if not len(self.stack):
+            return
+        tag = entry[0]
+        parent = self.stack[-1][0]
+        if len(self.stack) == 1:
+            self.completed.append(tag)
+            if not self.keepChildren:
+                return
+        parent.appendChild(tag)
+
+    def characters(self,content):
+        if len(self.stack) and self.stack[-1][1] is not None:
+            self.stack[-1][1].append(content)
+
+    #lexical handler methods
+    def comment(self,content):
+        #a comment before any text means there's no data, as with minidom
+        if len(self.stack) and self.stack[-1][1] is not None:
+            if len(self.stack[-1][1]):
+                self._finishText(self.stack[-1])
+            else:
+                self.stack[-1][1] = None
+
+    def startCDATA(self):
+        self.characters('<![CDATA[')
+
+    def endCDATA(self):
+        self.characters(']]>')
+
+    def startDTD(self,name,publicId,systemId):
+        pass
+
+    def endDTD(self):
+        pass
+
+    def startEntity(self,name):
+        pass
+
+    def endEntity(self,name):
+        pass
+
+def makeParser(builder):
+    parser = xml.sax.make_parser()
+    parser.setContentHandler(builder)
+    parser.setProperty(property_lexical_handler,builder)
+    parser.setFeature(feature_external_ges,False)
+    return parser
+
+class BlankLineFilter(object):
+    """
+    File-like wrapper that passes text through to fobj, leaving out lines that are empty
+    or only whitespace.  Only the current line is ever held in memory.
+    """
+    def __init__(self,fobj):
+        self.fobj = fobj
+        self.pending = []
+
+    def write(self,text):
+        lines = text.split('\n')
+        for line in lines[0:-1]:
+            self.pending.append(line)
+            line = ''.join(self.pending)
+            self.pending = []
+            if len(line.strip()):
+                self.fobj.write(line + '\n')
+        if len(lines[-1]):
+            self.pending.append(lines[-1])
+
+    def flush(self):
+        #a last line without a newline still gets one
+        line = ''.join(self.pending)
+        self.pending = []
+        if len(line.strip()):
+            self.fobj.write(line + '\n')
+
+def getAttributeText(attributes,key):
+    """
+    Get an attribute value as the text it would be written as, without converting RawValues.
+    @return: Attribute text, or None if the attribute isn't there.
+    """
+    value = dict.get(attributes,key)
+    if value is None or isinstance(value,basestring):
+        return value
+    if isinstance(value,datetime.datetime):
+        return value.strftime(TIMEFMT)
+    return str(value)
+
+PATH_STEP = re.compile(r'^(\*|[^\[\]/@=]+)((?:\[[^\]]*\])*)$')
+PATH_PREDICATE = re.compile(r'\[\s*(?:@([^=\]\s]+)\s*(?:=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\]]*?)))?|(\d+))\s*\]')
+
+class TagPath(object):
+    """
+    Compiled path query, like 'contents/file[@id=bodywave3_2]/format'.
+
+    Steps are separated by /, and the first step is matched against the tag the query starts
+    from.  A step is a tag name or *, followed by any number of predicates: [@key=value]
+    (attribute text equals value, which may be quoted), [@key] (attribute is present) or
+    [N] (the Nth match under each parent, counting from 1).
+    """
+    def __init__(self,path):
+        self.path = path
+        self.steps = []
+        for step in self._split(path):
+            m = PATH_STEP.match(step.strip())
+            if m is None:
+                raise Exception,'Bad step "%s" in path "%s"' % (step,path)
+            name,predtext = m.groups()
+            predicates = []
+            pos = 0
+            for p in PATH_PREDICATE.finditer(predtext):
+                if p.start() != pos:
+                    break
+                pos = p.end()
+                key,dquoted,squoted,bare,index = p.groups()
+                if index is not None:
+                    predicates.append(('index',int(index)))
+                elif dquoted is not None or squoted is not None or bare is not None:
+                    value = [v for v in (dquoted,squoted,bare) if v is not None][0]
+                    predicates.append(('equals',(key,value)))
+                else:
+                    predicates.append(('has',key))
+            if pos != len(predtext):
+                raise Exception,'Bad predicate in step "%s" of path "%s"' % (step,path)
+            self.steps.append((name.strip(),predicates))
+
+    def _split(self,path):
+        #split on / characters that aren't inside [...]
+        steps = []
+        depth = 0
+        start = 0
+        for i,c in enumerate(path):
+            if c == '[':
+                depth += 1
+            elif c == ']':
+                depth -= 1
+            elif c == '/' and depth == 0:
+                steps.append(path[start:i])
+                start = i+1
+        steps.append(path[start:])
+        return steps
+
+    def _filter(self,tags,predicates):
+        for kind,arg in predicates:
+            if kind == 'index':
+                tags = tags[arg-1:arg]
+            elif kind == 'has':
+                tags = [tag for tag in tags if arg in tag._attributes]
+            else:
+                key,value = arg
+                tags = [tag for tag in tags if getAttributeText(tag._attributes,key) == value]
+        return tags
+
+    def _getCandidates(self,parent,name,predicates):
+        #use the id index when the first predicate picks out an id
+        if len(predicates) and predicates[0][0] == 'equals' and predicates[0][1][0] == 'id':
+            child = parent.getChildById(predicates[0][1][1])
+            if child is None or (name != '*' and child.name != name):
+                return ([],predicates[1:])
+            return ([child],predicates[1:])
+        if name == '*':
+            return (list(parent.children),predicates)
+        return (parent.getChildren(name),predicates)
+
+    def findAll(self,tag):
+        """
+        @return: List of all tags under (and including) tag that match the path.
+        """
+        name,predicates = self.steps[0]
+        if name != '*' and name != tag.name:
+            return []
+        current = self._filter([tag],predicates)
+        for name,predicates in self.steps[1:]:
+            matches = []
+            for parent in current:
+                candidates,remaining = self._getCandidates(parent,name,predicates)
+                matches.extend(self._filter(candidates,remaining))
+            current = matches
+            if not len(current):
+                break
+        return current
+
+_paths = {}
+
+def compilePath(path):
+    """
+    Get the compiled TagPath for path, compiling it only the first time it's seen.
+    """
+    tagpath = _paths.get(path)
+    if tagpath is None:
+        tagpath = TagPath(path)
+        _paths[path] = tagpath
+    return tagpath
+
 class Tag(object):
-    def __init__(self,name,attributes={},data=None,root=None,schema=None):
+    __slots__ = ('name','_attributes','data','schema','children','nameindex','idindex')
+
+    def __init__(self,name,attributes=None,data=None,root=None,schema=None):
+        if attributes is None:
+            attributes = EMPTY_ATTRIBUTES
         if not isinstance(attributes,dict):
             raise Exception,'Attributes for Tag %s are of type %s, not dict!' % (name,type(attributes))
         self.data = data
-        self.attributes = attributes
+        self._attributes = attributes
         self.name = name
         self.schema = schema
-        self.children = []
+        self.children = EMPTY_CHILDREN
+        #name -> children and id attribute -> child lookups, built the first time they're needed
+        self.nameindex = None
+        self.idindex = None
+
+    def _getAttributes(self):
+        #tags without attributes share EMPTY_ATTRIBUTES until someone asks for them, so that
+        #tag.attributes can always be written to
+        if self._attributes is EMPTY_ATTRIBUTES:
+            self._attributes = Attributes()
+        return self._attributes
+
+    def _setAttributes(self,attributes):
+        self._attributes = attributes
+
+    attributes = property(_getAttributes,_setAttributes)
 
     def addAttribute(self,key,value):
         self.attributes[key] = value
         
     def loadFromFile(self,xmlfile):
-        xmlstr = open(xmlfile,'rt').read()
-        return self.loadFromString(xmlstr)
+        builder = TagBuilder(self)
+        parser = makeParser(builder)
+        f = open(xmlfile,'rb')
+        try:
+            for chunk in iter(lambda: f.read(CHUNKSIZE),''):
+                parser.feed(chunk)
+            parser.close()
+        finally:
+            f.close()
 
     def loadFromString(self,xmlstr):
-        dom = minidom.parseString(xmlstr)
-        #try to detect which child node of the dom is an actual XML element
-        for root in dom.childNodes:
-            if not isinstance(root,minidom.DocumentType):
-                break
-        self.name = root.nodeName
-        atts = root.attributes
-        hasData = root.firstChild.nodeType == root.TEXT_NODE and len(root.firstChild.nodeValue.strip())
-        if len(atts) and hasData:
-            pass
-            #raise Exception,'You can have child elements or tag data, but not both!'
-        if len(atts):
-            for item in atts.items():
-                key = item[0]
-                value = item[1]
-                self.attributes[key] = value
-        if hasData:
-            self.data = root.firstChild.nodeValue.strip()
-        for child in root.childNodes:
-            if child.nodeType == child.ELEMENT_NODE:
-                self.children.append(copy.deepcopy(self.convertNode(child)))
+        if isinstance(xmlstr,unicode):
+            xmlstr = xmlstr.encode('utf-8')
+        builder = TagBuilder(self)
+        parser = makeParser(builder)
+        parser.feed(xmlstr)
+        parser.close()
 
+    def iterLoadFromFile(self,xmlfile,chunksize=CHUNKSIZE):
+        """
+        Parse an XML file incrementally, yielding each child of the root element as soon as
+        it has been parsed.  This tag gets the root element's name and attributes, but the
+        children are not added to it, so memory use stays bounded for large files.
+        """
+        builder = TagBuilder(self,keepChildren=False)
+        parser = makeParser(builder)
+        f = open(xmlfile,'rb')
+        try:
+            for chunk in iter(lambda: f.read(chunksize),''):
+                parser.feed(chunk)
+                completed = builder.completed
+                builder.completed = []
+                for child in completed:
+                    yield child
+            parser.close()
+            for child in builder.completed:
+                yield child
+        finally:
+            f.close()
 
     def convertNode(self,child):
+        """
+        Convert a minidom element node (and its children) to a Tag.
+        """
         name = child.nodeName
         atts = child.attributes
         c1 = child.firstChild is not None
@@ -57,117 +440,163 @@ class Tag(object):
             c3 = len(child.firstChild.nodeValue.strip())
             hasData = c1 and c2 and c3
 
-        if len(atts) and hasData:
-            pass
-            #raise Exception,'You can have child elements or tag data, but not both!'
-        attributes = {}
+        attributes = EMPTY_ATTRIBUTES
         if len(atts):
-            for item in atts.items():
-                key = item[0]
-                value = item[1]
-                try:
-                    value = float(value)
-                except ValueError,msg:
-                    try:
-                        value = int(value)
-                    except ValueError,msg:
-                        pass
-                #this may be a time field - let's assume it is and try to parse it
-                if (isinstance(value,str) or isinstance(value,unicode)) and (key.lower().count('time') or key.lower().count('date')): 
-                    try:
-                        value = datetime.datetime.strptime(value,TIMEFMT)
-                    except ValueError:
-                        pass #oh, well, I guess it isn't
-                    
-                attributes[key] = value
+            attributes = Attributes()
+            for key,value in atts.items():
+                attributes[key] = RawValue(value)
         data = None
         if hasData:
             data = child.firstChild.nodeValue.strip()
-        children = []
+        t = Tag(name,attributes,data)
         for child2 in child.childNodes:
             if child2.nodeType == child2.ELEMENT_NODE:
-                children.append(copy.deepcopy(self.convertNode(child2)))
-        t = Tag(name,attributes,data)
-        for child in children:
-            t.addChild(child)
+                t.appendChild(self.convertNode(child2))
         return t
 
     def __repr__(self):
         fmt = '[%s: Attributes: "%s" Data: %s... %i children]'
-        attstr = ' '.join(self.attributes.keys())
+        attstr = ' '.join(self._attributes.keys())
         repstr = fmt % (self.name,attstr,self.data,len(self.children))
         return repstr
 
-    def getChildren(self,name):
-        children = []
+    def buildIndex(self):
+        """
+        Rebuild the child lookups.  Only needed after changing the children list directly -
+        addChild() and deleteChildren() keep them up to date.
+        """
+        self.nameindex = {}
+        self.idindex = {}
         for child in self.children:
-            if child.name == name:
-                children.append(child)
-        return children
+            self._indexChild(child)
+
+    def _indexChild(self,child):
+        self.nameindex.setdefault(child.name,[]).append(child)
+        childid = getAttributeText(child._attributes,'id')
+        if childid is not None and childid not in self.idindex:
+            self.idindex[childid] = child
+
+    def getChildren(self,name):
+        if self.nameindex is None:
+            self.buildIndex()
+        return list(self.nameindex.get(name,[]))
+
+    def getChildById(self,childid):
+        """
+        @return: The first child whose id attribute is childid, or None.
+        """
+        if self.idindex is None:
+            self.buildIndex()
+        return self.idindex.get(childid)
+
+    def findAll(self,path):
+        """
+        @return: List of all tags matching a path query, like 'contents/file[@id=bodywave3_2]/format'.
+        See TagPath for the query syntax.  The first step of the path matches this tag.
+        """
+        return compilePath(path).findAll(self)
+
+    def find(self,path):
+        """
+        @return: The first tag matching a path query (see findAll()), or None.
+        """
+        matches = compilePath(path).findAll(self)
+        if len(matches):
+            return matches[0]
+        return None
 
     def addChild(self,tag):
         if not isinstance(tag,Tag):
             raise Exception,'addChild only takes Tag objects as arguments'
         if self.data is not None:
             raise Exception,'You can have child elements or tag data, but not both!'
+        self.appendChild(tag)
+
+    def appendChild(self,tag):
+        #add a child without any checks (the XML loaders allow data and children together)
+        if self.children is EMPTY_CHILDREN:
+            self.children = []
         self.children.append(tag)
+        if self.nameindex is not None:
+            self._indexChild(tag)
 
     def deleteChildren(self,tagname):
-        if not isinstance(tagname,str):
+        if not isinstance(tagname,basestring):
             raise Exception,'deleteChildren only takes string objects as arguments'
-        numchildren = 0
-        goodchildren = []
-        for child in self.children:
-            if child.name != tagname:
-                goodchildren.append(copy.deepcopy(child))
-            else:
-                numchildren += 1
-        
-        self.children = goodchildren
+        if self.nameindex is None:
+            self.buildIndex()
+        numchildren = len(self.nameindex.pop(tagname,[]))
+        if numchildren:
+            self.children[:] = [child for child in self.children if child.name != tagname]
+            self.idindex = None #rebuilt when next needed
         return numchildren
 
-    def renderTag(self,ntabs):
-        hasAttributes = bool(len(self.attributes))
+    def writeTag(self,fobj,ntabs=0):
+        """
+        Write the tag (and all of its children) to a file-like object, piece by piece.
+        """
+        hasAttributes = bool(len(self._attributes))
         hasData = self.data is not None
         hasChildren = bool(len(self.children))
 
         linestr = '\t'*ntabs+'<%s ' % self.name
         if hasAttributes:
-            attstr = ''
-            for key,value in self.attributes.iteritems():
+            atts = []
+            #RawValues are written as they were read, without converting them
+            for key,value in dict.iteritems(self._attributes):
                 if isinstance(value,datetime.datetime):
                     value = value.strftime(TIMEFMT)
                 #strip out " (double quotes) from attributes - they'll mess up XML parsing later
                 if isinstance(value,str) or isinstance(value,unicode):
                     value = value.replace('"',"'")
-                attstr = attstr + '%s="%s" ' % (key,str(value))
-            linestr = linestr + attstr.strip()
+                atts.append('%s="%s"' % (key,str(value)))
+            linestr = linestr + ' '.join(atts)
         if hasData or hasChildren:
+            fobj.write(linestr.rstrip() + '>\n')
             if hasData:
-                linestr = linestr.rstrip() + '>\n'
-                linestr = linestr + '\t'*(ntabs+1) + self.data + '\n' + '\t'*ntabs + '</%s>\n' % self.name
+                fobj.write('\t'*(ntabs+1))
+                fobj.write(self.data)
+                fobj.write('\n' + '\t'*ntabs + '</%s>' % self.name)
+                if hasChildren:
+                    fobj.write('>\n')
+                else:
+                    fobj.write('\n')
             if hasChildren:
-                linestr = linestr.rstrip() + '>\n'
                 for child in self.children:
-                    linestr = linestr + child.renderTag(ntabs+1)
-                linestr = linestr + '\n' + '\t'*ntabs + '</%s>\n' % self.name
-                #linestr = linestr + '\t'*ntabs + '</%s>\n' % self.name
+                    child.writeTag(fobj,ntabs+1)
+                fobj.write('\n' + '\t'*ntabs + '</%s>\n' % self.name)
         else:
-            linestr = linestr + '/>\n'
-        return linestr
+            fobj.write(linestr + '/>\n')
+
+    def renderTag(self,ntabs):
+        buf = StringIO.StringIO()
+        self.writeTag(buf,ntabs)
+        return buf.getvalue()
+
+    def writeXML(self,fobj,ntabs=0):
+        """
+        Stream the tag (and all of its children) as an XML document to a file-like object,
+        leaving out blank lines.
+        """
+        out = BlankLineFilter(fobj)
+        out.write('<?xml version="1.0" encoding="US-ASCII" standalone="yes"?>\n')
+        self.writeTag(out,ntabs)
+        out.flush()
 
     def renderToXML(self,filename=None,ntabs=0):
-        xmlstr = '<?xml version="1.0" encoding="US-ASCII" standalone="yes"?>\n'
-        xmlstr = xmlstr + self.renderTag(ntabs)
-        xmlstr2 = ''
-        for line in xmlstr.split('\n'):
-            if len(line.strip()):
-                xmlstr2 = xmlstr2 + line + '\n'
+        """
+        Render the tag (and all of its children) as an XML document.
+        @param filename: File to stream the document to.  If None, the document is returned instead.
+        @return: The XML document as a string, or None if filename was given.
+        """
         if filename is not None:
             f = open(filename,'wt')
-            f.write(xmlstr2)
+            self.writeXML(f,ntabs)
             f.close()
-        return xmlstr
+            return None
+        buf = StringIO.StringIO()
+        self.writeXML(buf,ntabs)
+        return buf.getvalue()
 
 
 if __name__ == '__main__':
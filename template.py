@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import re
+
+#macros look like [NAME] - upper case letters, digits and underscores.  Bracketed
+#text like [Bird, 2003] is not a macro and is left alone.
+MACRO_PATTERN = re.compile(r'\[([A-Z][A-Z0-9_]*)\]')
+
+class Template(object):
+    """
+    Text containing [NAME] macros, parsed once into a list of tokens.
+    """
+    def __init__(self,text):
+        #re.split() with one group gives literal,name,literal,name,...,literal
+        self.tokens = MACRO_PATTERN.split(text)
+        self.names = self.tokens[1::2]
+
+    def render(self,context):
+        """
+        Fill in every macro in a single pass.
+        @param context: Dictionary of macro name (without brackets) to value.  Values that aren't
+        strings are converted with %s.  Macros missing from context are left in place, so
+        a document can be filled in several steps.
+        @return: Rendered text.
+        """
+        parts = list(self.tokens)
+        for i in range(1,len(parts),2):
+            name = parts[i]
+            if name in context:
+                value = context[name]
+                if not isinstance(value,basestring):
+                    value = '%s' % value
+                parts[i] = value
+            else:
+                parts[i] = '[%s]' % name
+        return ''.join(parts)
+
+    def renderEach(self,contexts):
+        """
+        Render a repeated section once per context and join the results.
+        """
+        return ''.join([self.render(context) for context in contexts])
+
+_templates = {}
+
+def getTemplate(text):
+    """
+    Get the parsed Template for text, parsing it only the first time it's seen.
+    """
+    template = _templates.get(text)
+    if template is None:
+        template = Template(text)
+        _templates[text] = template
+    return template
+
+def render(text,context):
+    """
+    Shortcut for getTemplate(text).render(context).
+    """
+    return getTemplate(text).render(context)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os.path
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+#local imports
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import ffault
+import ffwatch
+
+class Options(object):
+    def __init__(self,**kwargs):
+        self.version = 1
+        self.comment = 'Not available yet.'
+        self.offline = True
+        self.thumbnails = False
+        self.optimize = False
+        self.doSend = True
+        self.__dict__.update(kwargs)
+
+class BlobStore(object):
+    def prune(self):
+        return (0,0)
+
+class SendTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir,'ffmdata')
+        for name in ['b0006bqc','b0006bqc2']:
+            os.makedirs(os.path.join(self.root,name))
+        self.sent = []
+        self.saved = (ffault.BASE_PDL_FOLDER,ffault.processBatchRow,ffault.sendProduct,ffault.getBlobStore)
+        ffault.BASE_PDL_FOLDER = os.path.join(self.tmpdir,'pdl')
+        def processBatchRow(row,offline=False,thumbnails=False,optimize=False):
+            return {'eventid':row['eventid'],'success':True,'message':'built',
+                    'pdlfolder':os.path.join(ffault.BASE_PDL_FOLDER,row['eventid']),'eventdicts':[]}
+        def sendProduct(eventdicts,eventid,pdlfolder,sender=None):
+            self.sent.append(eventid)
+            return ('send %s' % eventid,True,'')
+        ffault.processBatchRow = processBatchRow
+        ffault.sendProduct = sendProduct
+        ffault.getBlobStore = BlobStore
+
+    def tearDown(self):
+        ffault.BASE_PDL_FOLDER,ffault.processBatchRow,ffault.sendProduct,ffault.getBlobStore = self.saved
+        shutil.rmtree(self.tmpdir)
+
+    def testDirectoriesAreNotSent(self):
+        #without a manifest, b0006bqc2 would be sent as an event of its own
+        rows = ffwatch.getEventRows(self.root,'us',Options())
+        self.assertEqual(sorted([row['eventid'] for row in rows]),['usb0006bqc','usb0006bqc2'])
+        for row in rows:
+            self.assertTrue(ffwatch.buildEvent(row,Options()))
+        self.assertEqual(self.sent,[])
+
+    def testManifestEventsAreSent(self):
+        manifestfile = os.path.join(self.tmpdir,'events.csv')
+        f = open(manifestfile,'wt')
+        f.write('usb0006bqc,b0006bqc,b0006bqc2,,\n')
+        f.close()
+        manifest = ffwatch.WatchManifest(manifestfile,self.root)
+        rows = ffwatch.getEventRows(self.root,'us',Options(),manifest)
+        self.assertEqual(len(rows),1)
+        self.assertTrue(ffwatch.buildEvent(rows[0],Options()))
+        self.assertEqual(self.sent,['usb0006bqc'])
+
+    def testSendNeedsManifest(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(ffwatch.__file__)),'ffwatch.py')
+        process = subprocess.Popen([sys.executable,script,'-S',self.root],stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode,1)
+        self.assertTrue('-m' in output)
+
+if __name__ == '__main__':
+    unittest.main()
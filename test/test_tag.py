@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os.path
+import sys
+import unittest
+
+#local imports
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import tag
+
+XML = '<contents><file id="basemap" version="3" time="2015-03-29 23:48:31"/></contents>'
+
+class AttributeConversionTest(unittest.TestCase):
+    def setUp(self):
+        self.convertValue = tag.convertValue
+        self.nconversions = 0
+        def countingConvert(key,value):
+            self.nconversions += 1
+            return self.convertValue(key,value)
+        tag.convertValue = countingConvert
+
+    def tearDown(self):
+        tag.convertValue = self.convertValue
+
+    def testConvertedOnce(self):
+        root = tag.Tag('contents')
+        root.loadFromString(XML)
+        attributes = root.children[0].attributes
+        for i in range(0,5):
+            self.assertEqual(attributes['version'],3)
+            self.assertEqual(attributes['time'].year,2015)
+        self.assertEqual(attributes.get('version'),3)
+        self.assertEqual(self.nconversions,2)
+
+    def testConvertedAgainWhenReplaced(self):
+        root = tag.Tag('contents')
+        root.loadFromString(XML)
+        attributes = root.children[0].attributes
+        self.assertEqual(attributes['version'],3)
+        attributes['version'] = tag.RawValue(u'4')
+        self.assertEqual(attributes['version'],4)
+        self.assertEqual(self.nconversions,2)
+
+    def testRenderedAsRead(self):
+        root = tag.Tag('contents')
+        root.loadFromString(XML)
+        attributes = root.children[0].attributes
+        attributes['version']
+        attributes['time']
+        self.assertTrue('version="3"' in root.renderToXML())
+        self.assertTrue('time="2015-03-29 23:48:31"' in root.renderToXML())
+
+if __name__ == '__main__':
+    unittest.main()
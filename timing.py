@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+#stdlib imports
+import os
+import json
+import datetime
+import threading
+from timeit import default_timer
+from contextlib import contextmanager
+
+TIMEFMT = '%Y-%m-%dT%H:%M:%S'
+
+class Timer(object):
+    """
+    Record how long each named stage (span) of a run takes.  Spans may nest and may be
+    recorded from several threads at once.
+    """
+    def __init__(self):
+        self.started = datetime.datetime.utcnow()
+        self.start = default_timer()
+        self.spans = [] #dictionaries with name, start (s after the timer started) and duration (s)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self,name):
+        """
+        Time the body of a with statement as a span called name.  The span is recorded even
+        if the body raises an exception.
+        """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.addSpan(name,start-self.start,default_timer()-start)
+
+    def addSpan(self,name,start,duration):
+        self.lock.acquire()
+        try:
+            self.spans.append({'name':name,'start':round(start,6),'duration':round(duration,6),'pid':os.getpid()})
+        finally:
+            self.lock.release()
+
+    def addSpans(self,spans,start,**fields):
+        """
+        Add spans recorded by another Timer (for example in a worker process).
+        @param spans: List of span dictionaries, from the other Timer's spans.
+        @param start: The other Timer's start (its start attribute).
+        @param fields: Anything else to add to each span (plane number, etc.).
+        """
+        offset = start-self.start
+        self.lock.acquire()
+        try:
+            for span in spans:
+                self.spans.append(dict(span,start=round(span['start']+offset,6),**fields))
+        finally:
+            self.lock.release()
+
+    def getTotals(self):
+        """
+        @return: Dictionary of span name to the total time (s) spent in spans of that name.
+        """
+        totals = {}
+        for span in self.spans:
+            totals[span['name']] = round(totals.get(span['name'],0.0)+span['duration'],6)
+        return totals
+
+    def getReport(self,**info):
+        """
+        @param info: Anything else to put in the report (event id, options, etc.).
+        @return: Dictionary with the start time, total time, spans (in the order they started) and per-name totals.
+        """
+        report = dict(info)
+        report['started'] = self.started.strftime(TIMEFMT)
+        report['elapsed'] = round(default_timer()-self.start,6)
+        report['spans'] = sorted(self.spans,key=lambda span: span['start'])
+        report['totals'] = self.getTotals()
+        return report
+
+    def writeReport(self,reportfile,**info):
+        """
+        Write the report (see getReport()) as JSON.
+        """
+        f = open(reportfile,'wt')
+        json.dump(self.getReport(**info),f,indent=1,sort_keys=True)
+        f.close()
+
+#the Timer that span() records in (per thread, see setTimer()), and the one used when none is set
+_current = threading.local()
+_default = Timer()
+
+def getTimer():
+    return getattr(_current,'timer',None) or _default
+
+def setTimer(timer):
+    """
+    Make timer the one that span() records in, for this thread only.
+    @param timer: Timer, or None to go back to the default.
+    @return: The timer.
+    """
+    _current.timer = timer
+    return timer
+
+def span(name):
+    """
+    Time the body of a with statement as a span of the current Timer (see setTimer()).
+    """
+    return getTimer().span(name)